@@ -0,0 +1,278 @@
+"""
+concurrent HMI load tester: many virtual operators against the coordinator,
+mixing GET /update polls, HMI asset fetches and POST /manual pump toggles at a
+target request rate, while the coordinator's /metrics are scraped around every
+step to show what the load does to the control loop running in the same
+process (cycle start jitter, cycle and poll durations, overruns and modbus
+round trips)
+
+    python hmiload.py -u http://192.168.1.2 -o 500 -r 100,500,1000 -d 10
+    python hmiload.py -u http://192.168.1.2 -m update=80,asset=19,manual=1 -r 0
+
+an unloaded baseline step runs first. if manual toggles are in the mix the
+plant is switched to manual mode for the run, and back to the mode it was in
+when done. operators past the HMI server's connection limit (100 for waitress)
+wait to be accepted, which shows up as a long latency tail
+"""
+
+import asyncio
+import json
+import multiprocessing
+import random
+import re
+import sys
+import time
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+import click
+
+# the load generators share loadgen.py, one directory up
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from loadgen import Histogram, Stats, collect, paced, parse_mix, pick, start_workers, step_times
+
+
+KINDS = ("update", "asset", "manual")
+CONTROL_HISTOGRAMS = {
+    # label in the report: metric
+    "cycle_jitter": "psh_cycle_jitter_seconds",
+    "cycle_duration": "psh_cycle_duration_seconds",
+    "poll_duration": "psh_poll_duration_seconds",
+    "modbus_rtt": "psh_modbus_request_duration_seconds",
+}
+
+class OperatorStats(Stats):
+    def __init__(self):
+        self.latency = {kind: Histogram() for kind in KINDS}
+        self.statuses = {}
+        self.errors = 0
+        self.timeouts = 0
+
+
+def parse_kind(kind):
+    if kind not in KINDS:
+        raise click.BadParameter(f"unknown request kind {kind!r}; use one of {', '.join(KINDS)}")
+    return kind
+
+
+async def _request(reader, writer, host, method, path):
+    """One HTTP/1.1 keep-alive request; returns the status code and whether the connection stays open."""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nAccept-Encoding: gzip, br\r\n"
+                 f"Content-Length: 0\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif status not in (204, 304):
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers.get("connection", "").lower() != "close"
+
+
+async def _operator(url, mix, assets, plant, interval, phase, start_at, stop_at, timeout, stats):
+    host, port = url.hostname, url.port or 80
+    loop = asyncio.get_running_loop()
+    query = f"&plant={urllib.parse.quote(plant)}" if plant else ""
+    pump = random.randrange(2)
+    reader = writer = None
+    async for _ in paced(interval, phase, start_at, stop_at):
+        kind = pick(mix)
+        if kind == "update":
+            method, path = "GET", "/update" + query.replace("&", "?", 1)
+        elif kind == "asset":
+            method, path = "GET", random.choice(assets)
+        else:
+            pump ^= 1
+            method, path = "POST", f"/manual?p={pump}{query}"
+        try:
+            async with asyncio.timeout(timeout):
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(host, port)
+                sent = loop.time()
+                status, keep_alive = await _request(reader, writer, host, method, path)
+            stats.latency[kind].add(loop.time() - sent)
+            key = f"{kind} {status}"
+            stats.statuses[key] = stats.statuses.get(key, 0) + 1
+            if not keep_alive:
+                # waitress closes after responses without a body, e.g. the 204 of /manual
+                writer.close()
+                reader = writer = None
+        except (TimeoutError, OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            if isinstance(e, TimeoutError):
+                stats.timeouts += 1
+            else:
+                stats.errors += 1
+            # start over on a fresh connection
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def _run(operators, rate, start_at, stop_at, timeout, url, mix, assets, plant):
+    stats = OperatorStats()
+    url = urllib.parse.urlsplit(url)
+    interval = operators / rate if rate else 0.0
+    await asyncio.gather(*(_operator(url, mix, assets, plant, interval, random.uniform(0, interval) if interval else 0.0,
+                                     start_at, stop_at, timeout, stats)
+                           for _ in range(operators)))
+    return stats
+
+
+def scrape(base):
+    with urllib.request.urlopen(base + "/metrics", timeout=5) as response:
+        return response.read().decode()
+
+
+def parse_histograms(text):
+    """{metric: {le: cumulative count summed over all other labels}} plus sums and counts."""
+    histograms = {}
+    for name, labels, value in re.findall(r"^(\w+)_bucket\{([^}]*)\} (\S+)$", text, re.M):
+        le = re.search(r'le="([^"]+)"', labels).group(1)
+        buckets = histograms.setdefault(name, {})
+        bound = float("inf") if le == "+Inf" else float(le)
+        buckets[bound] = buckets.get(bound, 0.0) + float(value)
+    counters = {}
+    for name, value in re.findall(r"^(psh_cycle_overruns_total|psh_modbus_errors_total)(?:\{[^}]*\})? (\S+)$", text, re.M):
+        counters[name] = counters.get(name, 0.0) + float(value)
+    return histograms, counters
+
+
+def histogram_delta(before, after, name):
+    """count, p50 and p99 (bucket-interpolated, in ms) of what a histogram observed between two scrapes."""
+    bounds = sorted(after.get(name, {}))
+    cumulative = [after[name][b] - before.get(name, {}).get(b, 0.0) for b in bounds]
+    count = cumulative[-1] if cumulative else 0
+
+    def quantile(q):
+        target = q * count
+        lower_bound, lower_count = 0.0, 0.0
+        for bound, seen in zip(bounds, cumulative):
+            if seen >= target:
+                if bound == float("inf"):
+                    return lower_bound
+                share = (target - lower_count) / max(seen - lower_count, 1)
+                return lower_bound + (bound - lower_bound) * share
+            lower_bound, lower_count = bound, seen
+        return lower_bound
+
+    return {"count": int(count), "p50_ms": quantile(0.5) * 1000 if count else None,
+            "p99_ms": quantile(0.99) * 1000 if count else None}
+
+
+def discover_assets(base):
+    """Asset paths referenced by the HMI's index page, plus the page itself."""
+    try:
+        with urllib.request.urlopen(base + "/", timeout=5) as response:
+            page = response.read().decode(errors="replace")
+    except OSError:
+        return ["/"]
+    return ["/"] + sorted(set(re.findall(r'(?:src|href)="(/[^"]+\.(?:js|css|ico|png|svg|json))"', page)))
+
+
+def _manual(base, plant, query):
+    suffix = f"&plant={urllib.parse.quote(plant)}" if plant else ""
+    request = urllib.request.Request(f"{base}/manual?{query}{suffix}", method="POST")
+    urllib.request.urlopen(request, timeout=5).read()
+
+
+def run_step(pool, base, rate, operators, processes, mix, assets, plant, duration, timeout):
+    """One load step; returns (http stats, control loop report)."""
+    start_at, stop_at = step_times(operators, duration)
+    jobs = start_workers(pool, _run, operators, processes, rate, start_at, stop_at, timeout, base, mix, assets, plant)
+    time.sleep(max(0.0, start_at - time.time()))
+    before = parse_histograms(scrape(base))
+    time.sleep(max(0.0, stop_at - time.time()))
+    after = parse_histograms(scrape(base))
+
+    stats = collect(jobs, OperatorStats)
+    control = {label: histogram_delta(before[0], after[0], metric) for label, metric in CONTROL_HISTOGRAMS.items()}
+    control["overruns"] = int(after[1].get("psh_cycle_overruns_total", 0) - before[1].get("psh_cycle_overruns_total", 0))
+    control["modbus_errors"] = int(after[1].get("psh_modbus_errors_total", 0) - before[1].get("psh_modbus_errors_total", 0))
+    return stats, control
+
+
+def _line(name, control, baseline=None):
+    jitter = control["cycle_jitter"]
+    rtt = control["modbus_rtt"]
+    text = (f"cycles {control['cycle_duration']['count']:>5}  jitter p99 {jitter['p99_ms'] or 0:>7.2f} ms  "
+            f"cycle p99 {control['cycle_duration']['p99_ms'] or 0:>7.2f} ms  modbus p99 {rtt['p99_ms'] or 0:>7.2f} ms  "
+            f"overruns {control['overruns']}")
+    if baseline is not None and baseline["modbus_rtt"]["p99_ms"] and rtt["p99_ms"]:
+        text += f"  (modbus {rtt['p99_ms'] / baseline['modbus_rtt']['p99_ms']:.1f}x baseline)"
+    return f"{name:<14} {text}"
+
+
+@click.command()
+@click.option("--url", "-u", default="http://192.168.1.2", help="Base URL of the coordinator HMI (default: http://192.168.1.2)")
+@click.option("--operators", "-o", default=100, help="Concurrent virtual operators, each with its own keep-alive connection (default: 100)")
+@click.option("--rate", "-r", default="0", help="Target requests per second over all operators, 0 for as fast as the HMI answers; a comma-separated list runs one step per rate (default: 0)")
+@click.option("--duration", "-d", default=10.0, help="Seconds each step runs for (default: 10)")
+@click.option("--mix", "-m", default="update=90,asset=9,manual=1", help="Weighted mix of /update polls, asset fetches and /manual pump toggles (default: update=90,asset=9,manual=1)")
+@click.option("--plant", "-p", default=None, help="Plant to address in a multi-plant coordinator (default: the first plant)")
+@click.option("--processes", "-P", default=max(1, multiprocessing.cpu_count() - 1), help="Processes to spread the operators over (default: one less than the CPU count)")
+@click.option("--timeout", "-to", default=5.0, help="Seconds to wait for a response before reconnecting (default: 5.0)")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a summary")
+def main(url, operators, rate, duration, mix, plant, processes, timeout, as_json):
+    base = url.rstrip("/")
+    mix = parse_mix(mix, parse_kind)
+    rates = [float(r) for r in rate.split(",")]
+    assets = discover_assets(base) if "asset" in mix[0] else ["/"]
+    toggles = "manual" in mix[0]
+    if toggles:
+        suffix = f"?plant={urllib.parse.quote(plant)}" if plant else ""
+        with urllib.request.urlopen(f"{base}/update{suffix}", timeout=5) as response:
+            was_manual = json.load(response)["manualControl"]
+
+    results = {"operators": operators, "processes": processes, "duration": duration, "assets": assets, "steps": []}
+    if toggles:
+        _manual(base, plant, "m=1")
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            _, baseline = run_step(pool, base, 0, 0, processes, mix, assets, plant, duration, timeout)
+            results["baseline"] = baseline
+            if not as_json:
+                click.echo(_line("baseline", baseline))
+
+            for step_rate in rates:
+                stats, control = run_step(pool, base, step_rate, operators, processes, mix, assets, plant,
+                                          duration, timeout)
+                requests = sum(h.count for h in stats.latency.values())
+                result = {
+                    "target_rate": step_rate or None,
+                    "achieved_rate": requests / duration,
+                    "statuses": stats.statuses,
+                    "errors": stats.errors,
+                    "timeouts": stats.timeouts,
+                    "http": {kind: h.summary() for kind, h in stats.latency.items() if h.count},
+                    "control": control,
+                }
+                results["steps"].append(result)
+                if as_json:
+                    continue
+                click.echo(f"rate {step_rate or 'max':>8}: {result['achieved_rate']:>7.0f} req/s, "
+                           f"{stats.errors} error(s), {stats.timeouts} timeout(s)")
+                for kind, summary in result["http"].items():
+                    click.echo(f"  {kind:<12} p50 {summary['p50_ms']:>8.2f} ms  p90 {summary['p90_ms']:>8.2f} ms  "
+                               f"p99 {summary['p99_ms']:>8.2f} ms  max {summary['max_ms']:>8.2f} ms")
+                click.echo("  " + _line("control loop", control, baseline))
+    finally:
+        if toggles and not was_manual:
+            _manual(base, plant, "m=0")
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+shared plumbing of the load generators (modbusattacks/modbusload.py and
+hmiattacks/hmiload.py): latency histograms, per-worker statistics, weighted
+request mixes, request pacing, and spreading the clients of a load step over
+a process pool
+"""
+
+import asyncio
+import bisect
+import math
+import random
+import time
+
+
+# log-spaced latency buckets from 10 us to 100 s, 20 per decade
+HISTOGRAM_FLOOR = 1e-5
+HISTOGRAM_PER_DECADE = 20
+HISTOGRAM_BUCKETS = 7 * HISTOGRAM_PER_DECADE + 1
+
+
+class Histogram:
+    def __init__(self, counts=None):
+        self.counts = counts or [0] * (HISTOGRAM_BUCKETS + 1)
+
+    @staticmethod
+    def bound(i):
+        return HISTOGRAM_FLOOR * 10 ** (i / HISTOGRAM_PER_DECADE)
+
+    def add(self, seconds):
+        if seconds <= HISTOGRAM_FLOOR:
+            self.counts[0] += 1
+        else:
+            i = math.ceil(math.log10(seconds / HISTOGRAM_FLOOR) * HISTOGRAM_PER_DECADE)
+            self.counts[min(i, HISTOGRAM_BUCKETS)] += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, pct):
+        """Upper bound of the bucket holding the pct-th percentile, in seconds."""
+        total = self.count
+        if not total:
+            return None
+        rank = math.ceil(pct / 100 * total)
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.bound(i)
+        return self.bound(HISTOGRAM_BUCKETS)
+
+    def summary(self):
+        return {name: (self.percentile(pct) * 1000 if self.count else None)
+                for name, pct in (("p50_ms", 50), ("p90_ms", 90), ("p99_ms", 99), ("p99.9_ms", 99.9), ("max_ms", 100))}
+
+    def render(self, width=50):
+        used = [i for i, n in enumerate(self.counts) if n]
+        if not used:
+            return []
+        peak = max(self.counts)
+        lines = []
+        for i in range(used[0], used[-1] + 1):
+            bar = "#" * math.ceil(self.counts[i] / peak * width) if self.counts[i] else ""
+            lines.append(f"  <= {self.bound(i) * 1000:>10.3f} ms {self.counts[i]:>10} {bar}")
+        return lines
+
+
+def _merged(a, b):
+    if isinstance(a, Histogram):
+        a.merge(b)
+        return a
+    if isinstance(a, dict):
+        return {key: _merged(a[key], b[key]) if key in a and key in b else a.get(key, b.get(key))
+                for key in {**a, **b}}
+    return a + b
+
+
+def _plain(value):
+    if isinstance(value, Histogram):
+        return value.counts
+    if isinstance(value, dict):
+        return {key: _plain(v) for key, v in value.items()}
+    return value
+
+
+def _restored(template, value):
+    if isinstance(template, Histogram):
+        return Histogram(value)
+    if isinstance(template, dict):
+        return {key: _restored(template.get(key), v) for key, v in value.items()}
+    return value
+
+
+class Stats:
+    """
+    What a worker measured. Subclasses set up their fields in __init__ as
+    numbers, Histograms, or dicts of either (a dict of Histograms with every
+    key already present); merge() adds two of them up field by field, and
+    to_tuple() / from_tuple() carry them across processes as plain values.
+    """
+
+    def merge(self, other):
+        for name, value in vars(other).items():
+            setattr(self, name, _merged(getattr(self, name), value))
+
+    def to_tuple(self):
+        return tuple(_plain(value) for value in vars(self).values())
+
+    @classmethod
+    def from_tuple(cls, values):
+        stats = cls()
+        for (name, template), value in zip(list(vars(stats).items()), values):
+            setattr(stats, name, _restored(template, value))
+        return stats
+
+
+def parse_mix(text, parse):
+    """
+    Parse "a=9,b=1" into (choices, cumulative weights), each name turned
+    into a choice by parse(name), which raises click.BadParameter for
+    names it does not know.
+    """
+    choices, weights = [], []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        choices.append(parse(name.strip()))
+        weights.append(float(weight or 1))
+    total = sum(weights)
+    cumulative, running = [], 0.0
+    for weight in weights:
+        running += weight / total
+        cumulative.append(running)
+    return choices, cumulative
+
+
+def pick(mix):
+    """A random choice from a parsed mix, by weight."""
+    choices, cumulative = mix
+    return choices[bisect.bisect_left(cumulative, random.random())] if len(choices) > 1 else choices[0]
+
+
+async def paced(interval, phase, start_at, stop_at):
+    """
+    Yield the loop time each request of one client is due, from the wall
+    clock start_at (shared by all processes) plus phase until stop_at, one
+    every interval seconds; without an interval requests go back to back.
+    The next request is scheduled when the caller asks for it.
+    """
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    due = now + (start_at - time.time()) + phase
+    stop = now + (stop_at - time.time())
+    while True:
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if loop.time() >= stop:
+            return
+        yield due
+        if interval:
+            due += interval
+
+
+def step_times(clients, duration):
+    """Wall clock start and end of a step, leaving the workers time to open their connections."""
+    start_at = time.time() + max(1.0, clients / 2000)
+    return start_at, start_at + duration
+
+
+def _worker(run, clients, rate, start_at, stop_at, *args):
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    return asyncio.run(run(clients, rate, start_at, stop_at, *args)).to_tuple()
+
+
+def start_workers(pool, run, clients, processes, rate, start_at, stop_at, *args):
+    """
+    Spread `clients` and the request rate over up to `processes` workers
+    of the pool, each running the coroutine run(clients, rate, start_at,
+    stop_at, *args) that returns a Stats. Returns the pending jobs.
+    """
+    jobs = []
+    for i in range(processes):
+        share = clients // processes + (1 if i < clients % processes else 0)
+        if share:
+            jobs.append(pool.apply_async(_worker, (run, share, rate * share / clients, start_at, stop_at, *args)))
+    return jobs
+
+
+def collect(jobs, stats_class):
+    """Wait for the jobs of start_workers() and add up what they measured."""
+    stats = stats_class()
+    for job in jobs:
+        stats.merge(stats_class.from_tuple(job.get()))
+    return stats
@@ -0,0 +1,227 @@
+"""
+concurrent modbus/TCP load generator: thousands of client sessions against
+the field device servers with a chosen mix of function codes, at a target
+request rate (or as fast as the servers answer) for a fixed duration, with
+latency histograms of everything it sends
+
+a separate probe process polls like the coordinator does, so each load step
+shows what the load costs the control loop; given several rates the steps run
+in turn after an unloaded baseline, and the first rate at which the probe's
+p99 grows past --knee-factor times the baseline is reported as the knee
+
+    python modbusload.py -t 192.168.1.5:502 -s 1000 -r 500,1000,2000,4000 -d 10
+    python modbusload.py -t 192.168.1.4:502 -t 192.168.1.5:502 -m read_coils=9,write_single_coil=1 -r 0
+
+latency is measured from when each request was sent; at a target rate it is
+also measured from when the request was due (corrected latency), so a server
+that falls behind shows up as latency instead of as a lower request rate
+"""
+
+import asyncio
+import json
+import multiprocessing
+import random
+import struct
+import sys
+from pathlib import Path
+
+import click
+
+# the load generators share loadgen.py, one directory up
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from loadgen import Histogram, Stats, collect, paced, parse_mix, pick, start_workers, step_times
+
+
+FUNCTIONS = {
+    "read_coils": 1,
+    "read_discrete_inputs": 2,
+    "read_holding_registers": 3,
+    "read_input_registers": 4,
+    "write_single_coil": 5,
+    "write_single_register": 6,
+    "write_multiple_coils": 15,
+    "write_multiple_registers": 16,
+}
+
+class LoadStats(Stats):
+    def __init__(self):
+        self.latency = Histogram()
+        self.corrected = Histogram()
+        self.requests = 0
+        self.exceptions = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.connect_failures = 0
+
+
+def parse_function(name):
+    """A function code from its name or number."""
+    function = FUNCTIONS.get(name) or (int(name) if name.isdigit() and int(name) in FUNCTIONS.values() else None)
+    if function is None:
+        raise click.BadParameter(f"unknown function {name!r}; use one of {', '.join(FUNCTIONS)}")
+    return function
+
+
+def parse_target(text):
+    """HOST[:PORT][/UNIT]"""
+    address, _, unit = text.partition("/")
+    host, _, port = address.partition(":")
+    return host, int(port or 502), int(unit or 0)
+
+
+def build_pdu(function, address, count):
+    if function in (1, 2, 3, 4):
+        return struct.pack(">BHH", function, address, count)
+    if function == 5:
+        return struct.pack(">BHH", function, address, 0xFF00 if random.random() < 0.5 else 0)
+    if function == 6:
+        return struct.pack(">BHH", function, address, random.randrange(0x10000))
+    if function == 15:
+        data = bytes(random.randrange(256) for _ in range((count + 7) // 8))
+        return struct.pack(">BHHB", function, address, count, len(data)) + data
+    values = [random.randrange(0x10000) for _ in range(count)]
+    return struct.pack(f">BHHB{count}H", function, address, count, 2 * count, *values)
+
+
+async def _session(target, mix, address, count, interval, phase, start_at, stop_at, timeout, stats):
+    host, port, unit = target
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        stats.connect_failures += 1
+        return
+    loop = asyncio.get_running_loop()
+    transaction = 0
+    try:
+        async for due in paced(interval, phase, start_at, stop_at):
+            pdu = build_pdu(pick(mix), address, count)
+            transaction = (transaction + 1) & 0xFFFF
+            sent = loop.time()
+            writer.write(struct.pack(">HHHB", transaction, 0, len(pdu) + 1, unit) + pdu)
+            try:
+                async with asyncio.timeout(timeout):
+                    header = await reader.readexactly(7)
+                    body = await reader.readexactly((header[4] << 8 | header[5]) - 1)
+            except TimeoutError:
+                stats.timeouts += 1
+                break
+            received = loop.time()
+            stats.latency.add(received - sent)
+            if interval:
+                stats.corrected.add(received - due)
+            stats.requests += 1
+            if body[0] & 0x80:
+                stats.exceptions += 1
+    except (OSError, asyncio.IncompleteReadError):
+        stats.errors += 1
+    finally:
+        writer.close()
+
+
+async def _run(sessions, rate, start_at, stop_at, timeout, targets, mix, address, count):
+    stats = LoadStats()
+    interval = sessions / rate if rate else 0.0
+    tasks = [_session(targets[i % len(targets)], mix, address, count, interval,
+                      random.uniform(0, interval) if interval else 0.0, start_at, stop_at, timeout, stats)
+             for i in range(sessions)]
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def run_step(pool, rate, sessions, processes, targets, mix, address, count, duration, timeout, probe):
+    """One load step; returns (load stats, probe stats or None)."""
+    start_at, stop_at = step_times(sessions, duration)
+    jobs = start_workers(pool, _run, sessions, processes, rate, start_at, stop_at, timeout, targets, mix, address, count)
+    probe_jobs = None
+    if probe is not None:
+        target, function, period = probe
+        probe_jobs = start_workers(pool, _run, 1, 1, 1 / period, start_at, stop_at, timeout,
+                                   [target], ([function], [1.0]), address, 1)
+    return collect(jobs, LoadStats), (collect(probe_jobs, LoadStats) if probe_jobs is not None else None)
+
+
+def _step_result(rate, duration, load, probe):
+    result = {
+        "target_rate": rate or None,
+        "achieved_rate": load.requests / duration,
+        "requests": load.requests,
+        "exceptions": load.exceptions,
+        "errors": load.errors,
+        "timeouts": load.timeouts,
+        "connect_failures": load.connect_failures,
+        "latency": load.latency.summary(),
+    }
+    if rate:
+        result["corrected_latency"] = load.corrected.summary()
+    if probe is not None:
+        result["probe"] = {"requests": probe.requests, "timeouts": probe.timeouts, "errors": probe.errors,
+                           "latency": probe.latency.summary()}
+    return result
+
+
+@click.command()
+@click.option("--target", "-t", "targets", multiple=True, required=True, help="HOST[:PORT][/UNIT] of a device to load; sessions are spread over all targets (port default: 502, unit default: 0)")
+@click.option("--sessions", "-s", default=100, help="Concurrent client sessions, each with its own connection (default: 100)")
+@click.option("--rate", "-r", default="0", help="Target requests per second over all sessions, 0 for as fast as the servers answer; a comma-separated list runs one step per rate (default: 0)")
+@click.option("--duration", "-d", default=10.0, help="Seconds each step runs for (default: 10)")
+@click.option("--mix", "-m", default="read_coils", help="Weighted mix of function codes, e.g. read_coils=9,write_single_coil=1 (default: read_coils)")
+@click.option("--address", "-a", default=0, help="Zero-based address every request starts at (default: 0)")
+@click.option("--count", "-c", default=1, help="Points each read or multiple write covers (default: 1)")
+@click.option("--processes", "-P", default=max(1, multiprocessing.cpu_count() - 1), help="Processes to spread the sessions over (default: one less than the CPU count)")
+@click.option("--timeout", "-to", default=2.0, help="Seconds to wait for a response before a session gives up (default: 2.0)")
+@click.option("--probe", "-pr", default=None, help="HOST[:PORT][/UNIT] to poll like the coordinator while the load runs (default: the first target)")
+@click.option("--probe-function", "-pf", default="read_coils", type=click.Choice(list(FUNCTIONS)), help="Function the probe polls with (default: read_coils)")
+@click.option("--probe-period", "-pp", default=0.1, help="Seconds between probe polls, 0 to disable the probe (default: 0.1)")
+@click.option("--knee-factor", "-k", default=2.0, help="Probe p99 over the unloaded baseline that counts as the knee (default: 2.0)")
+@click.option("--histogram", "-H", is_flag=True, help="Print the latency histogram of every step")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a summary")
+def main(targets, sessions, rate, duration, mix, address, count, processes, timeout, probe, probe_function,
+         probe_period, knee_factor, histogram, as_json):
+    targets = [parse_target(t) for t in targets]
+    mix = parse_mix(mix, parse_function)
+    rates = [float(r) for r in rate.split(",")]
+    probe = (parse_target(probe) if probe else targets[0], FUNCTIONS[probe_function], probe_period) if probe_period > 0 else None
+
+    results = {"sessions": sessions, "processes": processes, "duration": duration, "steps": []}
+    with multiprocessing.Pool(processes + (1 if probe else 0)) as pool:
+        baseline = None
+        if probe is not None:
+            _, probe_stats = run_step(pool, 0, 0, processes, targets, mix, address, count, duration, timeout, probe)
+            baseline = probe_stats.latency.percentile(99)
+            results["baseline_probe"] = {"requests": probe_stats.requests, "latency": probe_stats.latency.summary()}
+            if not as_json:
+                click.echo(f"baseline probe p99 {baseline * 1000:.3f} ms over {probe_stats.requests} poll(s)")
+
+        for step_rate in rates:
+            load, probe_stats = run_step(pool, step_rate, sessions, processes, targets, mix, address, count,
+                                         duration, timeout, probe)
+            result = _step_result(step_rate, duration, load, probe_stats)
+            if baseline and probe_stats is not None and probe_stats.latency.count:
+                result["probe"]["p99_over_baseline"] = probe_stats.latency.percentile(99) / baseline
+                if "knee_rate" not in results and result["probe"]["p99_over_baseline"] >= knee_factor:
+                    results["knee_rate"] = result["achieved_rate"]
+            results["steps"].append(result)
+            if as_json:
+                continue
+            latency = result["latency"]
+            line = (f"rate {step_rate or 'max':>8}: {result['achieved_rate']:>9.0f} req/s  "
+                    f"p50 {latency['p50_ms'] or 0:>8.3f} ms  p99 {latency['p99_ms'] or 0:>8.3f} ms  "
+                    f"corrected p99 {result.get('corrected_latency', latency)['p99_ms'] or 0:>8.3f} ms  "
+                    f"exceptions {load.exceptions}  errors {load.errors + load.timeouts + load.connect_failures}")
+            if probe_stats is not None:
+                line += (f"  | probe p99 {result['probe']['latency']['p99_ms'] or 0:>8.3f} ms"
+                         f" ({result['probe'].get('p99_over_baseline', 0):.1f}x)")
+            click.echo(line)
+            if histogram:
+                click.echo("\n".join(load.latency.render()))
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+    elif probe is not None:
+        knee = results.get("knee_rate")
+        click.echo(f"knee: probe p99 reached {knee_factor}x the baseline at {knee:.0f} req/s" if knee is not None
+                   else f"knee: probe p99 stayed below {knee_factor}x the baseline at every rate")
+
+
+if __name__ == "__main__":
+    main()
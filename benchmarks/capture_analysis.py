@@ -0,0 +1,156 @@
+"""
+throughput benchmark of the nids Modbus/TCP analyzer
+
+synthesizes a capture of the plant network: the coordinator polling the three
+field devices every 100 ms, HMI traffic on port 8000, and a pumpforce.py style
+attacker writing the pump coil every 2 s. it is then analyzed from a
+memory-mapped file and again through a pipe, as `live` would read it, and the
+benchmark checks that the flood was flagged
+
+usage: python benchmarks/capture_analysis.py -s 1000 --format pcapng
+"""
+
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "nids"))
+
+COORDINATOR = "192.168.1.2"
+ATTACKER = "192.168.1.99"
+HMI_CLIENT = "192.168.1.50"
+DEVICES = [
+    # server, function polled, reply payload
+    ("192.168.1.3", 2, b"\x01\x01"),
+    ("192.168.1.4", 1, b"\x01\x00"),
+    ("192.168.1.5", 1, b"\x01\x01"),
+]
+
+
+def _ethernet(src, dst, sport, dport, payload):
+    tcp = struct.pack(">HHIIBBHHH", sport, dport, 1, 1, 5 << 4, 0x18, 502, 0, 0)
+    ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp) + len(payload), 0, 0, 64, 6, 0,
+                     bytes(map(int, src.split("."))), bytes(map(int, dst.split("."))))
+    return b"\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00" + ip + tcp + payload
+
+
+def _modbus(transaction, function, data, unit=0):
+    return struct.pack(">HHHBB", transaction, 0, len(data) + 2, unit, function) + data
+
+
+def _traffic():
+    """An endless stream of (timestamp, frame) for the synthetic plant network."""
+    t = 1.7e9
+    transaction = 0
+    step = 0
+    while True:
+        t += 0.1
+        step += 1
+        for server, function, reply in DEVICES:
+            transaction = (transaction + 1) & 0xFFFF
+            yield t, _ethernet(COORDINATOR, server, 40000, 502, _modbus(transaction, function, b"\x00\x00\x00\x01"))
+            yield t + 0.0005, _ethernet(server, COORDINATOR, 502, 40000, _modbus(transaction, function, reply))
+        yield t + 0.01, _ethernet(HMI_CLIENT, COORDINATOR, 51000, 8000, b"GET /update HTTP/1.1\r\n\r\n")
+        if step % 20 == 0:
+            transaction = (transaction + 1) & 0xFFFF
+            yield t + 0.05, _ethernet(ATTACKER, "192.168.1.5", 41000, 502, _modbus(transaction, 5, b"\x00\x00\xff\x00"))
+
+
+def write_capture(path, size, fmt):
+    with open(path, "wb") as f:
+        if fmt == "pcap":
+            f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+        else:
+            f.write(struct.pack("<IIIHHqI", 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+            f.write(struct.pack("<IIHHII", 1, 20, 1, 0, 65535, 20))
+        written = 0
+        chunk = []
+        for t, frame in _traffic():
+            if fmt == "pcap":
+                record = struct.pack("<IIII", int(t), int(t % 1 * 1e6), len(frame), len(frame)) + frame
+            else:
+                padded = frame + b"\x00" * (-len(frame) % 4)
+                micros = int(t * 1e6)
+                record = struct.pack("<IIIIIII", 6, 32 + len(padded), 0, micros >> 32, micros & 0xFFFFFFFF,
+                                     len(frame), len(frame)) + padded + struct.pack("<I", 32 + len(padded))
+            chunk.append(record)
+            written += len(record)
+            if len(chunk) >= 10000:
+                f.write(b"".join(chunk))
+                chunk = []
+                if written >= size:
+                    break
+        f.write(b"".join(chunk))
+
+
+@click.command()
+@click.option("--size", "-s", default=200, help="Size of the synthetic capture in MB (default: 200)")
+@click.option("--format", "-f", "fmt", default="pcap", type=click.Choice(["pcap", "pcapng"]), help="Capture format (default: pcap)")
+@click.option("--capture", "-c", default=None, type=click.Path(dir_okay=False), help="Keep the capture at this path instead of a temporary file")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a summary")
+def main(size, fmt, capture, as_json):
+    import analyzer
+
+    directory = tempfile.TemporaryDirectory()
+    path = capture or os.path.join(directory.name, f"bench.{fmt}")
+    start = time.perf_counter()
+    write_capture(path, size * 1_000_000, fmt)
+    generated = time.perf_counter() - start
+    file_bytes = os.path.getsize(path)
+
+    results = {"format": fmt, "file_mb": file_bytes / 1e6, "generate_seconds": generated}
+
+    start = time.perf_counter()
+    mapped = analyzer.analyze_file(path, analyzer.Analyzer(writers=[COORDINATOR]))
+    elapsed = time.perf_counter() - start
+    report = mapped.report()
+    results["mmap"] = {"seconds": elapsed, "mb_per_second": file_bytes / 1e6 / elapsed,
+                       "frames_per_second": mapped.frames / elapsed}
+
+    # the live path, fed by another process through a pipe
+    start = time.perf_counter()
+    with subprocess.Popen(["cat", path], stdout=subprocess.PIPE) as cat:
+        piped = analyzer.Analyzer(writers=[COORDINATOR])
+        for ts, linktype, data, off, length in analyzer.frames_stream(cat.stdout):
+            piped.feed(ts, linktype, data, off, length)
+    elapsed = time.perf_counter() - start
+    results["pipe"] = {"seconds": elapsed, "mb_per_second": file_bytes / 1e6 / elapsed,
+                       "frames_per_second": piped.frames / elapsed}
+
+    floods = [a for a in report["alerts"] if a["alert"] == "write_flood" and a["source"] == ATTACKER]
+    writers = [a for a in report["alerts"] if a["alert"] == "unexpected_writer" and a["source"] == ATTACKER]
+    results.update({
+        "frames": report["frames"],
+        "modbus_requests": report["requests"],
+        "capture_seconds": report["seconds"],
+        "flood_flagged": bool(floods),
+        "flood_flagged_after_seconds": floods[0]["ts"] - floods[0]["since"] if floods else None,
+        "unexpected_writer_flagged": bool(writers),
+        "pipe_matches_mmap": piped.requests == mapped.requests and len(piped.alerts) == len(mapped.alerts),
+    })
+    directory.cleanup()
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+    click.echo(f"{results['file_mb']:.0f} MB {fmt}, {results['frames']} frames covering "
+               f"{results['capture_seconds'] / 3600:.1f} h of traffic (generated in {generated:.1f} s)")
+    for mode in ("mmap", "pipe"):
+        r = results[mode]
+        click.echo(f"{mode:<5} {r['seconds']:>7.2f} s  {r['mb_per_second']:>7.1f} MB/s  {r['frames_per_second']:>10.0f} frames/s")
+    click.echo(f"flood flagged: {results['flood_flagged']}, unexpected writer flagged: "
+               f"{results['unexpected_writer_flagged']}, pipe matches mmap: {results['pipe_matches_mmap']}")
+    if not (results["flood_flagged"] and results["unexpected_writer_flagged"] and results["pipe_matches_mmap"]):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
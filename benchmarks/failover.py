@@ -0,0 +1,242 @@
+"""
+benchmark of how long a hot standby coordinator takes to drive the plant
+after the active one fails, and whether the plant notices
+
+the level sensor, gate and pump servers are started in their debug modbus
+modes with two coordinators sharing a replication socket. the active one is
+put in manual mode with the gate open and the pump on, a combination the
+automatic policy never produces, and once the standby has caught up the
+active one is either killed (--failure kill) or frozen with SIGSTOP
+(--failure stop, a hung process: the standby has to wait out the lease). the
+gate and pump coils are read straight from the devices every few
+milliseconds throughout; the standby then switches the pump off, so a run is
+clean when the gate never moved and the pump moved exactly once. with
+--failure stop the frozen coordinator is resumed afterwards and has to step
+down instead of fighting the new active one. the timings, in seconds:
+
+  takeover     from the failure until the standby reported itself active
+  first_cycle  the standby's own measure from taking over to the end of its
+               first cycle as the active coordinator (psh_failover_seconds)
+  command      from the failure until a manual command sent to the new active
+               one was confirmed
+
+usage: python benchmarks/failover.py -n 5
+       python benchmarks/failover.py --failure stop -n 3
+"""
+
+import http.client
+import json
+import os
+import re
+import signal
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEVICES = ("level-sensor", "gate-controller", "pump-controller")
+TIMINGS = ("takeover", "first_cycle", "command")
+ACTIVE = re.compile(r"^psh_coordinator_active (\S+)", re.MULTILINE)
+FAILOVER = re.compile(r"^psh_failover_seconds (\S+)", re.MULTILINE)
+
+
+def _get(port, path, timeout=0.5):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def _post_json(port, path, timeout=5.0):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("POST", path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def _metric(port, pattern):
+    try:
+        status, body = _get(port, "/metrics")
+    except OSError:
+        return None
+    match = pattern.search(body.decode()) if status == 200 else None
+    return float(match.group(1)) if match else None
+
+
+def _until(condition, timeout, poll=0.002):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return time.monotonic()
+        except (OSError, ValueError):
+            pass
+        time.sleep(poll)
+    return None
+
+
+def _read_coil(sock):
+    # read coils, address 0, count 1
+    sock.sendall(struct.pack(">HHHBBHH", 1, 0, 6, 0, 1, 0, 1))
+    response = b""
+    while len(response) < 10:
+        chunk = sock.recv(256)
+        if not chunk:
+            raise OSError("connection closed")
+        response += chunk
+    return response[9] & 1
+
+
+class CoilWatcher(threading.Thread):
+    """Reads the gate and pump coils from the devices until stopped, counting every change."""
+
+    def __init__(self, gate_port, pump_port, poll=0.002):
+        super().__init__(daemon=True)
+        self.ports = {"gate": gate_port, "pump": pump_port}
+        self.poll = poll
+        self.changes = {"gate": 0, "pump": 0}
+        self.values = {}
+        self.running = True
+
+    def run(self):
+        socks = {name: socket.create_connection(("127.0.0.1", port), timeout=1.0) for name, port in self.ports.items()}
+        try:
+            while self.running:
+                for name, sock in socks.items():
+                    value = _read_coil(sock)
+                    if name in self.values and value != self.values[name]:
+                        self.changes[name] += 1
+                    self.values[name] = value
+                time.sleep(self.poll)
+        finally:
+            for sock in socks.values():
+                sock.close()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def _run(base_port, failure, cycle_period, lease, timeout):
+    modbus_ports = {name: base_port + i for i, name in enumerate(DEVICES)}
+    hmi_ports = (base_port + 20, base_port + 21)
+    replication_socket = f"psh-failover-{os.getpid()}"
+    processes = []
+
+    def start(*args, cwd=ROOT):
+        process = subprocess.Popen([sys.executable, *map(str, args)], cwd=cwd,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        return process
+
+    def start_coordinator(hmi_port):
+        return start("app.py", "-l", "error", "-ss", "127.0.0.1", "-sp", modbus_ports["level-sensor"],
+                     "-gs", "127.0.0.1", "-gp", modbus_ports["gate-controller"],
+                     "-ps", "127.0.0.1", "-pp", modbus_ports["pump-controller"],
+                     "-hp", hmi_port, "-cp", cycle_period, "-hc", 0,
+                     "-rs", replication_socket, "-rl", lease, cwd=ROOT / "coordinator")
+
+    def update(port):
+        return json.loads(_get(port, "/update")[1])
+
+    try:
+        for name in DEVICES:
+            start(ROOT / name / "app.py", "-l", "error", "debug", "modbus", "-h", "127.0.0.1", "-p", modbus_ports[name])
+        active_port, standby_port = hmi_ports
+        active = start_coordinator(active_port)
+        if _until(lambda: _get(active_port, "/ready")[0] == 200, timeout) is None:
+            raise RuntimeError("the active coordinator never became ready")
+        start_coordinator(standby_port)
+        if _until(lambda: _metric(standby_port, ACTIVE) == 0, timeout) is None:
+            raise RuntimeError("the second coordinator never came up as the standby")
+
+        _post_json(active_port, "/manual?m=1&g=1&p=1&wait=2")
+        replicated = _until(lambda: (lambda s: s["manualControl"] and s["gateOpen"] and s["pumpOn"])(update(standby_port)), timeout)
+        if replicated is None:
+            raise RuntimeError("the standby never saw the manual targets")
+
+        watcher = CoilWatcher(modbus_ports["gate-controller"], modbus_ports["pump-controller"])
+        watcher.start()
+        time.sleep(0.1)
+        failed = time.monotonic()
+        active.send_signal(signal.SIGKILL if failure == "kill" else signal.SIGSTOP)
+        took_over = _until(lambda: _metric(standby_port, ACTIVE) == 1, timeout)
+        sample = {name: None for name in TIMINGS}
+        if took_over is not None:
+            sample["takeover"] = took_over - failed
+            sent = time.monotonic()
+            reply = _post_json(standby_port, "/manual?p=0&wait=2")
+            if reply["commands"]["pump"]["status"] == "confirmed":
+                sample["command"] = time.monotonic() - failed
+                sample["command_latency"] = time.monotonic() - sent
+            first_cycle = _until(lambda: _metric(standby_port, FAILOVER) is not None, 1.0)
+            if first_cycle is not None:
+                sample["first_cycle"] = _metric(standby_port, FAILOVER)
+
+        if failure == "stop":
+            # the frozen coordinator comes back with its lease long gone and must step down
+            active.send_signal(signal.SIGCONT)
+            sample["stepped_down"] = _until(lambda: _metric(active_port, ACTIVE) == 0, timeout) is not None
+        time.sleep(max(1.0, 2 * cycle_period))
+        watcher.stop()
+        sample["gate_changes"] = watcher.changes["gate"]
+        sample["pump_changes"] = watcher.changes["pump"]
+        sample["clean"] = watcher.changes == {"gate": 0, "pump": 1 if sample["command"] is not None else 0}
+        return sample
+    finally:
+        for process in processes:
+            if failure == "stop":
+                process.send_signal(signal.SIGCONT)
+            process.kill()
+        for process in processes:
+            process.wait()
+
+
+@click.command()
+@click.option("--runs", "-n", default=5, help="Failovers to time (default: 5)")
+@click.option("--failure", "-f", default="kill", type=click.Choice(["kill", "stop"]), help="Kill the active coordinator outright, or freeze it with SIGSTOP and resume it afterwards (default: kill)")
+@click.option("--cycle-period", "-cp", default=1.0, help="Coordinator control cycle period in seconds (default: 1.0)")
+@click.option("--lease", "-rl", default=0.5, help="Replication lease of the coordinators in seconds (default: 0.5)")
+@click.option("--base-port", "-b", default=16400, help="First of the ports used: devices, then the two HMIs at +20 and +21 (default: 16400)")
+@click.option("--timeout", "-t", default=30.0, help="Seconds to give each step of a run before giving up on it (default: 30)")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a table")
+def main(runs, failure, cycle_period, lease, base_port, timeout, as_json):
+    samples = [_run(base_port, failure, cycle_period, lease, timeout) for _ in range(runs)]
+    results = {"runs": samples, "median": {}}
+    for name in TIMINGS:
+        values = [s[name] for s in samples if s[name] is not None]
+        results["median"][name] = statistics.median(values) if values else None
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+    click.echo(f"{runs} failover(s), active coordinator {'killed' if failure == 'kill' else 'frozen'}, "
+               f"{cycle_period} s cycle, {lease} s lease:")
+    for name in TIMINGS:
+        values = [s[name] for s in samples if s[name] is not None]
+        if not values:
+            click.echo(f"  {name:<12} {'-':>8}")
+            continue
+        click.echo(f"  {name:<12} {statistics.median(values):>7.3f}s median, {min(values):.3f}..{max(values):.3f}s"
+                   f"{'' if len(values) == runs else f' ({runs - len(values)} run(s) never got there)'}")
+    clean = sum(s["clean"] for s in samples)
+    click.echo(f"  {clean}/{runs} run(s) clean (gate never moved, pump moved only when commanded)")
+    if failure == "stop":
+        click.echo(f"  {sum(s.get('stepped_down', False) for s in samples)}/{runs} frozen coordinator(s) stepped down on resuming")
+
+
+if __name__ == "__main__":
+    main()
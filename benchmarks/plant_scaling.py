@@ -0,0 +1,112 @@
+"""
+benchmark of coordinator cycle latency as the number of managed plants (and so
+modbus endpoints) grows
+
+a helper process hosts one modbus/TCP server per simulated device on
+consecutive localhost ports; the coordinator's own poll/actuation path is then
+timed against them for each plant count and worker pool size
+
+usage: python benchmarks/plant_scaling.py run -n 1 -n 10 -n 50 -n 100 -w 1 -w 32
+"""
+
+import asyncio
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "coordinator"))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def _serve(base_port, count):
+    from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+    from pymodbus.server import ModbusTcpServer
+
+    servers = []
+    for port in range(base_port, base_port + count):
+        store = ModbusSlaveContext(di=ModbusSequentialDataBlock(0x01, [0]), co=ModbusSequentialDataBlock(0x01, [0]))
+        context = ModbusServerContext(slaves=store, single=True)
+        servers.append(ModbusTcpServer(context, address=("127.0.0.1", port)))
+    await asyncio.gather(*(s.serve_forever() for s in servers))
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--base-port", "-b", default=15020)
+@click.option("--count", "-c", default=3)
+def serve(base_port, count):
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(_serve(base_port, count))
+
+
+@cli.command()
+@click.option("--plants", "-n", multiple=True, type=int, default=[1, 10, 50, 100], help="Plant counts to benchmark (each plant is 3 devices)")
+@click.option("--workers", "-w", multiple=True, type=int, default=[1, 32], help="Poll worker pool sizes to benchmark")
+@click.option("--cycles", "-k", default=50, help="Cycles to time per configuration")
+@click.option("--base-port", "-b", default=15020)
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a table")
+def run(plants, workers, cycles, base_port, as_json):
+    logging.basicConfig(level=logging.ERROR)
+    import app
+    from plants import Plant
+    from pool import ConnectionPool
+
+    max_devices = 3 * max(plants)
+    server = subprocess.Popen([sys.executable, __file__, "serve", "-b", str(base_port), "-c", str(max_devices)])
+    try:
+        time.sleep(1.0 + max_devices / 200)
+        results = []
+        for n in plants:
+            for w in workers:
+                site = [Plant(f"p{i}", *(("127.0.0.1", base_port + 3 * i + role) for role in range(3))) for i in range(n)]
+                pool = ConnectionPool()
+                app.setup(site, pool)
+                scheduler = app.PollScheduler(1.0, app.build_poll_groups(site, 0, 0), max_workers=min(w, 3 * n))
+                samples = []
+                try:
+                    for _ in range(cycles):
+                        start = time.perf_counter()
+                        app.update_thread_variables(site, scheduler.poll())
+                        scheduler.dispatch(app.run_plant_logic, site)
+                        samples.append(time.perf_counter() - start)
+                finally:
+                    scheduler.shutdown()
+                    pool.close()
+                results.append({
+                    "plants": n,
+                    "devices": 3 * n,
+                    "workers": min(w, 3 * n),
+                    "cycles": cycles,
+                    "median_ms": statistics.median(samples) * 1000,
+                    "p99_ms": _percentile(samples, 99) * 1000,
+                    "max_ms": max(samples) * 1000,
+                })
+    finally:
+        server.terminate()
+        server.wait()
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'plants':>7} {'devices':>8} {'workers':>8} {'median ms':>10} {'p99 ms':>8} {'max ms':>8}")
+    for r in results:
+        print(f"{r['plants']:>7} {r['devices']:>8} {r['workers']:>8} {r['median_ms']:>10.2f} {r['p99_ms']:>8.2f} {r['max_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,186 @@
+"""
+benchmark of the latency and throughput the modbus policy proxy costs
+
+the pump controller is run in its debug modbus mode with the proxy in front
+of it; the same coil reads are made straight to the device and through the
+proxy, one at a time for latency (the added latency is the difference between
+the two at each percentile) and from concurrent connections for throughput.
+the policy decisions are checked along the way: a burst of writes past the
+rate limit, an unmapped address and a function the policy does not allow
+
+usage: python benchmarks/proxy_latency.py -n 20000 -c 8
+"""
+
+import json
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _wait_listening(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.05).close()
+            return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class RawClient:
+    """A minimal modbus/TCP client, so the client adds as little as possible to the timings."""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transaction = 0
+
+    def _recv(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("connection closed")
+            data += chunk
+        return data
+
+    def request(self, pdu, unit=0):
+        self.transaction = (self.transaction + 1) & 0xFFFF
+        self.sock.sendall(struct.pack(">HHHB", self.transaction, 0, len(pdu) + 1, unit) + pdu)
+        header = self._recv(7)
+        transaction, _, length, _ = struct.unpack(">HHHB", header)
+        if transaction != self.transaction:
+            raise RuntimeError(f"response to transaction {transaction}, expected {self.transaction}")
+        return self._recv(length - 1)
+
+    def close(self):
+        self.sock.close()
+
+
+READ_COIL = struct.pack(">BHH", 1, 0, 1)
+
+
+def _latencies(port, requests):
+    client = RawClient(port)
+    for _ in range(200):
+        client.request(READ_COIL)
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.request(READ_COIL)
+        samples.append(time.perf_counter() - start)
+    client.close()
+    return samples
+
+
+def _throughput(port, connections, duration):
+    stop = threading.Event()
+    counts = []
+
+    def loop():
+        client = RawClient(port)
+        n = 0
+        while not stop.is_set():
+            client.request(READ_COIL)
+            n += 1
+        client.close()
+        counts.append(n)
+
+    threads = [threading.Thread(target=loop) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / duration
+
+
+def _check_policy(port, burst):
+    client = RawClient(port)
+    results = {}
+    # a burst of writes, twice the allowed burst
+    answers = [client.request(struct.pack(">BHH", 5, 0, 0xFF00 if i % 2 else 0)) for i in range(2 * burst)]
+    results["writes_allowed"] = sum(1 for a in answers if a[0] == 5)
+    results["writes_rate_limited"] = sum(1 for a in answers if a[:2] == b"\x85\x06")
+    results["unmapped_address"] = client.request(struct.pack(">BHH", 1, 5, 1))[:2] == b"\x81\x02"
+    results["range_past_point"] = client.request(struct.pack(">BHH", 1, 0, 2))[:2] == b"\x81\x02"
+    results["unlisted_function"] = client.request(struct.pack(">BHH", 8, 0, 0))[:2] == b"\x88\x01"
+    client.close()
+    return results
+
+
+@click.command()
+@click.option("--requests", "-n", default=20000, help="Sequential requests for the latency measurement (default: 20000)")
+@click.option("--connections", "-c", default=8, help="Concurrent connections for the throughput measurement (default: 8)")
+@click.option("--duration", "-d", default=5.0, help="Seconds to measure throughput for (default: 5)")
+@click.option("--port", "-p", default=15510, help="Port of the device; the proxy listens on the next one (default: 15510)")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a summary")
+def main(requests, connections, duration, port, as_json):
+    proxy_port = port + 1
+    burst = 5
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as policy:
+        json.dump({"devices": {"pump-controller": {
+            "listen": proxy_port, "upstream": f"127.0.0.1:{port}",
+            "points": [{"name": "pumpOn", "table": "co", "address": 0, "read": ["127.0.0.0/8"],
+                        "write": ["127.0.0.1"], "write_rate": 0.1, "write_burst": burst}],
+        }}}, policy)
+
+    device = subprocess.Popen([sys.executable, str(ROOT / "pump-controller" / "app.py"), "-l", "error",
+                               "debug", "modbus", "-h", "127.0.0.1", "-p", str(port)])
+    proxy = subprocess.Popen([sys.executable, str(ROOT / "modbus-proxy" / "app.py"), "-l", "error",
+                              "run", "-pf", policy.name, "-h", "127.0.0.1"])
+    try:
+        _wait_listening(port)
+        _wait_listening(proxy_port)
+
+        direct = _latencies(port, requests)
+        proxied = _latencies(proxy_port, requests)
+        results = {"latency_us": {}, "requests_per_second": {}}
+        for name, pct in (("p50", 50), ("p90", 90), ("p99", 99), ("p99.9", 99.9)):
+            results["latency_us"][name] = {
+                "direct": _percentile(direct, pct) * 1e6,
+                "proxied": _percentile(proxied, pct) * 1e6,
+                "added": (_percentile(proxied, pct) - _percentile(direct, pct)) * 1e6,
+            }
+        results["latency_us"]["mean_added"] = (statistics.fmean(proxied) - statistics.fmean(direct)) * 1e6
+        results["requests_per_second"]["direct"] = _throughput(port, connections, duration)
+        results["requests_per_second"]["proxied"] = _throughput(proxy_port, connections, duration)
+        results["policy"] = _check_policy(proxy_port, burst)
+    finally:
+        proxy.terminate()
+        device.terminate()
+        proxy.wait()
+        device.wait()
+        Path(policy.name).unlink()
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+    click.echo(f"{'':<8} {'direct us':>10} {'proxied us':>11} {'added us':>9}")
+    for name, row in results["latency_us"].items():
+        if isinstance(row, dict):
+            click.echo(f"{name:<8} {row['direct']:>10.0f} {row['proxied']:>11.0f} {row['added']:>9.0f}")
+    rps = results["requests_per_second"]
+    click.echo(f"throughput with {connections} connection(s): {rps['direct']:.0f} req/s direct, {rps['proxied']:.0f} req/s proxied")
+    click.echo(f"policy: {json.dumps(results['policy'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+benchmark of how long the coordinator takes to recover after a field device
+bounces
+
+the pump controller is run in its debug modbus mode and repeatedly killed and
+restarted while a PollScheduler polls its coil at the control cycle rate, with
+the pool's on_connect expediting a cycle the way the coordinator does.
+recovery is the time from the restarted server accepting connections to the
+first successful read, split into the reconnect (bounded by the pool's
+backoff, capped here at one cycle) and the read after it (the expedited
+cycle, independent of the cycle length); the pool's own down-to-reconnected
+outage time is reported too
+
+usage: python benchmarks/reconnect_recovery.py -b 5 -c 0.1
+"""
+
+import json
+import logging
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "coordinator"))
+
+
+def _start_device(port):
+    return subprocess.Popen([sys.executable, str(ROOT / "pump-controller" / "app.py"), "-l", "error",
+                             "debug", "modbus", "-h", "127.0.0.1", "-p", str(port)])
+
+
+def _wait_listening(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.05).close()
+            return time.monotonic()
+        except OSError:
+            time.sleep(0.001)
+    raise RuntimeError(f"device on port {port} did not come up")
+
+
+@click.command()
+@click.option("--bounces", "-b", default=5, help="How many times to restart the device")
+@click.option("--cycle-period", "-c", default=0.1, help="Seconds between polls, i.e. the control cycle period")
+@click.option("--down-time", "-d", default=1.0, help="Seconds to leave the device down on each bounce")
+@click.option("--port", "-p", default=15502)
+@click.option("--timeout", "-t", default=10.0, help="Seconds to wait for the first successful read after a restart before counting the bounce as failed")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a summary")
+def main(bounces, cycle_period, down_time, port, timeout, as_json):
+    logging.basicConfig(level=logging.CRITICAL)
+    from polling import PollGroup, PollPoint, PollScheduler
+    from pool import ConnectionPool
+
+    device = _start_device(port)
+    _wait_listening(port)
+
+    pool = ConnectionPool(timeout=0.5, max_backoff=cycle_period)
+    client = pool.add("pump", "127.0.0.1", port)
+    pool.start()
+    pool.wait_connected(5.0)
+
+    last_ok = [0.0]
+    connected = [0.0]
+
+    def on_cycle(values):
+        if "pump.coil" in values:
+            last_ok[0] = time.monotonic()
+
+    def on_connect(device):
+        connected[0] = time.monotonic()
+        scheduler.expedite()
+
+    point = PollPoint("pump.coil", "pump", client, "co")
+    scheduler = PollScheduler(cycle_period, [PollGroup("pump", cycle_period, [point])])
+    pool.on_connect = on_connect
+    thread = threading.Thread(target=scheduler.run, args=(on_cycle,), daemon=True)
+    thread.start()
+
+    samples = []
+    try:
+        for _ in range(bounces):
+            device.kill()
+            device.wait()
+            time.sleep(down_time)
+            device = _start_device(port)
+            ready = _wait_listening(port)
+            deadline = ready + timeout
+            while last_ok[0] < ready and time.monotonic() < deadline:
+                time.sleep(0.001)
+            if last_ok[0] < ready:
+                samples.append({"recovered": False, "recovery_ms": None, "reconnect_ms": None,
+                                "first_read_ms": None, "outage_ms": None})
+                continue
+            samples.append({"recovered": True, "recovery_ms": (last_ok[0] - ready) * 1000,
+                            "reconnect_ms": max(0.0, connected[0] - ready) * 1000,
+                            "first_read_ms": max(0.0, last_ok[0] - connected[0]) * 1000,
+                            "outage_ms": (client.last_outage or 0.0) * 1000})
+    finally:
+        scheduler.shutdown()
+        thread.join()
+        pool.close()
+        device.kill()
+        device.wait()
+
+    recovery = [s["recovery_ms"] for s in samples if s["recovered"]]
+    failed = len(samples) - len(recovery)
+    result = {
+        "bounces": bounces,
+        "cycle_period_ms": cycle_period * 1000,
+        "failed": failed,
+        "recovery_ms_median": statistics.median(recovery) if recovery else None,
+        "recovery_ms_max": max(recovery) if recovery else None,
+        "reconnect_ms_max": max((s["reconnect_ms"] for s in samples if s["recovered"]), default=None),
+        "first_read_ms_max": max((s["first_read_ms"] for s in samples if s["recovered"]), default=None),
+        "samples": samples,
+    }
+    if as_json:
+        print(json.dumps(result, indent=2))
+    elif recovery:
+        print(f"recovery after device restart over {len(recovery)} bounce(s): median {result['recovery_ms_median']:.1f} ms, "
+              f"max {result['recovery_ms_max']:.1f} ms (control cycle {cycle_period * 1000:.0f} ms)")
+        print(f"  reconnect after the server is up: max {result['reconnect_ms_max']:.1f} ms "
+              f"(bounded by the pool's {cycle_period * 1000:.0f} ms maximum backoff)")
+        print(f"  first read after the reconnect:   max {result['first_read_ms_max']:.1f} ms "
+              f"(expedited cycle, not the next tick)")
+    if failed:
+        print(f"FAILED: {failed} of {bounces} bounce(s) did not recover within {timeout:g} s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+benchmark of how long the stack takes from a cold start to its first control
+cycle over fresh data
+
+locally (the default), the level sensor, gate and pump servers are started in
+their debug modbus modes together with the coordinator, either all at once or
+with the coordinator held back until every device answers /ready (the way
+compose used to gate it), or with the devices coming up --device-delay seconds
+after the coordinator, like devices that are slow to set up their GPIO or are
+down; with --compose, `docker compose up -d` is run in the
+repository and the published HMI port is watched instead. the milestones, in
+seconds from launch:
+
+  devices_ready  every device answered /ready (local runs only)
+  hmi            the HMI answered its first /update
+  first_cycle    the coordinator completed its first control cycle
+  fresh          a completed cycle has read every point (no stale points)
+
+usage: python benchmarks/startup.py -n 5
+       python benchmarks/startup.py --compose -n 3
+"""
+
+import http.client
+import json
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEVICES = ("level-sensor", "gate-controller", "pump-controller")
+MILESTONES = ("devices_ready", "hmi", "first_cycle", "fresh")
+CYCLES = re.compile(r"^psh_cycle_duration_seconds_count (\d+)", re.MULTILINE)
+
+
+def _get(port, path, timeout=0.5):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def _wait_free(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.05).close()
+        except OSError:
+            return
+        time.sleep(0.05)
+    raise RuntimeError(f"port {port} is still in use")
+
+
+def _watch(launched, hmi_port, device_ports, timeout, poll=0.005):
+    """Poll every milestone until all of them are reached; returns {milestone: seconds or None}."""
+    reached = {}
+    deadline = launched + timeout
+
+    def devices():
+        pending = set(device_ports)
+        while pending and time.monotonic() < deadline:
+            for port in list(pending):
+                try:
+                    if _get(port, "/ready")[0] == 200:
+                        pending.discard(port)
+                except OSError:
+                    pass
+            time.sleep(poll)
+        if not pending:
+            reached["devices_ready"] = time.monotonic() - launched
+
+    def coordinator():
+        while time.monotonic() < deadline and "fresh" not in reached:
+            try:
+                status, body = _get(hmi_port, "/update")
+                now = time.monotonic() - launched
+                if status == 200:
+                    reached.setdefault("hmi", now)
+                    _, metrics = _get(hmi_port, "/metrics")
+                    match = CYCLES.search(metrics.decode())
+                    if match and int(match.group(1)) > 0:
+                        reached.setdefault("first_cycle", now)
+                        if not json.loads(body).get("stale"):
+                            reached["fresh"] = now
+            except (OSError, ValueError):
+                pass
+            time.sleep(poll)
+
+    threads = [threading.Thread(target=coordinator)]
+    if device_ports:
+        threads.append(threading.Thread(target=devices))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {name: reached.get(name) for name in MILESTONES}
+
+
+def _local_run(base_port, gated, cycle_period, timeout, device_delay=0.0):
+    modbus_ports = {name: base_port + i for i, name in enumerate(DEVICES)}
+    ready_ports = {name: base_port + 10 + i for i, name in enumerate(DEVICES)}
+    hmi_port = base_port + 20
+    for port in [*modbus_ports.values(), *ready_ports.values(), hmi_port]:
+        _wait_free(port)
+
+    processes = []
+
+    def start(*args, cwd=ROOT):
+        processes.append(subprocess.Popen([sys.executable, *map(str, args)], cwd=cwd,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    def start_coordinator():
+        start("app.py", "-l", "error", "-ss", "127.0.0.1", "-sp", modbus_ports["level-sensor"],
+              "-gs", "127.0.0.1", "-gp", modbus_ports["gate-controller"],
+              "-ps", "127.0.0.1", "-pp", modbus_ports["pump-controller"],
+              "-hp", hmi_port, "-cp", cycle_period, "-hc", 0, cwd=ROOT / "coordinator")
+
+    def start_devices(delay=0.0):
+        time.sleep(delay)
+        for name in DEVICES:
+            start(ROOT / name / "app.py", "-l", "error", "debug", "modbus", "-h", "127.0.0.1",
+                  "-p", modbus_ports[name], "-mp", ready_ports[name])
+
+    launched = time.monotonic()
+    try:
+        if device_delay and not gated:
+            start_coordinator()
+            devices = threading.Thread(target=start_devices, args=(device_delay,))
+            devices.start()
+            try:
+                return _watch(launched, hmi_port, list(ready_ports.values()), timeout)
+            finally:
+                devices.join()
+        start_devices()
+        if gated:
+            # hold the coordinator back until every device is ready, as depends_on: service_healthy would
+            pending = set(ready_ports.values())
+            while pending and time.monotonic() < launched + timeout:
+                for port in list(pending):
+                    try:
+                        if _get(port, "/ready")[0] == 200:
+                            pending.discard(port)
+                    except OSError:
+                        pass
+                time.sleep(0.005)
+            start_coordinator()
+        else:
+            threading.Thread(target=start_coordinator).start()
+        return _watch(launched, hmi_port, list(ready_ports.values()), timeout)
+    finally:
+        time.sleep(0.1)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def _compose_run(hmi_port, build, timeout):
+    subprocess.run(["docker", "compose", "down"], cwd=ROOT, check=True, capture_output=True)
+    launched = time.monotonic()
+    command = ["docker", "compose", "up", "-d"] + (["--build"] if build else [])
+    up = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return _watch(launched, hmi_port, [], timeout)
+    finally:
+        up.wait()
+        subprocess.run(["docker", "compose", "down"], cwd=ROOT, capture_output=True)
+
+
+@click.command()
+@click.option("--runs", "-n", default=5, help="Cold starts to time (default: 5)")
+@click.option("--gated", is_flag=True, help="Start the coordinator only once every device is ready, instead of all at once")
+@click.option("--device-delay", "-dd", default=0.0, help="Start the devices this many seconds after the coordinator (default: 0, all at once)")
+@click.option("--cycle-period", "-cp", default=1.0, help="Coordinator control cycle period in seconds (default: 1.0)")
+@click.option("--base-port", "-b", default=16300, help="First of the ports used locally: devices, their /ready ports from +10, the HMI at +20 (default: 16300)")
+@click.option("--compose", is_flag=True, help="Time `docker compose up -d` in the repository instead of local processes")
+@click.option("--build", is_flag=True, help="With --compose, pass --build (and time the image builds too)")
+@click.option("--hmi-port", "-hp", default=80, help="With --compose, the published HMI port to watch (default: 80)")
+@click.option("--timeout", "-t", default=60.0, help="Seconds to give one start before giving up on it (default: 60)")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a table")
+def main(runs, gated, device_delay, cycle_period, base_port, compose, build, hmi_port, timeout, as_json):
+    samples = []
+    for _ in range(runs):
+        if compose:
+            samples.append(_compose_run(hmi_port, build, timeout))
+        else:
+            samples.append(_local_run(base_port, gated, cycle_period, timeout, device_delay))
+
+    results = {"runs": samples, "median": {}}
+    for name in MILESTONES:
+        values = [s[name] for s in samples if s[name] is not None]
+        results["median"][name] = statistics.median(values) if values else None
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+    mode = "compose" if compose else ("local, gated" if gated else
+                                      f"local, devices {device_delay} s late" if device_delay else "local, all at once")
+    click.echo(f"{runs} cold start(s), {mode}:")
+    for name in MILESTONES:
+        values = [s[name] for s in samples if s[name] is not None]
+        if not values:
+            click.echo(f"  {name:<14} {'-':>8}")
+            continue
+        click.echo(f"  {name:<14} {statistics.median(values):>7.3f}s median, {min(values):.3f}..{max(values):.3f}s"
+                   f"{'' if len(values) == runs else f' ({runs - len(values)} run(s) never got there)'}")
+
+
+if __name__ == "__main__":
+    main()
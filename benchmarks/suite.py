@@ -0,0 +1,301 @@
+"""
+end-to-end benchmark suite for the coordinator and the field devices
+
+starts the level sensor, gate and pump servers in their debug modbus modes on
+localhost, then the coordinator against them, and measures:
+
+  modbus     requests/sec and latency each device server sustains on its own
+  cycle      control cycle duration and start jitter, from the coordinator's /metrics
+  update     /update throughput and latency under concurrent keep-alive clients
+  actuation  time from POST /manual to the pump coil reading back the new value,
+             and to a POST /manual?wait= response confirming it
+
+results are printed as JSON (or written with --output) so runs can be compared
+between releases
+
+usage: python benchmarks/suite.py -o results.json
+"""
+
+import datetime as dt
+import http.client
+import json
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import click
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEVICES = {
+    # name: (directory, function used to read its point)
+    "sensor": ("level-sensor", "read_discrete_inputs"),
+    "gate": ("gate-controller", "read_coils"),
+    "pump": ("pump-controller", "read_coils"),
+}
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _summary(samples, duration=None):
+    result = {
+        "count": len(samples),
+        "median_ms": statistics.median(samples) * 1000 if samples else None,
+        "p99_ms": _percentile(samples, 99) * 1000 if samples else None,
+        "max_ms": max(samples) * 1000 if samples else None,
+    }
+    if duration is not None:
+        result["per_second"] = len(samples) / duration
+    return result
+
+
+def _wait_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout} s")
+
+
+def _run_concurrently(clients, duration, work):
+    """Run work() in a tight loop on `clients` threads; returns the latencies."""
+    stop = threading.Event()
+    samples = []
+
+    def loop():
+        local = []
+        state = work.setup() if hasattr(work, "setup") else None
+        while not stop.is_set():
+            start = time.perf_counter()
+            work(state)
+            local.append(time.perf_counter() - start)
+        samples.extend(local)
+
+    threads = [threading.Thread(target=loop) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return samples
+
+
+class ModbusReads:
+    def __init__(self, port, function):
+        self.port = port
+        self.function = function
+
+    def setup(self):
+        from pymodbus.client import ModbusTcpClient
+        client = ModbusTcpClient("127.0.0.1", port=self.port)
+        client.connect()
+        return client
+
+    def __call__(self, client):
+        getattr(client, self.function)(0x00)
+
+
+class UpdateGets:
+    def __init__(self, port):
+        self.port = port
+
+    def setup(self):
+        return http.client.HTTPConnection("127.0.0.1", self.port)
+
+    def __call__(self, conn):
+        conn.request("GET", "/update")
+        conn.getresponse().read()
+
+
+def _scrape(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("GET", "/metrics")
+    text = conn.getresponse().read().decode()
+    conn.close()
+    return text
+
+
+def _histogram(text, name):
+    """Mean and bucket-interpolated quantiles of an unlabelled histogram."""
+    buckets = [(float("inf") if le == "+Inf" else float(le), float(v))
+               for le, v in re.findall(rf'^{name}_bucket{{le="([^"]+)"}} (\S+)$', text, re.M)]
+    total = float(re.search(rf"^{name}_sum (\S+)$", text, re.M).group(1))
+    count = float(re.search(rf"^{name}_count (\S+)$", text, re.M).group(1))
+
+    def quantile(q):
+        target = q * count
+        lower_bound, lower_count = 0.0, 0.0
+        for bound, cumulative in buckets:
+            if cumulative >= target:
+                if bound == float("inf"):
+                    return lower_bound
+                share = (target - lower_count) / max(cumulative - lower_count, 1)
+                return lower_bound + (bound - lower_bound) * share
+            lower_bound, lower_count = bound, cumulative
+        return lower_bound
+
+    return {
+        "count": int(count),
+        "mean_ms": total / count * 1000 if count else None,
+        "p50_ms": quantile(0.5) * 1000 if count else None,
+        "p99_ms": quantile(0.99) * 1000 if count else None,
+    }
+
+
+def _read_pump(client):
+    return 1 if client.read_coils(0x00).bits[0] else 0
+
+
+def _post(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", path)
+    conn.getresponse().read()
+    conn.close()
+
+
+def _post_json(port, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", path)
+    body = json.loads(conn.getresponse().read())
+    conn.close()
+    return body
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option("--base-port", "-b", default=16020, help="First of the ports used for the device servers and the HMI")
+@click.option("--clients", "-c", default=8, help="Concurrent clients for the throughput measurements")
+@click.option("--duration", "-d", default=5.0, help="Seconds to run each throughput measurement")
+@click.option("--cycle-period", "-cp", default=0.1, help="Coordinator control cycle period in seconds")
+@click.option("--cycle-window", "-cw", default=10.0, help="Seconds of control cycles to sample")
+@click.option("--actuations", "-a", default=20, help="Manual pump toggles to time")
+@click.option("--output", "-o", default=None, type=click.Path(dir_okay=False, writable=True), help="Write the JSON results here instead of stdout")
+def main(base_port, clients, duration, cycle_period, cycle_window, actuations, output):
+    ports = {name: base_port + i for i, name in enumerate(DEVICES)}
+    hmi_port = base_port + len(DEVICES)
+    processes = []
+    results = {
+        "meta": {
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "parameters": {"clients": clients, "duration": duration, "cycle_period": cycle_period,
+                           "cycle_window": cycle_window, "actuations": actuations},
+        },
+    }
+
+    def start(*args):
+        processes.append(subprocess.Popen([sys.executable, *map(str, args)], cwd=ROOT,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    try:
+        for name, (directory, _) in DEVICES.items():
+            start(ROOT / directory / "app.py", "-l", "error", "debug", "modbus", "-h", "127.0.0.1", "-p", ports[name])
+        for port in ports.values():
+            _wait_port(port)
+
+        # device servers on their own, before the coordinator adds its polling
+        results["modbus"] = {}
+        for name, (_, function) in DEVICES.items():
+            samples = _run_concurrently(clients, duration, ModbusReads(ports[name], function))
+            results["modbus"][name] = _summary(samples, duration)
+            click.echo(f"modbus {name}: {results['modbus'][name]['per_second']:.0f} req/s", err=True)
+
+        start(ROOT / "coordinator" / "app.py", "-l", "error",
+              "-ss", "127.0.0.1", "-sp", ports["sensor"], "-gs", "127.0.0.1", "-gp", ports["gate"],
+              "-ps", "127.0.0.1", "-pp", ports["pump"], "-ha", "127.0.0.1", "-hp", hmi_port,
+              "-cp", cycle_period, "-lp", cycle_period, "-op", cycle_period)
+        _wait_port(hmi_port)
+
+        # control cycle timing over the first window of cycles
+        time.sleep(cycle_window)
+        metrics = _scrape(hmi_port)
+        results["cycle"] = {
+            "period_ms": cycle_period * 1000,
+            "duration": _histogram(metrics, "psh_cycle_duration_seconds"),
+            "jitter": _histogram(metrics, "psh_cycle_jitter_seconds"),
+            "overruns": int(float(re.search(r"^psh_cycle_overruns_total (\S+)$", metrics, re.M).group(1))),
+        }
+        click.echo(f"cycle: {results['cycle']['duration']['mean_ms']:.2f} ms mean", err=True)
+
+        samples = _run_concurrently(clients, duration, UpdateGets(hmi_port))
+        results["update"] = _summary(samples, duration)
+        click.echo(f"update: {results['update']['per_second']:.0f} req/s", err=True)
+
+        # toggle the pump in manual mode and watch the coil on the device itself
+        from pymodbus.client import ModbusTcpClient
+        pump = ModbusTcpClient("127.0.0.1", port=ports["pump"])
+        pump.connect()
+        _post(hmi_port, "/manual?m=1")
+        samples = []
+        timeouts = 0
+        for _ in range(actuations):
+            target = 1 - _read_pump(pump)
+            start_time = time.perf_counter()
+            _post(hmi_port, f"/manual?p={target}")
+            while _read_pump(pump) != target:
+                if time.perf_counter() - start_time > 10 * cycle_period + 5:
+                    timeouts += 1
+                    break
+                time.sleep(0.0005)
+            else:
+                samples.append(time.perf_counter() - start_time)
+        results["actuation"] = _summary(samples)
+        results["actuation"]["timeouts"] = timeouts
+        results["actuation"]["under_100ms"] = sum(1 for s in samples if s < 0.1) / len(samples) if samples else None
+        click.echo(f"actuation: {results['actuation']['median_ms']:.1f} ms median", err=True)
+
+        # the same toggles, with the response held until the coordinator confirms the coil
+        samples = []
+        unconfirmed = 0
+        for _ in range(actuations):
+            target = 1 - _read_pump(pump)
+            start_time = time.perf_counter()
+            body = _post_json(hmi_port, f"/manual?p={target}&wait=5")
+            elapsed = time.perf_counter() - start_time
+            if body["commands"]["pump"]["status"] != "confirmed" or _read_pump(pump) != target:
+                unconfirmed += 1
+            else:
+                samples.append(elapsed)
+        _post(hmi_port, "/manual?m=0")
+        pump.close()
+        results["actuation_confirmed"] = _summary(samples)
+        results["actuation_confirmed"]["unconfirmed"] = unconfirmed
+        results["actuation_confirmed"]["under_100ms"] = sum(1 for s in samples if s < 0.1) / len(samples) if samples else None
+        click.echo(f"confirmed actuation: {results['actuation_confirmed']['median_ms']:.1f} ms median", err=True)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    text = json.dumps(results, indent=2)
+    if output is None:
+        click.echo(text)
+    else:
+        Path(output).write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+load test of the HMI /update endpoint
+
+a coordinator HMI server (no control loop, one plant with a published
+snapshot) is started in a helper process and hammered by concurrent
+keep-alive clients in three modes:
+
+  legacy    the old behaviour: the state dict is rebuilt and serialized per request
+  snapshot  /update serving the pre-serialized snapshot
+  etag      /update with If-None-Match, answered with 304 Not Modified
+
+usage: python benchmarks/update_load.py -c 16 -d 5
+"""
+
+import http.client
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "coordinator"))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--port", "-p", default=18080)
+@click.option("--hmi-server", "-s", default="waitress")
+def serve(port, hmi_server):
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    import app
+    from plants import Plant
+
+    plant = Plant("default", ("127.0.0.1", 1), ("127.0.0.1", 1), ("127.0.0.1", 1))
+    app.plants.append(plant)
+    plant.broadcaster.publish(app.plant_state(plant))
+
+    @app.app.route("/update-legacy")
+    def update_legacy():
+        return app.plant_state(app.get_plant())
+
+    app.serve_hmi(app.app, "127.0.0.1", port, hmi_server)
+
+
+def _client(port, path, headers, stop, samples, errors):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except OSError:
+            errors.append(1)
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            continue
+        samples.append(time.perf_counter() - start)
+    conn.close()
+
+
+def _etag(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("GET", "/update")
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.getheader("ETag")
+
+
+@cli.command()
+@click.option("--clients", "-c", default=16, help="Concurrent keep-alive clients")
+@click.option("--duration", "-d", default=5.0, help="Seconds to run each mode")
+@click.option("--port", "-p", default=18080)
+@click.option("--hmi-server", "-s", default="waitress", help="HMI server to test (waitress or development)")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON instead of a table")
+def run(clients, duration, port, hmi_server, as_json):
+    server = subprocess.Popen([sys.executable, __file__, "serve", "-p", str(port), "-s", hmi_server])
+    try:
+        time.sleep(2.0)
+        etag = _etag(port)
+        modes = [
+            ("legacy", "/update-legacy", {}),
+            ("snapshot", "/update", {}),
+            ("etag", "/update", {"If-None-Match": etag}),
+        ]
+        results = []
+        for name, path, headers in modes:
+            stop = threading.Event()
+            samples, errors = [], []
+            threads = [threading.Thread(target=_client, args=(port, path, headers, stop, samples, errors))
+                       for _ in range(clients)]
+            for t in threads:
+                t.start()
+            time.sleep(duration)
+            stop.set()
+            for t in threads:
+                t.join()
+            results.append({
+                "mode": name,
+                "clients": clients,
+                "requests": len(samples),
+                "errors": len(errors),
+                "rps": len(samples) / duration,
+                "median_ms": statistics.median(samples) * 1000,
+                "p99_ms": _percentile(samples, 99) * 1000,
+            })
+    finally:
+        server.terminate()
+        server.wait()
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'mode':>9} {'req/s':>9} {'median ms':>10} {'p99 ms':>8} {'errors':>7}")
+    for r in results:
+        print(f"{r['mode']:>9} {r['rps']:>9.0f} {r['median_ms']:>10.2f} {r['p99_ms']:>8.2f} {r['errors']:>7}")
+
+
+if __name__ == "__main__":
+    cli()
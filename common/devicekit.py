@@ -0,0 +1,323 @@
+"""
+shared plumbing of the device servers and the modbus proxy: the logging
+pipeline, the metrics/readiness endpoint, readiness checks and the plant
+simulator client
+
+each image copies this file next to its app.py (see the Dockerfiles); run from
+a checkout, the apps find it here in common/
+"""
+
+import atexit
+import bisect
+import json
+import logging
+import logging.handlers
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# logging goes through a bounded queue to a writer thread so requests never
+# wait on stdout; repetitive lines are rate-limited per call site and state
+# changes are logged as structured events
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=5.0, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, "event", None) is not None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault((record.pathname, record.lineno), [self.burst, now, 0])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # formatting happens on the writer thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class LogFormatter(logging.Formatter):
+    def __init__(self, fmt="text"):
+        super().__init__(logging.BASIC_FORMAT)
+        self.json = fmt == "json"
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        suppressed = getattr(record, "suppressed", 0)
+        if not self.json:
+            text = super().format(record)
+            if fields:
+                text += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+            return text + (f" ({suppressed} similar message(s) suppressed)" if suppressed else "")
+        entry = {"ts": record.created, "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if getattr(record, "event", None) is not None:
+            entry["event"] = record.event
+            entry.update(fields)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def log_event(event, message, level=logging.INFO, **fields):
+    logging.log(level, message, extra={"event": event, "fields": fields})
+
+
+def setup_logging(level, fmt="text", rate=5.0):
+    records = queue.Queue(10000)
+    handler = NonBlockingQueueHandler(records)
+    if rate > 0:
+        handler.addFilter(RateLimitFilter(rate))
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(LogFormatter(fmt))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+
+# metrics in prometheus text format; a family is rendered from (labels, value)
+# samples, labels being a dict
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def counter(name, documentation, samples):
+    # samples are exposed as <name>_total, so the HELP and TYPE lines name that too
+    lines = [f"# HELP {name}_total {documentation}", f"# TYPE {name}_total counter"]
+    lines += [f"{name}_total{_labels(labels)} {value}" for labels, value in samples]
+    return lines
+
+
+def gauge(name, documentation, samples):
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{_labels(labels)} {value}" for labels, value in samples]
+    return lines
+
+
+def render(*families):
+    return ("\n".join(line for family in families for line in family) + "\n").encode()
+
+
+class RequestMetrics:
+    """
+    Modbus requests a device answered, counted by function ("read" or
+    "write") and any extra labels, and the time spent answering them as a
+    histogram per function.
+    """
+
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+    def __init__(self, labelnames=()):
+        self.labelnames = tuple(labelnames)
+        # without labels both functions are always exported, even before a request
+        self._requests = {} if self.labelnames else {("read",): 0, ("write",): 0}
+        self._seconds = {function: [0] * (len(self.BUCKETS) + 1) for function in ("read", "write")}
+        self._seconds_sum = {"read": 0.0, "write": 0.0}
+        self._lock = threading.Lock()
+
+    def observe(self, function, seconds, *labels):
+        with self._lock:
+            key = labels + (function,)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._seconds[function][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self._seconds_sum[function] += seconds
+
+    def render(self, duration_documentation):
+        with self._lock:
+            requests = sorted(self._requests.items())
+            seconds = {function: list(counts) for function, counts in self._seconds.items()}
+            seconds_sum = dict(self._seconds_sum)
+        lines = counter("psh_device_requests", "Modbus requests answered by this device",
+                        [(dict(zip(self.labelnames + ("function",), key)), count) for key, count in requests])
+        lines += [
+            f"# HELP psh_device_request_duration_seconds {duration_documentation}",
+            "# TYPE psh_device_request_duration_seconds histogram",
+        ]
+        for function, counts in seconds.items():
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'psh_device_request_duration_seconds_bucket{{function="{function}",le="{le}"}} {cumulative}')
+            lines.append(f'psh_device_request_duration_seconds_sum{{function="{function}"}} {seconds_sum[function]}')
+            lines.append(f'psh_device_request_duration_seconds_count{{function="{function}"}} {cumulative}')
+        return lines
+
+
+def start_metrics_server(host, port, render_metrics, readiness_problems=None):
+    """
+    Serve render_metrics() at /metrics and, if given, readiness_problems()
+    at /ready (200 when it returns no problems, 503 with them otherwise).
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/ready" and readiness_problems is not None:
+                problems = readiness_problems()
+                body = (json.dumps({"ready": not problems, "problems": problems}) + "\n").encode()
+                self.send_response(503 if problems else 200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    logging.info(f"serving metrics at {host}:{port}/metrics"
+                 f"{' and readiness at /ready' if readiness_problems is not None else ''}")
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# readiness checks; each returns a problem description, or None when all is well
+def check_modbus(host, port, unit=0, function=1, address=0, timeout=0.5):
+    # read one point from our own server, the way a client would
+    host = "127.0.0.1" if host in ("", "0.0.0.0") else host
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(struct.pack(">HHHBBHH", 1, 0, 6, unit, function, address, 1))
+            response = b""
+            while len(response) < 9:
+                chunk = sock.recv(256)
+                if not chunk:
+                    raise OSError("connection closed")
+                response += chunk
+    except OSError as e:
+        return str(e)
+    if response[7] != function:
+        return f"exception response {response[7:9].hex()}"
+    return None
+
+
+def check_gpio(gpio, pin, output):
+    try:
+        if gpio.gpio_function(pin) != (gpio.OUT if output else gpio.IN):
+            return f"pin {pin} is not set up as an {'output' if output else 'input'}"
+    except Exception as e:
+        return f"pin {pin}: {e}"
+    return None
+
+
+def check_plant_sim(plant_sim):
+    try:
+        plant_sim.request("get")
+    except (OSError, ValueError) as e:
+        return str(e)
+    return None
+
+
+class SimulatedPlant:
+    """
+    Client for the shared plant simulator (plant-simulator/app.py). Each
+    request carries a sequence number that the reply echoes, so a reply that
+    arrives after its request timed out is dropped instead of being taken for
+    the answer to the next one.
+    """
+
+    def __init__(self, address, timeout=0.2):
+        host, _, port = address.partition(":")
+        self._address = (host, int(port) if port else 5020)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._snapshot = None
+        self._outbox = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def request(self, message):
+        with self._lock:
+            self._seq = (self._seq + 1) & 0xFFFFFFFF
+            seq = self._seq
+            self._sock.sendto(f"{seq} {message}".encode(), self._address)
+            deadline = time.monotonic() + self._timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("timed out")
+                self._sock.settimeout(remaining)
+                reply = json.loads(self._sock.recv(512))
+                if reply.get("seq") == seq:
+                    break
+        if "error" not in reply:
+            self._snapshot = reply
+        return reply
+
+    def send(self, message):
+        """
+        Queue message for a background thread to send, for callers that must
+        not wait on the simulator (Modbus writes run on the server's event
+        loop). Never blocks or raises; a send that fails is logged.
+        """
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="plant-sim-writer", daemon=True)
+                self._writer.start()
+        self._outbox.put(message)
+
+    def _write(self):
+        while True:
+            message = self._outbox.get()
+            try:
+                self.request(message)
+            except (OSError, ValueError) as e:
+                logging.warning(f"could not send {message!r} to the plant simulator: {e}")
+
+    def start_polling(self, period=0.05):
+        """Keep fetching the plant snapshot in the background, for snapshot() to answer from."""
+        threading.Thread(target=self._poll, args=(period,), name="plant-sim", daemon=True).start()
+
+    def _poll(self, period):
+        while True:
+            try:
+                self.request("get")
+            except (OSError, ValueError) as e:
+                logging.warning(f"could not read the plant simulator: {e}")
+            time.sleep(period)
+
+    def snapshot(self):
+        """The latest plant snapshot received, without waiting on the network."""
+        if self._snapshot is None:
+            raise ConnectionError("no snapshot from the plant simulator yet")
+        return self._snapshot
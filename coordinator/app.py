@@ -1,116 +1,238 @@
 import logging
 import threading
+import time
 import datetime as dt
 from pathlib import Path
 
 import click
-from flask import Flask, send_from_directory, request
-from pymodbus.client import ModbusTcpClient
+from flask import Flask, Response, abort, send_from_directory, request
 from pymodbus.exceptions import ModbusException
-from pymodbus.pdu import ExceptionResponse
+
+import journal
+import policy
+from historian import Historian
+from logs import log_event, setup_logging
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram
+from plants import DEVICE_ROLES, Plant, load_device_map
+from polling import PollGroup, PollPoint, PollScheduler
+from pool import ConnectionPool
+from schedule import Schedule
+from serving import StaticBundleMiddleware, etag_matches, serve_hmi
+from simulation import SimulatedDaylight
+from standby import Replicator
+from state import (ANY_STALE, DAY, GATE_OPEN, LEVEL_HIGH, MANUAL, PUMP_ON, SIGNALS, STALE, TARGET_GATE_OPEN,
+                   TARGET_PUMP_ON, enter_manual, stale_signals)
 
 
 app = Flask("coordinator")
 HMI_ROOT = '/opt/csci498/hmi'
+MAX_HISTORY_POINTS = 10000
+MAX_MANUAL_WAIT = 10.0
 
+HMI_REQUESTS = Counter("psh_hmi_requests", "HMI API requests handled by flask", ["endpoint", "status"])
+MODE_SWITCHES = Counter("psh_mode_switches", "Switches between manual and automatic control", ["plant", "mode"])
+HMI_STREAMS = Gauge("psh_hmi_streams", "Open /stream subscribers, each holding an HMI worker thread")
+FIRST_CYCLE = Gauge("psh_first_cycle_seconds", "Seconds from coordinator start to the end of its first control cycle")
+ACTUATION_DURATION = Histogram("psh_actuation_duration_seconds", "Time to run the control logic and relay writes of every plant")
 
-# thread-safe variables for state sharing
-manualControlEvent = threading.Event()
-isDayEvent = threading.Event()
-waterLevelHighEvent = threading.Event()
-gateOpenEvent = threading.Event()
-pumpOnEvent = threading.Event()
 
-manualTargetGateOpenEvent = threading.Event()
-manualTargetPumpOnEvent = threading.Event()
+# /stream subscribers allowed at once, so they never take every HMI worker thread; set by main()
+stream_slots = threading.BoundedSemaphore(16)
 
+# plants managed by this coordinator, filled in by main() before any thread starts
+plants = []
 
-@app.route("/update")
-def flask_update():
-    # get management style
-    if manualControlEvent.is_set():
-        manualControl = 1
-    else:
-        manualControl = 0
+# calendar that decides day and night (and the tariff in force), set by main()
+schedule = None
 
-    # get time of day
-    if isDayEvent.is_set():
-        timeOfDay = 1
-    else:
-        timeOfDay = 0
+# source of day/night other than the wall clock (a plant simulator), set by main()
+daylight = None
 
-    # get water level state
-    if waterLevelHighEvent.is_set():
-        waterLevelHigh = 1
-    else:
-        waterLevelHigh = 0
+# decision table of the automatic control logic, set by main()
+control_policy = policy.DEFAULT_POLICY
 
-    # get gate state
-    if gateOpenEvent.is_set():
-        gateOpen = 1
-    else:
-        gateOpen = 0
+# durable record of control inputs, commands and coil writes, set by main() if enabled
+event_journal = None
 
-    # get pump state
-    if pumpOnEvent.is_set():
-        pumpOn = 1
-    else:
-        pumpOn = 0
+# pairing with a hot standby (or an active) coordinator on this host, set by main() if enabled
+replicator = None
+
+# wall clock time the coordinator started and finished its first control cycle
+started_at = time.time()
+first_cycle_at = None
 
+
+def get_plant():
+    # requests without a plant argument address the first plant in the device map
+    name = request.args.get('plant')
+    if name is None:
+        return plants[0]
+    for plant in plants:
+        if plant.name == name:
+            return plant
+    abort(404, f"unknown plant {name!r}")
+
+
+@app.after_request
+def count_request(response):
+    HMI_REQUESTS.labels(request.endpoint or "unknown", str(response.status_code)).inc()
+    return response
+
+
+@app.route("/metrics")
+def flask_metrics():
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+
+def plant_state(plant):
+    # one snapshot, so every field comes from the same moment
+    bits = plant.state.snapshot.bits
     return {
-        "manualControl": manualControl,
-        "timeOfDay": timeOfDay,
-        "waterLevelHigh": waterLevelHigh,
-        "gateOpen": gateOpen,
-        "pumpOn": pumpOn
+        "manualControl": 1 if bits & MANUAL else 0,
+        "timeOfDay": 1 if bits & DAY else 0,
+        "waterLevelHigh": 1 if bits & LEVEL_HIGH else 0,
+        "gateOpen": 1 if bits & GATE_OPEN else 0,
+        "pumpOn": 1 if bits & PUMP_ON else 0,
+        "stale": stale_signals(bits)
     }
 
 
+@app.route("/ready")
+def flask_ready():
+    # ready once a control cycle has completed and every point of every plant is fresh
+    problems = []
+    if first_cycle_at is None:
+        problems.append("no control cycle has completed yet")
+    if replicator is not None and not replicator.active:
+        problems.append("standby: another coordinator drives the plant")
+    for plant in plants:
+        stale = stale_signals(plant.state.snapshot.bits)
+        if stale:
+            problems.append(f"{plant.name}: {', '.join(stale)} stale")
+    return {"ready": not problems, "problems": problems}, 503 if problems else 200
+
+
+@app.route("/update")
+def flask_update():
+    # serve the snapshot the control loop last published; unchanged -> 304
+    etag, body = get_plant().broadcaster.snapshot()
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        # serve_hmi keeps the connection open after a 304, so a poll that finds nothing new costs one round trip
+        return Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return Response(body, mimetype="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+@app.route("/stream")
+def flask_stream():
+    # push a snapshot and then only the fields that changed, as server-sent events;
+    # a stream holds a worker thread for as long as it is open, so past the cap
+    # clients are turned away and fall back to polling /update
+    plant = get_plant()
+    if not stream_slots.acquire(blocking=False):
+        return Response("too many open streams, poll /update instead", status=503, headers={"Retry-After": "30"})
+    HMI_STREAMS.inc()
+
+    def release():
+        HMI_STREAMS.inc(-1)
+        stream_slots.release()
+
+    response = Response(plant.broadcaster.subscribe(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(release)
+    return response
+
+
+@app.route("/history")
+def flask_history():
+    # downsampled series between from and to (unix seconds), step seconds per point
+    plant = get_plant()
+    if plant.historian is None:
+        abort(404, "history is not being recorded")
+    try:
+        end_time = float(request.args.get('to', time.time()))
+        start_time = float(request.args.get('from', end_time - 3600))
+        step = float(request.args.get('step', max(1.0, (end_time - start_time) / 500)))
+    except ValueError:
+        abort(400, "from, to and step must be numbers")
+    if end_time <= start_time or step <= 0 or (end_time - start_time) / step > MAX_HISTORY_POINTS:
+        abort(400, f"need from < to and at most {MAX_HISTORY_POINTS} points")
+    return {"from": start_time, "to": end_time, "step": step,
+            "series": plant.historian.query(start_time, end_time, step)}
+
+
 @app.route("/manual", methods=['POST'])
 def flask_manual():
+    plant = get_plant()
+    if replicator is not None and not replicator.active:
+        abort(503, "this coordinator is the standby; send commands to the active one")
+    wait = request.args.get('wait')
+    if wait is not None:
+        try:
+            wait = min(float(wait), MAX_MANUAL_WAIT)
+        except ValueError:
+            abort(400, "wait must be a number of seconds")
 
     # update mode if provided
     new_mode = request.args.get('m')
     if new_mode == '1':
-        logging.warning("changing to manual control mode")
-        manualControlEvent.set()
+        if not plant.state.is_set(MANUAL):
+            log_event("mode", f"[{plant.name}] changing to manual control mode", logging.WARNING,
+                      plant=plant.name, mode="manual")
+            MODE_SWITCHES.labels(plant.name, "manual").inc()
+            journal_append(plant, journal.MANUAL, journal.MANUAL_MODE, 1)
+            plant.commands.discard()
 
         # sync current state w/ target state to avoid leftovers of previous manual control targets
-        if gateOpenEvent.is_set():
-            manualTargetGateOpenEvent.set()
-        else:
-            manualTargetGateOpenEvent.clear()
-        
-        if pumpOnEvent.is_set():
-            manualTargetPumpOnEvent.set()
-        else:
-            manualTargetPumpOnEvent.clear()
+        plant.state.apply(enter_manual)
 
     elif new_mode == '0':
-        logging.info("changing to automatic control mode")
-        manualControlEvent.clear()
+        if plant.state.is_set(MANUAL):
+            log_event("mode", f"[{plant.name}] changing to automatic control mode", plant=plant.name, mode="automatic")
+            MODE_SWITCHES.labels(plant.name, "automatic").inc()
+            journal_append(plant, journal.MANUAL, journal.MANUAL_MODE, 0)
+            plant.commands.discard()
+        plant.state.put(MANUAL, 0)
 
-    if manualControlEvent.is_set():
+    # gate and pump commands go through the plant's command queue, which wakes the control loop
+    submitted = {}
+    if plant.state.is_set(MANUAL):
 
         # update gate status if provided
         new_gate_state = request.args.get('g')
         if new_gate_state == '1':
-            logging.info("received manual mode request to open gate")
-            manualTargetGateOpenEvent.set()
+            logging.info(f"[{plant.name}] received manual mode request to open gate")
+            submitted["gate"] = (plant.commands.submit("gate", 1), 1)
         elif new_gate_state == '0':
-            logging.info("received manual mode request to close gate")
-            manualTargetGateOpenEvent.clear()
+            logging.info(f"[{plant.name}] received manual mode request to close gate")
+            submitted["gate"] = (plant.commands.submit("gate", 0), 0)
 
         # update pump status if provided
         new_pump_state = request.args.get('p')
         if new_pump_state == '1':
-            logging.info("received manual mode request to start pump")
-            manualTargetPumpOnEvent.set()
+            logging.info(f"[{plant.name}] received manual mode request to start pump")
+            submitted["pump"] = (plant.commands.submit("pump", 1), 1)
         elif new_pump_state == '0':
-            logging.info("received manual mode request to stop pump")
-            manualTargetPumpOnEvent.clear()
+            logging.info(f"[{plant.name}] received manual mode request to stop pump")
+            submitted["pump"] = (plant.commands.submit("pump", 0), 0)
+
+    plant.broadcaster.publish(plant_state(plant))
+    if wait is None:
+        return ('', 204)
+
+    # hold the response until the device confirms each command (or the wait runs out)
+    commands = {}
+    for actuator, (seq, value) in submitted.items():
+        status, latency = plant.commands.wait(actuator, seq, wait)
+        commands[actuator] = {"seq": seq, "value": value, "status": status,
+                              "latencyMs": latency * 1000 if latency is not None else None}
+    state = plant_state(plant)
+    return {"commands": commands, "gateOpen": state["gateOpen"], "pumpOn": state["pumpOn"],
+            "manualControl": state["manualControl"]}
 
-    return ('', 204)
+
+@app.route("/plants")
+def flask_plants():
+    return {"plants": [p.name for p in plants]}
 
 
 @app.route("/")
@@ -129,222 +251,347 @@ def flask_react_css(build_file="index.html"):
     return send_from_directory(Path(HMI_ROOT)/"static/css", build_file)
 
 
-def setup(sensor_server, sensor_server_port, gate_server, gate_server_port, pump_server, pump_server_port):
+def setup(plants, pool):
     logging.debug("setting up modbus relay server clients")
-    sensor_client = ModbusTcpClient(sensor_server, port=sensor_server_port)
-    gate_client = ModbusTcpClient(gate_server, port=gate_server_port)
-    pump_client = ModbusTcpClient(pump_server, port=pump_server_port)
-
-    sensor_client.connect()
-    gate_client.connect()
-    pump_client.connect()
+    for plant in plants:
+        plant.connect(pool)
 
-    return [sensor_client, gate_client, pump_client]
+    # every device is connected at once in the background; the first request
+    # to a device waits for its own connection attempt only, and devices that
+    # are not up yet stay stale until the pool reaches them
+    pool.start()
 
 
-def teardown(clients):
+def teardown(plants, pool):
     logging.debug("cleaning up modbus relay server clients")
-    clients[1].write_coil(0x00, 0)
-    clients[2].write_coil(0x00, 0)
-    for c in clients:
-        c.close()
-
-
-def set_pump(state_on, clients):
-    if state_on is True and not pumpOnEvent.is_set():
-        clients[2].write_coil(0x00, 1)
-        pumpOnEvent.set()
-    elif state_on is False and pumpOnEvent.is_set():
-        clients[2].write_coil(0x00, 0)
-        pumpOnEvent.clear()
-
-
-def set_gate(state_open, clients):
-    if state_open is True and not gateOpenEvent.is_set():
-        clients[1].write_coil(0x00, 1)
-        gateOpenEvent.set()
-    elif state_open is False and gateOpenEvent.is_set():
-        clients[1].write_coil(0x00, 0)
-        gateOpenEvent.clear()
-
-
-def automatic_control_logic(is_day, water_level_high, previous_action, clients):
-    if is_day:
-        # open gate, stop pump
-        if previous_action == 1:
-            logging.debug("(DAY, ___) --> opening gate, stopping pump")
-        else:
-            logging.info("(DAY, ___) --> opening gate, stopping pump")
-
-        # manipulate relays
-        set_gate(True, clients)
-        set_pump(False, clients)
-
-        return 1
-
-    elif not is_day and not water_level_high:
-        # close gate, run pump
-        if previous_action == 2:
-            logging.debug("(NIGHT, LOW) --> closing gate, starting pump")
-        else:
-            logging.info("(NIGHT, LOW) --> closing gate, starting pump")
-
-        # manipulate relays
-        set_gate(False, clients)
-        set_pump(True, clients)
-
-        return 2
-
-    else: #(not day and water level is high)
-        # close gate, stop pump
-        if previous_action == 3:
-            logging.debug("(NIGHT, HIGH) --> closing gate, stopping pump")
-        else:
-            logging.info("(NIGHT, HIGH) --> closing gate, stopping pump")
-
-        # manipulate relays
-        set_gate(False, clients)
-        set_pump(False, clients)
-
-        return 3
-
-
-def manual_control_logic(clients):
-    if manualTargetGateOpenEvent.is_set():
-        set_gate(True, clients)
-    else:
-        set_gate(False, clients)
-
-    if manualTargetPumpOnEvent.is_set():
-        set_pump(True, clients)
+    if replicator is not None and not replicator.release():
+        # the standby drives the plant from here (or this coordinator never did)
+        pool.close()
+        return
+    for plant in plants:
+        for role in ("gate", "pump"):
+            try:
+                plant.clients[role].write_coil(0x00, 0)
+            except ModbusException as e:
+                logging.error(f"could not switch off {plant.device_name(role)}: {e}")
+    pool.close()
+
+
+def journal_append(plant, kind, a=0, b=0, c=0):
+    if event_journal is not None:
+        event_journal.append(plant.name, kind, a, b, c)
+
+
+def write_relay(plant, role, signal, flag, value):
+    # only an acknowledged write updates the coordinator's view of the coil
+    response = plant.clients[role].write_coil(0x00, value)
+    if response.isError():
+        raise ModbusException(f"{plant.device_name(role)} did not acknowledge the write: {response}")
+    plant.state.put(flag, value)
+    plant.coils.acknowledge(signal, value)
+    journal_append(plant, journal.COIL, journal.COIL_GATE if role == "gate" else journal.COIL_PUMP, value)
+    log_event("relay", f"[{plant.name}] {signal} set to {value}", plant=plant.name, device=plant.device_name(role),
+              signal=signal, value=value)
+
+
+def set_pump(state_on, plant):
+    if state_on is True and not plant.state.is_set(PUMP_ON):
+        write_relay(plant, "pump", "pumpOn", PUMP_ON, 1)
+    elif state_on is False and plant.state.is_set(PUMP_ON):
+        write_relay(plant, "pump", "pumpOn", PUMP_ON, 0)
+
+
+def set_gate(state_open, plant):
+    if state_open is True and not plant.state.is_set(GATE_OPEN):
+        write_relay(plant, "gate", "gateOpen", GATE_OPEN, 1)
+    elif state_open is False and plant.state.is_set(GATE_OPEN):
+        write_relay(plant, "gate", "gateOpen", GATE_OPEN, 0)
+
+
+def automatic_control_logic(is_day, water_level_high, previous_action, plant):
+    # the decision itself is a lookup in the policy table; see policy.py
+    situation = policy.situation(is_day, water_level_high)
+    action = control_policy[situation]
+    if previous_action == action:
+        logging.debug("[%s] %s --> %s", plant.name, policy.SITUATIONS[situation], policy.DESCRIPTIONS[action])
     else:
-        set_pump(False, clients)
-
-
-def update_thread_variables(clients):
-    # for now make every even minute represent daytime and every odd minute represent nighttime
-    if dt.datetime.now().minute % 2 == 0:
-        isDayEvent.set()
+        log_event("action", f"[{plant.name}] {policy.SITUATIONS[situation]} --> {policy.DESCRIPTIONS[action]}",
+                  plant=plant.name, action=action, previous=previous_action)
+
+    # manipulate relays
+    gate_open, pump_on = policy.OUTPUTS[action]
+    set_gate(bool(gate_open), plant)
+    set_pump(bool(pump_on), plant)
+
+    return action
+
+
+def manual_control_logic(plant):
+    # only the control loop moves the targets, to the newest command of each actuator
+    targets = {"gate": TARGET_GATE_OPEN, "pump": TARGET_PUMP_ON}
+    mask = bits = 0
+    for actuator, value in plant.commands.take().items():
+        # journalled as applied, so a replay sees the same coalesced commands
+        journal_append(plant, journal.MANUAL, journal.MANUAL_GATE if actuator == "gate" else journal.MANUAL_PUMP, value)
+        mask |= targets[actuator]
+        bits |= targets[actuator] if value else 0
+    target = plant.state.update(mask, bits).bits
+
+    set_gate(bool(target & TARGET_GATE_OPEN), plant)
+    set_pump(bool(target & TARGET_PUMP_ON), plant)
+
+    actual = plant.state.snapshot.bits
+    plant.commands.settle("gate", 1 if actual & GATE_OPEN else 0)
+    plant.commands.settle("pump", 1 if actual & PUMP_ON else 0)
+
+
+def update_thread_variables(plants, results, stale=()):
+    if schedule is not None:
+        schedule.maybe_reload()
+        is_day = schedule.is_day()
+    elif daylight is not None:
+        is_day = daylight.is_day()
     else:
-        isDayEvent.clear()
-
-    # update water level status
+        # for now make every even minute represent daytime and every odd minute represent nighttime
+        is_day = dt.datetime.now().minute % 2 == 0
+
+    # only points whose poll group was due this cycle are present in results;
+    # each plant's inputs are swapped in with a single update
+    for plant in plants:
+        mask = DAY | ANY_STALE
+        bits = DAY if is_day else 0
+        for signal, flag in SIGNALS.items():
+            name = f"{plant.name}.{signal}"
+            if name in stale:
+                bits |= STALE[signal]
+            value = results.get(name)
+            if value is None:
+                continue
+            if signal != "waterLevelHigh":
+                plant.coils.verify(signal, value)
+            mask |= flag
+            bits |= flag if value else 0
+        plant.state.update(mask, bits)
+
+
+def build_poll_groups(plants, level_poll_period, coil_poll_period):
+    level_points = []
+    coil_points = []
+    for plant in plants:
+        level_points.append(PollPoint(f"{plant.name}.waterLevelHigh", plant.device_name("sensor"), plant.clients["sensor"], "di"))
+        coil_points.append(PollPoint(f"{plant.name}.gateOpen", plant.device_name("gate"), plant.clients["gate"], "co"))
+        coil_points.append(PollPoint(f"{plant.name}.pumpOn", plant.device_name("pump"), plant.clients["pump"], "co"))
+
+    return [
+        PollGroup("level", level_poll_period, level_points),
+        PollGroup("coils", coil_poll_period, coil_points),
+    ]
+
+
+def run_plant_logic(plant):
+    # hold the last action rather than act on state we could not read back
+    bits = plant.state.snapshot.bits
+    if bits & ANY_STALE:
+        logging.debug(f"[{plant.name}] holding relays while {', '.join(stale_signals(bits))} is stale")
+        return
+
+    # flip between manual and automatic control
+    is_day = 1 if bits & DAY else 0
+    water_level_high = 1 if bits & LEVEL_HIGH else 0
+    previous_action = plant.previous_action
     try:
-        sr = clients[0].read_discrete_inputs(0x00)
-    except ModbusException as e:
-        logging.critical(f"{e}")
-        teardown(clients)
-        exit(1)
-
-    if sr.isError():
-        logging.critical(f"modbus library error: {sr}")
-        teardown(clients)
-        exit(1)
-
-    if isinstance(sr, ExceptionResponse):
-        logging.critical(f"modbus error response: {sr}")
-        teardown(clients)
-        exit(1)
-
-    if sr.bits[0] == 1:
-        waterLevelHighEvent.set()
-    else:
-        waterLevelHighEvent.clear()
-
-    # update gate status
-    try:
-        sr = clients[1].read_coils(0x00)
-    except ModbusException as e:
-        logging.critical(f"{e}")
-        teardown(clients)
-        exit(1)
-
-    if sr.isError():
-        logging.critical(f"modbus library error: {sr}")
-        teardown(clients)
-        exit(1)
-
-    if isinstance(sr, ExceptionResponse):
-        logging.critical(f"modbus error response: {sr}")
-        teardown(clients)
-        exit(1)
-
-    if sr.bits[0] == 1:
-        gateOpenEvent.set()
-    else:
-        gateOpenEvent.clear()
-
-    # update pump status
-    try:
-        sr = clients[2].read_coils(0x00)
+        if bits & MANUAL:
+            plant.previous_action = manual_control_logic(plant)
+        else:
+            plant.previous_action = automatic_control_logic(is_day, water_level_high, plant.previous_action, plant)
     except ModbusException as e:
-        logging.critical(f"{e}")
-        teardown(clients)
-        exit(1)
-
-    if sr.isError():
-        logging.critical(f"modbus library error: {sr}")
-        teardown(clients)
-        exit(1)
-
-    if isinstance(sr, ExceptionResponse):
-        logging.critical(f"modbus error response: {sr}")
-        teardown(clients)
-        exit(1)
-
-    if sr.bits[0] == 1:
-        pumpOnEvent.set()
-    else:
-        pumpOnEvent.clear()
-
-
-def run_control_loop(sensor_server, sensor_server_port, gate_server, gate_server_port, pump_server, pump_server_port):
-    clients = setup(sensor_server, sensor_server_port, gate_server, gate_server_port, pump_server, pump_server_port)
-    previous_action = 0
+        # the relay state is left untouched so the write is retried next cycle
+        logging.error(f"[{plant.name}] relay write failed: {e}")
+    if plant.previous_action != previous_action:
+        journal_append(plant, journal.ACTION, plant.previous_action or 0, previous_action or 0)
+
+
+def run_control_loop(plants, cycle_period=1.0, level_poll_period=1.0, coil_poll_period=10.0, poll_workers=32,
+                     modbus_timeout=0.5, max_reconnect_backoff=0.5):
+    pool = ConnectionPool(timeout=modbus_timeout, max_backoff=max_reconnect_backoff)
+    setup(plants, pool)
+    devices = len(plants) * len(DEVICE_ROLES)
+    scheduler = PollScheduler(cycle_period, build_poll_groups(plants, level_poll_period, coil_poll_period),
+                              max_workers=min(poll_workers, devices))
+
+    # poll in loop and set values in loop (mindful of day.night cycles; this is PSH after all)
+    def control_cycle(results):
+        # update current state
+        update_thread_variables(plants, results, scheduler.stale)
+        if event_journal is not None:
+            for plant in plants:
+                bits = plant.state.snapshot.bits
+                event_journal.record_inputs(plant.name, 1 if bits & DAY else 0, 1 if bits & LEVEL_HIGH else 0,
+                                            1 if bits & ANY_STALE else 0)
+
+        # plants share no devices, so their relays can be driven in parallel
+        # a standby only follows: it polls to keep its view and connections warm but writes nothing
+        if replicator is None or replicator.may_actuate():
+            start = time.perf_counter()
+            scheduler.dispatch(run_plant_logic, plants)
+            ACTUATION_DURATION.observe(time.perf_counter() - start)
+
+        # read back whatever was written this cycle; other coils wait for their group
+        for plant in plants:
+            scheduler.request_read(f"{plant.name}.{signal}" for signal in plant.coils.take_unverified())
+
+        # let HMI streams know about anything that changed this cycle and record it
+        for plant in plants:
+            state = plant_state(plant)
+            plant.broadcaster.publish(state)
+            if plant.historian is not None:
+                rtt = {role: scheduler.cycle_rtt[plant.device_name(role)]
+                       for role in DEVICE_ROLES if plant.device_name(role) in scheduler.cycle_rtt}
+                plant.historian.record(state, rtt)
+
+        global first_cycle_at
+        if first_cycle_at is None:
+            first_cycle_at = time.time()
+            FIRST_CYCLE.set(first_cycle_at - started_at)
+            logging.info(f"first control cycle completed {first_cycle_at - started_at:.3f} s after start")
+        if replicator is not None:
+            replicator.cycle_completed()
+
+    # act on manual commands as they arrive instead of at the next cycle
+    def on_command():
+        if replicator is not None and not replicator.may_actuate():
+            return
+        manual = [plant for plant in plants if plant.state.is_set(MANUAL)]
+        start = time.perf_counter()
+        scheduler.dispatch(run_plant_logic, manual)
+        ACTUATION_DURATION.observe(time.perf_counter() - start)
+        for plant in manual:
+            scheduler.request_read(f"{plant.name}.{signal}" for signal in plant.coils.take_unverified())
+            plant.broadcaster.publish(plant_state(plant))
+        if replicator is not None:
+            replicator.publish()
+
+    for plant in plants:
+        plant.commands.wake = scheduler.wake
+
+    # a device that comes (back) up is read on a cycle of its own rather than at the next tick
+    pool.on_connect = lambda device: scheduler.expedite()
+
+    # a standby that takes over runs its first cycle as the active coordinator right away
+    if replicator is not None:
+        replicator.on_promote = scheduler.expedite
+        replicator.start()
 
     try:
-
-        # poll in loop and set values in loop (mindful of day.night cycles; this is PSH after all)
-        while True:
-            import time
-            time.sleep(1)
-
-            # update current state
-            update_thread_variables(clients)
-
-            # flip between manual and automatic control
-            is_day = 1 if isDayEvent.is_set() else 0
-            water_level_high = 1 if waterLevelHighEvent.is_set() else 0
-            if manualControlEvent.is_set():
-                previous_action = manual_control_logic(clients)
-            else:
-                previous_action = automatic_control_logic(is_day, water_level_high, previous_action, clients)
-
+        scheduler.run(control_cycle, on_command)
     finally:
-        teardown(clients)
+        scheduler.shutdown()
+        teardown(plants, pool)
+        for plant in plants:
+            if plant.historian is not None:
+                plant.historian.close()
+        if event_journal is not None:
+            event_journal.close()
 
 
 @click.command()
 @click.option("--log", "-l", default="info", help="The log level to use when sending logs to stdout (default: INFO; options: DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+@click.option("--log-format", "-lf", default="text", type=click.Choice(["text", "json"], case_sensitive=False), help="Write log records as plain text or as one JSON object per line, with state transitions as structured events (default: text)")
+@click.option("--log-rate", "-lr", default=5.0, help="Log records per second allowed from any one line of code after a burst of 20; the rest are counted and suppressed, 0 to disable (default: 5.0)")
+@click.option("--device-map", "-dm", default=None, type=click.Path(exists=True, dir_okay=False), help="A JSON file describing every plant (sensor, gate and pump endpoints) to manage; overrides the single-plant server options below")
 @click.option("--sensor-server", "-ss", default="192.168.1.3", help="The address of the Modbus/TCP server to query for water level sensor state (default: 192.168.1.3)")
 @click.option("--sensor-server-port", "-sp", default=502, help="The port to direct Modbus traffic to for the water level sensor server (default: 502)")
 @click.option("--gate-server", "-gs", default="192.168.1.4", help="The address of the Modbus/TCP server to manipulate the water gate state (default: 192.168.1.4)")
 @click.option("--gate-server-port", "-gp", default=502, help="The port to direct Modbus traffic to for the water level sensor server (default: 502)")
 @click.option("--pump-server", "-ps", default="192.168.1.5", help="The address of the Modbus/TCP server to manipulate the water pump state (default: 192.168.1.5)")
 @click.option("--pump-server-port", "-pp", default=502, help="The port to direct Modbus traffic to for the water level sensor server (default: 502)")
+@click.option("--policy", "-po", "control_policy", default=",".join(map(str, policy.DEFAULT_POLICY)), help="Automatic control policy as four actions for (NIGHT, LOW), (NIGHT, HIGH), (DAY, LOW), (DAY, HIGH); 1 opens the gate, 2 runs the pump, 3 stops both; compare candidates with policy.py first (default: 2,3,1,1)")
+@click.option("--cycle-period", "-cp", default=1.0, help="The fixed period of the control cycle in seconds; cycles that run longer are reported as overruns (default: 1.0)")
+@click.option("--level-poll-period", "-lp", default=1.0, help="How often to poll the water level sensor in seconds, rounded up to a whole number of cycles (default: 1.0)")
+@click.option("--coil-poll-period", "-op", default=10.0, help="How often to re-verify the gate and pump coils in seconds, rounded up to a whole number of cycles; a coil is also read back on the cycle after every write, and otherwise trusted to hold what the device acknowledged (default: 10.0)")
+@click.option("--poll-workers", "-pw", default=32, help="The maximum number of threads used to poll and actuate devices, shared by all plants (default: 32)")
+@click.option("--modbus-timeout", "-mt", default=0.5, help="Seconds to wait for a Modbus response before treating the device as down and reconnecting it in the background (default: 0.5)")
+@click.option("--max-reconnect-backoff", "-mb", default=0.5, help="Upper bound in seconds on the exponential backoff between reconnect attempts; keep it below the cycle period so a bounced device is back within one cycle (default: 0.5)")
+@click.option("--history-capacity", "-hc", default=604800, help="Control cycles of history to keep per plant in a fixed-size ring buffer, 0 to disable (default: 604800, a week at 1 s cycles)")
+@click.option("--history-dir", "-hd", default=None, type=click.Path(file_okay=False, writable=True), help="Directory for memory-mapped history files so history survives restarts (default: keep history in memory only)")
+@click.option("--journal-dir", "-jd", default=None, type=click.Path(file_okay=False, writable=True), help="Directory for an append-only journal of control inputs, manual commands, actions and coil writes, for replay.py (default: disabled)")
+@click.option("--journal-segment-size", "-js", default=64, help="MiB after which a journal segment is closed and a new one started (default: 64)")
+@click.option("--journal-fsync-interval", "-jf", default=1.0, help="Seconds between batched journal writes and fsyncs; a crash loses at most this much (default: 1.0)")
+@click.option("--schedule", "-sc", "schedule_file", default=None, type=click.Path(exists=True, dir_okay=False), help="JSON schedule of sunrise/sunset, tariff bands and holidays that decides day and night; edits are picked up without a restart (default: alternate day and night every minute)")
+@click.option("--plant-sim", "-sim", default=None, help="HOST:PORT of a plant simulator whose (possibly accelerated) clock decides day and night (default: use the wall clock)")
+@click.option("--replication-socket", "-rs", default=None, help="Name of an abstract unix socket shared with a second coordinator on this host; whichever holds it drives the plant, the other is a hot standby that takes over when it goes away (default: disabled, run alone)")
+@click.option("--replication-lease", "-rl", default=0.5, help="Seconds the active coordinator's state updates entitle it to drive the plant; a standby hearing nothing for this long takes over, so keep it below the cycle period (default: 0.5)")
 @click.option("--hmi-host", "-ha", default="0.0.0.0", help="The address to use when creating a socket for the HMI (default: 0.0.0.0)")
 @click.option("--hmi-port", "-hp", default=80, help="The port to use when creating a socket for the HMI (default: 80)")
+@click.option("--hmi-server", "-hs", default="waitress", type=click.Choice(["waitress", "development"], case_sensitive=False), help="The web server to run the HMI under; waitress falls back to the Flask development server when it is not installed (default: waitress)")
+@click.option("--hmi-threads", "-ht", default=32, help="Worker threads for the waitress HMI server; every open /stream subscriber holds one (default: 32)")
+@click.option("--hmi-max-streams", "-hx", default=16, help="Open /stream subscribers allowed at once; keep it below --hmi-threads so /manual and /update always find a free worker, further clients poll /update instead (default: 16)")
 def main(**args):
     # set up logging
     log_level = getattr(logging, args['log'].upper())
-    logging.basicConfig(level=log_level)
+    setup_logging(log_level, args['log_format'], args['log_rate'])
     logging.info(f"logging level set to {args['log'].upper()}")
 
-    # start constituent threads
-    control_loop_thread = threading.Thread(target=run_control_loop, args=(args['sensor_server'], args['sensor_server_port'], args['gate_server'], args['gate_server_port'], args['pump_server'], args['pump_server_port']))
-    control_loop_thread.start()
-    hmi_webserver_thread = threading.Thread(target=app.run, kwargs={"host": args['hmi_host'], "port": args['hmi_port']})
+    global daylight, control_policy, schedule
+    control_policy = policy.parse_policy(args['control_policy'])
+    if control_policy != policy.DEFAULT_POLICY:
+        logging.warning(f"running with non-default control policy {args['control_policy']}")
+    if args['plant_sim'] is not None:
+        logging.info(f"taking day and night from the plant simulator at {args['plant_sim']}")
+        daylight = SimulatedDaylight(args['plant_sim'])
+    elif args['schedule_file'] is not None:
+        logging.info(f"taking day and night from the schedule in {args['schedule_file']}")
+        schedule = Schedule(args['schedule_file'])
+    else:
+        logging.warning("no --schedule given, alternating day and night every minute")
+
+    # load the plants to manage
+    if args['device_map'] is not None:
+        plants.extend(load_device_map(args['device_map']))
+    else:
+        plants.append(Plant("default",
+                            (args['sensor_server'], args['sensor_server_port']),
+                            (args['gate_server'], args['gate_server_port']),
+                            (args['pump_server'], args['pump_server_port'])))
+    logging.info(f"managing {len(plants)} plant(s): {', '.join(p.name for p in plants)}")
+    for plant in plants:
+        plant.broadcaster.publish(plant_state(plant))
+        if args['history_capacity'] > 0:
+            path = None
+            if args['history_dir'] is not None:
+                Path(args['history_dir']).mkdir(parents=True, exist_ok=True)
+                path = str(Path(args['history_dir']) / f"{plant.name}.history")
+            plant.historian = Historian(args['history_capacity'], path)
+
+    global event_journal
+    if args['journal_dir'] is not None:
+        event_journal = journal.Journal(args['journal_dir'], [p.name for p in plants],
+                                        args['journal_segment_size'] * 1024 * 1024, args['journal_fsync_interval'])
+
+    global stream_slots
+    max_streams = args['hmi_max_streams']
+    if max_streams >= args['hmi_threads']:
+        max_streams = max(0, args['hmi_threads'] - 1)
+        logging.warning(f"--hmi-max-streams must leave a worker free for other requests, lowered to {max_streams}")
+    stream_slots = threading.BoundedSemaphore(max_streams)
+
+    global replicator
+    if args['replication_socket'] is not None:
+        replicator = Replicator(args['replication_socket'], plants, args['replication_lease'])
+
+    # keep the built HMI in memory and answer asset requests before they reach
+    # flask; it is loaded in the background, and flask serves it from disk until then
+    if Path(HMI_ROOT).is_dir():
+        bundle_middleware = app.wsgi_app = StaticBundleMiddleware(app.wsgi_app)
+        threading.Thread(target=bundle_middleware.load, args=(HMI_ROOT,), name="hmi-bundle", daemon=True).start()
+    else:
+        logging.warning(f"no HMI build found at {HMI_ROOT}, serving the HMI from disk on demand")
+
+    # start constituent threads, the HMI first so it answers while the devices are still being reached
+    hmi_webserver_thread = threading.Thread(target=serve_hmi, args=(app, args['hmi_host'], args['hmi_port'], args['hmi_server'], args['hmi_threads']))
     hmi_webserver_thread.start()
+    control_loop_thread = threading.Thread(target=run_control_loop, args=(plants, args['cycle_period'], args['level_poll_period'], args['coil_poll_period'], args['poll_workers'], args['modbus_timeout'], args['max_reconnect_backoff']))
+    control_loop_thread.start()
     control_loop_thread.join()
     hmi_webserver_thread.join()
 
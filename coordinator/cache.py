@@ -0,0 +1,62 @@
+"""
+write-aware cache of the coil values the coordinator drives itself, so the
+gate and pump coils only need an occasional read-back
+"""
+
+import logging
+import threading
+
+from logs import log_event
+from metrics import Counter
+
+
+TRUSTED_WRITES = Counter("psh_coil_writes_trusted", "Acknowledged coil writes taken as the device state until verified", ["plant"])
+DRIFT = Counter("psh_coil_drift", "Coil read-backs that disagreed with the value the coordinator last wrote or read", ["plant", "signal"])
+
+
+class PointCache:
+    """
+    Last known value of each coil of one plant. A write the device
+    acknowledged is trusted as the coil's state, but the coil is still read
+    back once on the following cycle; after that it is only verified when its
+    poll group comes due. A read-back that disagrees with the cached value is
+    reported as drift and replaces it.
+    """
+
+    def __init__(self, plant):
+        self.plant = plant
+        self.values = {}
+        self.drift = 0
+        self._unverified = set()
+        self._lock = threading.Lock()
+
+    def acknowledge(self, signal, value):
+        with self._lock:
+            self.values[signal] = value
+            self._unverified.add(signal)
+        TRUSTED_WRITES.labels(self.plant).inc()
+
+    def follow(self, signal, value):
+        """Take the value another coordinator (the active one, to a standby) says the coil holds."""
+        with self._lock:
+            self.values[signal] = value
+
+    def take_unverified(self):
+        """Signals written since the last call, to be read back next cycle."""
+        with self._lock:
+            signals, self._unverified = self._unverified, set()
+        return signals
+
+    def verify(self, signal, value):
+        """Record a read-back; returns False if it contradicts the cache."""
+        with self._lock:
+            expected = self.values.get(signal)
+            self.values[signal] = value
+        if expected is None or expected == value:
+            return True
+
+        self.drift += 1
+        DRIFT.labels(self.plant, signal).inc()
+        log_event("drift", f"[{self.plant}] {signal} drifted: expected {expected}, device reports {value}",
+                  logging.WARNING, plant=self.plant, signal=signal, expected=expected, actual=value)
+        return False
@@ -0,0 +1,103 @@
+"""
+sequenced manual commands from the HMI, coalesced to the latest intent per
+actuator and handed to the control loop as soon as they are submitted
+"""
+
+import threading
+import time
+
+from metrics import Counter, Histogram
+
+
+COMMANDS = Counter("psh_manual_commands", "Manual gate and pump commands accepted from the HMI", ["plant", "actuator"])
+COALESCED = Counter("psh_manual_commands_coalesced", "Manual commands replaced by a newer one for the same actuator before the control loop applied them", ["plant", "actuator"])
+COMMAND_LATENCY = Histogram("psh_manual_command_latency_seconds", "Time from accepting a manual command to its value being confirmed on the device", ["plant", "actuator"])
+
+# what became of a command someone waited on
+CONFIRMED = "confirmed"
+SUPERSEDED = "superseded"
+PENDING = "pending"
+
+
+class CommandQueue:
+    """
+    Manual commands of one plant. Every command gets a number from one
+    sequence, and only the newest pending command per actuator is kept, so
+    however fast the operator toggles, the control loop applies the last
+    intent and never an older one after a newer one. Submitting wakes the
+    control loop through `wake`, which the loop sets when it starts.
+
+    A command is confirmed once the control loop sees the device hold its
+    value (an acknowledged write, or a coil that already had it), and
+    superseded if a newer command for the same actuator or a mode switch
+    overtakes it first.
+    """
+
+    def __init__(self, plant):
+        self.plant = plant
+        self.wake = None
+        self.seq = 0
+        self._pending = {}
+        self._latest = {}
+        self._confirmed = {}
+        self._discarded = 0
+        self._changed = threading.Condition()
+
+    def submit(self, actuator, value):
+        """Queue `value` for `actuator` ("gate" or "pump") and return its sequence number."""
+        with self._changed:
+            self.seq += 1
+            if actuator in self._pending:
+                COALESCED.labels(self.plant, actuator).inc()
+            self._pending[actuator] = self._latest[actuator] = (self.seq, value, time.monotonic())
+            seq = self.seq
+        COMMANDS.labels(self.plant, actuator).inc()
+        if self.wake is not None:
+            self.wake()
+        return seq
+
+    def take(self):
+        """{actuator: value} of every pending command, for the control loop to apply."""
+        with self._changed:
+            pending, self._pending = self._pending, {}
+        return {actuator: value for actuator, (_, value, _) in pending.items()}
+
+    def discard(self):
+        """Drop pending commands, e.g. when the control mode changes under them."""
+        with self._changed:
+            self._pending = {}
+            self._discarded = self.seq
+            self._changed.notify_all()
+
+    def settle(self, actuator, value):
+        """Called by the control loop with the value the device holds for `actuator`."""
+        with self._changed:
+            latest = self._latest.get(actuator)
+            if latest is None or latest[0] <= self._discarded or latest[1] != value or actuator in self._pending:
+                return
+            seq, _, submitted = latest
+            if self._confirmed.get(actuator, (0, 0.0))[0] >= seq:
+                return
+            latency = time.monotonic() - submitted
+            self._confirmed[actuator] = (seq, latency)
+            self._changed.notify_all()
+        COMMAND_LATENCY.labels(self.plant, actuator).observe(latency)
+
+    def wait(self, actuator, seq, timeout):
+        """
+        Block until command `seq` for `actuator` is confirmed or superseded,
+        or the timeout passes; returns (status, seconds from submit to
+        confirmation or None).
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                confirmed_seq, latency = self._confirmed.get(actuator, (0, 0.0))
+                if confirmed_seq == seq:
+                    return CONFIRMED, latency
+                if confirmed_seq > seq or self._latest[actuator][0] > seq or seq <= self._discarded:
+                    return SUPERSEDED, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return PENDING, None
+                self._changed.wait(remaining)
@@ -0,0 +1,203 @@
+"""
+fixed-size, memory-mapped ring buffer recording every control cycle of a plant
+"""
+
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+# bit positions of the HMI signals in a record's state field
+SIGNALS = ("manualControl", "timeOfDay", "waterLevelHigh", "gateOpen", "pumpOn", "stale")
+LATENCY_ROLES = ("sensor", "gate", "pump")
+
+MAGIC = b"PSHH"
+HEADER = struct.Struct("<4sIQQQ")     # magic, record size, capacity, next index, record count
+RECORD = struct.Struct("<dI3f")       # unix time, state bits, sensor/gate/pump rtt in ms (nan if not polled)
+
+
+def pack_state(state):
+    bits = 0
+    for i, signal in enumerate(SIGNALS):
+        if state.get(signal):
+            bits |= 1 << i
+    return bits
+
+
+class Historian:
+    """
+    Ring buffer of fixed-size binary records. Samples are packed straight
+    into the mapping, so recording allocates no per-sample Python objects and
+    memory use is capped at capacity * RECORD.size bytes. With a path the
+    buffer is backed by that file and survives restarts; without one it
+    lives in anonymous memory.
+
+    query() bisects on the record times, so they must never decrease: a
+    sample stamped before the last one (the wall clock was stepped back) is
+    recorded at the last one's time instead.
+    """
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.path = path
+        self._lock = threading.Lock()
+        size = HEADER.size + capacity * RECORD.size
+
+        if path is None:
+            self._file = None
+            self._map = mmap.mmap(-1, size)
+            self._reset()
+            return
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._file = os.fdopen(fd, "r+b")
+        existing = os.fstat(fd).st_size
+        if existing != size:
+            self._file.truncate(size)
+        self._map = mmap.mmap(fd, size)
+
+        magic, record_size, stored_capacity, self._next, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or record_size != RECORD.size or stored_capacity != capacity:
+            if existing:
+                logging.warning(f"history file {path} has a different layout, starting a new history")
+            self._reset()
+        else:
+            self._last = self._time_at(self._count - 1, self._next - self._count) if self._count else 0.0
+            logging.info(f"resuming history from {path} ({self._count} sample(s))")
+
+    def _reset(self):
+        self._next = 0
+        self._count = 0
+        self._last = 0.0
+        self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, RECORD.size, self.capacity, self._next, self._count)
+
+    def record(self, state, rtt=None, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        rtt = rtt or {}
+        latencies = [rtt[role] * 1000 if role in rtt else math.nan for role in LATENCY_ROLES]
+        with self._lock:
+            timestamp = self._last = max(timestamp, self._last)
+            RECORD.pack_into(self._map, HEADER.size + self._next * RECORD.size,
+                             timestamp, pack_state(state), *latencies)
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+            self._write_header()
+
+    def __len__(self):
+        return self._count
+
+    def _time_at(self, logical, first):
+        offset = HEADER.size + ((first + logical) % self.capacity) * RECORD.size
+        return struct.unpack_from("<d", self._map, offset)[0]
+
+    def _search(self, t, first, count):
+        # records are in time order, so bisect over logical (oldest-first) indices
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid, first) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _copy(self, start, end, first):
+        # copy the raw bytes of logical records [start, end) out of the ring
+        begin = (first + start) % self.capacity
+        length = end - start
+        tail = min(length, self.capacity - begin)
+        offset = HEADER.size + begin * RECORD.size
+        raw = self._map[offset:offset + tail * RECORD.size]
+        if tail < length:
+            raw += self._map[HEADER.size:HEADER.size + (length - tail) * RECORD.size]
+        return raw
+
+    def query(self, start_time, end_time, step):
+        """
+        Downsample [start_time, end_time) into buckets of `step` seconds.
+        Signals are reported as the fraction of samples in the bucket where
+        they were set, latencies as the mean of the polled samples.
+        """
+        with self._lock:
+            count = self._count
+            first = (self._next - count) % self.capacity
+            lo = self._search(start_time, first, count)
+            hi = self._search(end_time, first, count)
+            raw = self._copy(lo, hi, first)
+
+        buckets = max(1, math.ceil((end_time - start_time) / step))
+        try:
+            import numpy as np
+        except ImportError:
+            samples, signal_sums, latency_sums, latency_counts = _sum_python(raw, start_time, step, buckets)
+        else:
+            samples, signal_sums, latency_sums, latency_counts = _sum_numpy(np, raw, start_time, step, buckets)
+
+        series = {"t": [], "samples": []}
+        series.update({signal: [] for signal in SIGNALS})
+        series.update({f"{role}RttMs": [] for role in LATENCY_ROLES})
+        for b in range(buckets):
+            if not samples[b]:
+                continue
+            series["t"].append(start_time + b * step)
+            series["samples"].append(samples[b])
+            for i, signal in enumerate(SIGNALS):
+                series[signal].append(round(signal_sums[i][b] / samples[b], 4))
+            for i, role in enumerate(LATENCY_ROLES):
+                n = latency_counts[i][b]
+                series[f"{role}RttMs"].append(round(latency_sums[i][b] / n, 3) if n else None)
+        return series
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            if self._file is not None:
+                self._file.close()
+
+
+# per-bucket sums of a run of packed records: samples, samples with each
+# signal set, and the sum and number of polled samples of each latency
+def _sum_numpy(np, raw, start_time, step, buckets):
+    records = np.frombuffer(raw, dtype=np.dtype([("t", "<f8"), ("bits", "<u4"), ("rtt", "<f4", (len(LATENCY_ROLES),))]))
+    b = np.minimum(buckets - 1, (records["t"] - start_time) // step).astype(np.intp)
+    # count every combination of signals per bucket in one pass, then add up those with each signal set
+    patterns = 1 << len(SIGNALS)
+    combinations = np.bincount(b * patterns + (records["bits"] & (patterns - 1)),
+                               minlength=buckets * patterns).reshape(buckets, patterns)
+    samples = combinations.sum(axis=1).tolist()
+    signal_set = (np.arange(patterns)[:, None] >> np.arange(len(SIGNALS))) & 1
+    signal_sums = (combinations @ signal_set).T.tolist()
+    latency_sums, latency_counts = [], []
+    for i in range(len(LATENCY_ROLES)):
+        latency = records["rtt"][:, i].astype(np.float64)
+        polled = ~np.isnan(latency)
+        latency_sums.append(np.bincount(b, weights=np.where(polled, latency, 0.0), minlength=buckets).tolist())
+        latency_counts.append(np.bincount(b, weights=polled, minlength=buckets).astype(np.int64).tolist())
+    return samples, signal_sums, latency_sums, latency_counts
+
+
+def _sum_python(raw, start_time, step, buckets):
+    samples = [0] * buckets
+    signal_sums = [[0] * buckets for _ in SIGNALS]
+    latency_sums = [[0.0] * buckets for _ in LATENCY_ROLES]
+    latency_counts = [[0] * buckets for _ in LATENCY_ROLES]
+    for timestamp, bits, *latencies in RECORD.iter_unpack(raw):
+        b = min(buckets - 1, int((timestamp - start_time) // step))
+        samples[b] += 1
+        for i, sums in enumerate(signal_sums):
+            if bits & (1 << i):
+                sums[b] += 1
+        for i, latency in enumerate(latencies):
+            if latency == latency:
+                latency_sums[i][b] += latency
+                latency_counts[i][b] += 1
+    return samples, signal_sums, latency_sums, latency_counts
@@ -31,6 +31,7 @@ function setManualControlRequest(value) {
 
 function App() {
   const secondsBetweenUpdate = 1;
+  const secondsBeforeStreamRetry = 10;
 
   const [manualControl, setManualControl] = useState(0);
   const [timeOfDay, setTimeOfDay] = useState(0);
@@ -39,6 +40,14 @@ function App() {
   const [pumpOn, setPumpOn] = useState(0);
 
   useEffect(() => {
+    function applyData(json) {
+      if (json.manualControl !== undefined) setManualControl(json.manualControl);
+      if (json.timeOfDay !== undefined) setTimeOfDay(json.timeOfDay);
+      if (json.waterLevelHigh !== undefined) setWaterLevelHigh(json.waterLevelHigh);
+      if (json.gateOpen !== undefined) setGateOpen(json.gateOpen);
+      if (json.pumpOn !== undefined) setPumpOn(json.pumpOn);
+    }
+
     function updateData() {
       // for production:
       fetch("/update")
@@ -46,11 +55,7 @@ function App() {
         .then((json) => {
           console.log("updating data with vvv");
           console.log(json);
-          setManualControl(json.manualControl);
-          setTimeOfDay(json.timeOfDay);
-          setWaterLevelHigh(json.waterLevelHigh);
-          setGateOpen(json.gateOpen);
-          setPumpOn(json.pumpOn);
+          applyData(json);
         })
 
       // for testing:
@@ -61,17 +66,50 @@ function App() {
       //  gateOpen: 0,
       //  pumpOn: 0
       //}
-      //setManualControl(updateData.manualControl);
-      //setTimeOfDay(updateData.timeOfDay);
-      //setWaterLevelHigh(updateData.waterLevelHigh);
-      //setGateOpen(updateData.gateOpen);
-      //setPumpOn(updateData.pumpOn);
+      //applyData(updateData);
+    }
+
+    // fall back to polling /update whenever the push stream is unavailable
+    let interval = null;
+    function startPolling() {
+      if (interval === null) {
+        updateData();
+        interval = setInterval(() => updateData(), secondsBetweenUpdate * 1000);
+      }
+    }
+    function stopPolling() {
+      if (interval !== null) {
+        clearInterval(interval);
+        interval = null;
+      }
+    }
+
+    // prefer the server-sent event stream, which only pushes changed fields
+    let stream = null;
+    let retry = null;
+    function startStream() {
+      retry = null;
+      if (typeof EventSource === "undefined") {
+        startPolling();
+        return;
+      }
+      stream = new EventSource("/stream");
+      stream.onopen = () => stopPolling();
+      stream.addEventListener("snapshot", (e) => applyData(JSON.parse(e.data)));
+      stream.addEventListener("delta", (e) => applyData(JSON.parse(e.data)));
+      stream.onerror = () => {
+        stream.close();
+        stream = null;
+        startPolling();
+        retry = setTimeout(() => startStream(), secondsBeforeStreamRetry * 1000);
+      };
     }
 
-    updateData()
-    const interval = setInterval(() => updateData(), secondsBetweenUpdate * 1000);
+    startStream();
     return () => {
-      clearInterval(interval);
+      if (stream !== null) stream.close();
+      if (retry !== null) clearTimeout(retry);
+      stopPolling();
     }
   }, []);
 
@@ -0,0 +1,154 @@
+"""
+append-only binary journal of everything that drives an actuation: control
+inputs, manual commands, control actions and coil writes, in fixed-size
+records written in batches to rotating segment files
+"""
+
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from pathlib import Path
+
+from metrics import Counter, Histogram
+
+
+MAGIC = b"PSHJ"
+VERSION = 1
+# magic, version, length of the JSON segment header that follows
+SEGMENT_HEADER = struct.Struct("<4sHI")
+# wall clock time, plant index in the segment header, kind, three arguments
+RECORD = struct.Struct("<dHBBBBxx")
+SEGMENT_NAME = re.compile(r"^(\d{8})\.psj$")
+
+# a = is_day, b = water level high, c = 1 if any point is stale
+INPUT = 1
+# a = field (MANUAL_MODE, MANUAL_GATE, MANUAL_PUMP), b = value
+MANUAL = 2
+# a = action (1-3 automatic, 0 manual), b = previous action
+ACTION = 3
+# a = coil (COIL_GATE, COIL_PUMP), b = value written
+COIL = 4
+KINDS = {INPUT: "input", MANUAL: "manual", ACTION: "action", COIL: "coil"}
+
+MANUAL_MODE, MANUAL_GATE, MANUAL_PUMP = 0, 1, 2
+COIL_GATE, COIL_PUMP = 0, 1
+
+JOURNAL_RECORDS = Counter("psh_journal_records", "Records appended to the event journal", ["kind"])
+JOURNAL_FLUSH_DURATION = Histogram("psh_journal_flush_duration_seconds", "Time to write and fsync one batch of journal records")
+
+
+class Journal:
+    """
+    Records are packed into memory by append() and written out by a
+    background thread every `fsync_interval` seconds, followed by one fsync,
+    so a crash loses at most that much. A segment is closed and a new one
+    started once it grows past `segment_bytes`. Each segment begins with the
+    names of the plants its records refer to.
+    """
+
+    def __init__(self, directory, plant_names, segment_bytes=64 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.plant_names = list(plant_names)
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.records = 0
+
+        self._ids = {name: i for i, name in enumerate(self.plant_names)}
+        self._inputs = {}
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._running = True
+
+        existing = [int(m.group(1)) for m in map(SEGMENT_NAME.match, os.listdir(self.directory)) if m]
+        self._sequence = max(existing, default=0)
+        self._file = None
+        self._open_segment()
+        self._thread = threading.Thread(target=self._flush_loop, name="journal", daemon=True)
+        self._thread.start()
+
+    def _open_segment(self):
+        self._sequence += 1
+        path = self.directory / f"{self._sequence:08d}.psj"
+        header = json.dumps({"plants": self.plant_names, "created": time.time()}).encode()
+        self._file = open(path, "ab")
+        self._file.write(SEGMENT_HEADER.pack(MAGIC, VERSION, len(header)) + header)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        logging.info(f"journaling to {path}")
+
+    def append(self, plant, kind, a=0, b=0, c=0, timestamp=None):
+        record = RECORD.pack(time.time() if timestamp is None else timestamp, self._ids[plant], kind, a, b, c)
+        with self._lock:
+            self._buffer += record
+            self.records += 1
+        JOURNAL_RECORDS.labels(KINDS[kind]).inc()
+
+    def record_inputs(self, plant, is_day, water_level_high, stale):
+        """Journal the control inputs of a plant if they changed since the last call."""
+        inputs = (is_day, water_level_high, stale)
+        if self._inputs.get(plant) != inputs:
+            self._inputs[plant] = inputs
+            self.append(plant, INPUT, *inputs)
+
+    def _flush_loop(self):
+        with self._lock:
+            while self._running:
+                self._wake.wait(self.fsync_interval)
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._buffer:
+            return
+        start = time.perf_counter()
+        self._file.write(self._buffer)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._buffer = bytearray()
+        JOURNAL_FLUSH_DURATION.observe(time.perf_counter() - start)
+        if self._file.tell() >= self.segment_bytes:
+            self._file.close()
+            self._open_segment()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._running = False
+            self._wake.notify_all()
+        self._thread.join()
+        with self._lock:
+            self._flush_locked()
+            self._file.close()
+
+
+def segments(directory):
+    """Segment files of a journal directory, oldest first."""
+    return sorted(p for p in Path(directory).iterdir() if SEGMENT_NAME.match(p.name))
+
+
+def read_segment(path):
+    """Yield (timestamp, plant, kind, a, b, c) for every complete record of a segment."""
+    data = Path(path).read_bytes()
+    magic, version, header_length = SEGMENT_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} journal segment")
+    offset = SEGMENT_HEADER.size + header_length
+    plants = json.loads(data[SEGMENT_HEADER.size:offset])["plants"]
+
+    # a crash can leave half a record at the end; it is ignored
+    end = offset + (len(data) - offset) // RECORD.size * RECORD.size
+    for timestamp, plant, kind, a, b, c in RECORD.iter_unpack(memoryview(data)[offset:end]):
+        yield timestamp, plants[plant], kind, a, b, c
+
+
+def read_journal(directory):
+    for path in segments(directory):
+        yield from read_segment(path)
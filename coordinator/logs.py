@@ -0,0 +1,131 @@
+"""
+non-blocking logging: records are queued by the calling thread and formatted
+and written by a background listener, repetitive messages are rate-limited per
+call site, and state transitions are logged as structured events
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from metrics import Counter
+
+
+LOG_SUPPRESSED = Counter("psh_log_records_suppressed", "Log records dropped by the per-call-site rate limit", ["logger"])
+LOG_DROPPED = Counter("psh_log_records_dropped", "Log records dropped because the log queue was full")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per call site: a line of code may log `burst` records at
+    once and `rate` per second after that. The next record that gets through
+    carries the number suppressed in between. Events are never limited.
+    """
+
+    def __init__(self, rate=5.0, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, "event", None) is not None:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                suppressed = True
+            else:
+                bucket[0] -= 1
+                record.suppressed, bucket[2] = bucket[2], 0
+                suppressed = False
+        if suppressed:
+            LOG_SUPPRESSED.labels(record.name).inc()
+        return not suppressed
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener untouched; a full queue drops the record instead of waiting."""
+
+    def prepare(self, record):
+        # formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(logging.BASIC_FORMAT)
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if getattr(record, "suppressed", 0):
+            text += f" ({record.suppressed} similar message(s) suppressed)"
+        return text
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event is not None:
+            entry["event"] = event
+            entry.update(record.fields)
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def log_event(event, message, level=logging.INFO, **fields):
+    """Log a state transition; fields become keys of the JSON record."""
+    logging.log(level, message, extra={"event": event, "fields": fields})
+
+
+def setup_logging(level, fmt="text", rate=5.0, burst=20, queue_size=10000):
+    """Route every log record through a bounded queue to a stdout writer thread."""
+    records = queue.Queue(queue_size)
+    handler = NonBlockingQueueHandler(records)
+    if rate > 0:
+        handler.addFilter(RateLimitFilter(rate, burst))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return listener
@@ -0,0 +1,81 @@
+"""
+device map describing the plants (reservoirs) a coordinator manages, each with
+its own water level sensor, gate and pump
+"""
+
+import json
+
+from cache import PointCache
+from commands import CommandQueue
+from state import StateStore
+from stream import StateBroadcaster
+
+
+DEVICE_ROLES = ("sensor", "gate", "pump")
+
+
+class Plant:
+    """One pumped storage site and the state it shares with the HMI."""
+
+    def __init__(self, name, sensor, gate, pump):
+        self.name = name
+        self.endpoints = {"sensor": sensor, "gate": gate, "pump": pump}
+        self.clients = {}
+
+        # every flag shared between the control loop and the HMI, see state.py
+        self.state = StateStore()
+
+        self.commands = CommandQueue(name)
+        self.coils = PointCache(name)
+        self.previous_action = 0
+        self.broadcaster = StateBroadcaster()
+        self.historian = None
+
+    def device_name(self, role):
+        return f"{self.name}.{role}"
+
+    def connect(self, pool):
+        for role, endpoint in self.endpoints.items():
+            self.clients[role] = pool.add(self.device_name(role), *endpoint)
+
+    def __repr__(self):
+        return f"Plant({self.name!r})"
+
+
+def _parse_endpoint(value, default_port=502):
+    if isinstance(value, str):
+        host, _, port = value.partition(":")
+        return host, int(port) if port else default_port, 0
+    return value["host"], int(value.get("port", default_port)), int(value.get("unit", 0))
+
+
+def load_device_map(path):
+    """
+    Load plants from a JSON device map, e.g.
+
+        {"plants": [{"name": "north",
+                     "sensor": "192.168.1.3:502",
+                     "gate": {"host": "192.168.1.4", "port": 502},
+                     "pump": "192.168.1.5"}]}
+
+    An endpoint may also name the Modbus unit ID of the device, for devices
+    that share one multi-unit server (field-device/app.py):
+
+        "gate": {"host": "192.168.1.6", "port": 502, "unit": 1}
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    plants = []
+    for entry in config["plants"]:
+        missing = [role for role in DEVICE_ROLES if role not in entry]
+        if missing:
+            raise ValueError(f"plant {entry.get('name')!r} is missing {', '.join(missing)}")
+        plants.append(Plant(entry["name"], *(_parse_endpoint(entry[role]) for role in DEVICE_ROLES)))
+
+    names = [p.name for p in plants]
+    if len(set(names)) != len(names):
+        raise ValueError("plant names in the device map must be unique")
+    if not plants:
+        raise ValueError("device map does not define any plants")
+    return plants
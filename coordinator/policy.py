@@ -0,0 +1,203 @@
+"""
+the automatic control policy as a pure decision table, and a batch evaluator
+that applies a table to months of recorded inputs at once so candidate
+policies can be compared before they are deployed
+
+usage: python policy.py /var/lib/psh/history/north.history -p 2,3,1,1 -p 2,2,1,1
+"""
+
+import time
+
+import click
+
+import historian
+
+
+# what the coordinator does with the relays for each action
+OPEN_GATE_STOP_PUMP = 1
+CLOSE_GATE_START_PUMP = 2
+CLOSE_GATE_STOP_PUMP = 3
+OUTPUTS = {
+    # action: (gate open, pump on)
+    OPEN_GATE_STOP_PUMP: (1, 0),
+    CLOSE_GATE_START_PUMP: (0, 1),
+    CLOSE_GATE_STOP_PUMP: (0, 0),
+}
+DESCRIPTIONS = {
+    OPEN_GATE_STOP_PUMP: "opening gate, stopping pump",
+    CLOSE_GATE_START_PUMP: "closing gate, starting pump",
+    CLOSE_GATE_STOP_PUMP: "closing gate, stopping pump",
+}
+
+# a policy maps every input situation, indexed by is_day * 2 + water_level_high,
+# to an action: generate at day, pump at night until the upper reservoir is full
+SITUATIONS = ("(NIGHT, LOW)", "(NIGHT, HIGH)", "(DAY, ___)", "(DAY, ___)")
+DEFAULT_POLICY = (CLOSE_GATE_START_PUMP, CLOSE_GATE_STOP_PUMP, OPEN_GATE_STOP_PUMP, OPEN_GATE_STOP_PUMP)
+
+
+def situation(is_day, water_level_high):
+    return 2 * (1 if is_day else 0) + (1 if water_level_high else 0)
+
+
+def decide(is_day, water_level_high, policy=DEFAULT_POLICY):
+    return policy[situation(is_day, water_level_high)]
+
+
+def parse_policy(text):
+    """Parse a policy written as four actions, e.g. "2,3,1,1" for the default."""
+    try:
+        policy = tuple(int(action) for action in text.split(","))
+    except ValueError:
+        raise ValueError(f"policy {text!r} must be four comma-separated actions") from None
+    if len(policy) != len(SITUATIONS) or any(action not in OUTPUTS for action in policy):
+        raise ValueError(f"policy {text!r} must be four of the actions {', '.join(map(str, OUTPUTS))}, "
+                         f"for {', '.join(SITUATIONS)}")
+    return policy
+
+
+def evaluate(is_day, water_level, step=1.0, policy=DEFAULT_POLICY, threshold=None):
+    """
+    Apply a policy to equally long sequences of inputs. water_level is the
+    sensor bit, or a fill fraction compared against threshold if one is
+    given; step is the seconds each sample stands for, either one number or
+    one per sample. Uses numpy when it is installed.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return _evaluate_python(is_day, water_level, step, policy, threshold)
+
+    day = np.asarray(is_day).astype(bool)
+    level = np.asarray(water_level)
+    high = level >= threshold if threshold is not None else level.astype(bool)
+    actions = np.asarray(policy, dtype=np.int8)[day.astype(np.intp) * 2 + high]
+    outputs = np.zeros((max(OUTPUTS) + 1, 2), dtype=np.int8)
+    for action, output in OUTPUTS.items():
+        outputs[action] = output
+    gate = outputs[actions, 0]
+    pump = outputs[actions, 1]
+
+    if np.ndim(step) == 0:
+        # evenly spaced samples: counting is enough
+        hours = actions.size * step / 3600
+        pump_hours = np.count_nonzero(pump) * step / 3600
+        gate_hours = np.count_nonzero(gate) * step / 3600
+    else:
+        seconds = np.asarray(step, dtype=float)
+        hours = seconds.sum() / 3600
+        pump_hours = seconds @ pump / 3600
+        gate_hours = seconds @ gate / 3600
+
+    return {
+        "samples": int(actions.size),
+        "hours": float(hours),
+        "pump_hours": float(pump_hours),
+        "gate_hours": float(gate_hours),
+        "transitions": int(np.count_nonzero(actions[1:] != actions[:-1])),
+        "pump_starts": int(np.count_nonzero(np.diff(pump) == 1)),
+        "gate_opens": int(np.count_nonzero(np.diff(gate) == 1)),
+    }
+
+
+def _evaluate_python(is_day, water_level, step, policy, threshold):
+    steps = step if isinstance(step, (list, tuple)) else None
+    result = {"samples": 0, "hours": 0.0, "pump_hours": 0.0, "gate_hours": 0.0,
+              "transitions": 0, "pump_starts": 0, "gate_opens": 0}
+    previous = None
+    for i, (day, level) in enumerate(zip(is_day, water_level)):
+        action = decide(day, level >= threshold if threshold is not None else level, policy)
+        gate, pump = OUTPUTS[action]
+        seconds = steps[i] if steps is not None else step
+        result["samples"] += 1
+        result["hours"] += seconds / 3600
+        result["pump_hours"] += seconds / 3600 if pump else 0.0
+        result["gate_hours"] += seconds / 3600 if gate else 0.0
+        if previous is not None:
+            result["transitions"] += action != previous
+            result["pump_starts"] += pump and not OUTPUTS[previous][1]
+            result["gate_opens"] += gate and not OUTPUTS[previous][0]
+        previous = action
+    return result
+
+
+def load_history(path):
+    """
+    Read a historian file oldest sample first; returns (timestamps, is_day,
+    water_level_high, seconds per sample), as numpy arrays if available.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, record_size, capacity, next_index, count = historian.HEADER.unpack_from(data, 0)
+    if magic != historian.MAGIC or record_size != historian.RECORD.size:
+        raise ValueError(f"{path} is not a history file")
+    first = (next_index - count) % capacity
+    records = data[historian.HEADER.size:historian.HEADER.size + capacity * record_size]
+    # oldest first: from the first live record to the end of the ring, then the wrapped part
+    ordered = records[first * record_size:] + records[:first * record_size]
+    ordered = ordered[:count * record_size]
+    day_bit = 1 << historian.SIGNALS.index("timeOfDay")
+    level_bit = 1 << historian.SIGNALS.index("waterLevelHigh")
+
+    try:
+        import numpy as np
+    except ImportError:
+        timestamps, bits = [], []
+        for timestamp, state, *_ in historian.RECORD.iter_unpack(ordered):
+            timestamps.append(timestamp)
+            bits.append(state)
+        steps = [b - a for a, b in zip(timestamps, timestamps[1:])] + ([1.0] if timestamps else [])
+        return (timestamps, [1 if b & day_bit else 0 for b in bits],
+                [1 if b & level_bit else 0 for b in bits], steps)
+
+    table = np.frombuffer(ordered, dtype=np.dtype([("t", "<f8"), ("state", "<u4"), ("rtt", "<f4", 3)]))
+    timestamps = table["t"]
+    steps = np.diff(timestamps, append=timestamps[-1] + 1.0) if count else np.zeros(0)
+    return timestamps, (table["state"] & day_bit) != 0, (table["state"] & level_bit) != 0, steps
+
+
+def synthetic_history(days, step=1.0, sunrise=6.0, sunset=18.0, fill_hours=7.0):
+    """
+    Inputs for a plant that pumps at night: day between sunrise and sunset,
+    and the level sensor reading high after fill_hours of night. Needs numpy.
+    """
+    import numpy as np
+    t = np.arange(0, days * 86400, step)
+    hour = (t % 86400) / 3600
+    is_day = (hour >= sunrise) & (hour < sunset)
+    hours_into_night = (hour - sunset) % 24
+    return t, is_day, ~is_day & (hours_into_night >= fill_hours), step
+
+
+@click.command()
+@click.argument("history_file", required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option("--policy", "-p", "policies", multiple=True, help="Candidate policy as four actions for (NIGHT, LOW), (NIGHT, HIGH), (DAY, LOW), (DAY, HIGH); 1 opens the gate, 2 runs the pump, 3 stops both; may be repeated (default: 2,3,1,1)")
+@click.option("--synthetic-days", "-d", default=None, type=float, help="Evaluate this many days of synthetic 1 s samples instead of a history file (needs numpy)")
+@click.option("--schedule", "-sc", "schedule_file", default=None, type=click.Path(exists=True, dir_okay=False), help="Take day and night of the synthetic samples from this schedule file, starting now (default: 06:00-18:00)")
+def main(history_file, policies, synthetic_days, schedule_file):
+    if (history_file is None) == (synthetic_days is None):
+        raise click.UsageError("give either a history file or --synthetic-days")
+    candidates = [parse_policy(p) for p in policies] or [DEFAULT_POLICY]
+
+    start = time.perf_counter()
+    if history_file is not None:
+        _, is_day, level_high, step = load_history(history_file)
+    else:
+        t, is_day, level_high, step = synthetic_history(synthetic_days)
+        if schedule_file is not None:
+            from schedule import Schedule
+            is_day, _ = Schedule(schedule_file).lookup_many(t + time.time())
+            level_high &= ~is_day
+    click.echo(f"loaded {len(is_day)} sample(s) in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    click.echo(f"{'policy':<10} {'hours':>9} {'pump h':>9} {'gate h':>9} {'changes':>8} {'pump on':>8} {'gate on':>8} {'eval ms':>8}")
+    for policy in candidates:
+        start = time.perf_counter()
+        result = evaluate(is_day, level_high, step, policy)
+        elapsed = (time.perf_counter() - start) * 1000
+        click.echo(f"{','.join(map(str, policy)):<10} {result['hours']:>9.1f} {result['pump_hours']:>9.1f} "
+                   f"{result['gate_hours']:>9.1f} {result['transitions']:>8} {result['pump_starts']:>8} "
+                   f"{result['gate_opens']:>8} {elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+concurrent, deadline-scheduled polling of the modbus points the coordinator
+depends on
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymodbus.exceptions import ModbusException
+from pymodbus.pdu import ExceptionResponse
+
+from logs import log_event
+from metrics import Counter, Histogram
+
+
+CYCLE_DURATION = Histogram("psh_cycle_duration_seconds", "Time spent in one control cycle (poll, logic and actuation)")
+CYCLE_JITTER = Histogram("psh_cycle_jitter_seconds", "How late a control cycle started relative to its scheduled deadline")
+POLL_DURATION = Histogram("psh_poll_duration_seconds", "Time to read every due point, slowest device included")
+DEVICE_POLL_DURATION = Histogram("psh_device_poll_duration_seconds", "Time to read all due points of one device", ["device"])
+OVERRUNS = Counter("psh_cycle_overruns", "Control cycles that ran past their deadline")
+POINT_READS = Counter("psh_point_reads", "Points read from their device", ["group"])
+WAKEUPS = Counter("psh_cycle_wakeups", "Times the control loop was woken between cycles to act on a command")
+POINT_READS_SAVED = Counter("psh_point_reads_saved", "Point reads skipped compared to reading every point every cycle", ["group"])
+
+
+class PollError(Exception):
+    pass
+
+
+class PollPoint:
+    """A single bit read from a modbus device (coil or discrete input)."""
+
+    def __init__(self, name, device, client, kind, address=0x00):
+        if kind not in ("co", "di"):
+            raise ValueError(f"unsupported point kind {kind!r}")
+        self.name = name
+        self.device = device
+        self.client = client
+        self.kind = kind
+        self.address = address
+
+    def read(self):
+        try:
+            if self.kind == "co":
+                sr = self.client.read_coils(self.address)
+            else:
+                sr = self.client.read_discrete_inputs(self.address)
+        except ModbusException as e:
+            raise PollError(f"{self.name}: {e}") from e
+
+        if sr.isError():
+            raise PollError(f"{self.name}: modbus library error: {sr}")
+
+        if isinstance(sr, ExceptionResponse):
+            raise PollError(f"{self.name}: modbus error response: {sr}")
+
+        return 1 if sr.bits[0] else 0
+
+
+class PollGroup:
+    """A set of points that share a polling period."""
+
+    def __init__(self, name, period, points):
+        self.name = name
+        self.period = period
+        self.points = list(points)
+        self.next_due = 0.0
+
+    def is_due(self, now):
+        return now >= self.next_due
+
+    def mark_polled(self, now):
+        # keep a fixed rate, but never try to catch up on missed polls
+        self.next_due += self.period
+        if self.next_due <= now:
+            self.next_due = now + self.period
+
+
+class PollScheduler:
+    """
+    Runs a fixed-rate cycle of `period` seconds. On every tick the points of
+    all due poll groups are read concurrently (one task per device, so points
+    on the same device are never read in parallel) and the results are handed to
+    the cycle callback. Ticks are scheduled against absolute deadlines; a cycle
+    that runs past its deadline is reported as an overrun and the schedule
+    skips ahead instead of drifting.
+
+    Between due polls a point is still read if it was requested with
+    request_read(), if it is stale, or if its device has been reconnected
+    since the point was last read.
+
+    wake() interrupts the wait for the next tick to run the on_wake callback
+    right away, on the scheduler's thread so it never overlaps a cycle; the
+    tick schedule itself is unaffected. expedite() instead starts the next
+    cycle at once and schedules the following ones from there, for when a
+    device has just been (re)connected and its points can be fresh again.
+    """
+
+    def __init__(self, period, groups, max_workers=None):
+        self.period = period
+        self.groups = list(groups)
+        self.overruns = 0
+        self.cycles = 0
+        self.last_cycle_duration = 0.0
+        self.device_rtt = {}
+        self.cycle_rtt = {}
+        self.stale = set()
+        self.reads_saved = 0
+        self._requested = set()
+        self._outages_seen = {}
+
+        devices = {p.device for g in self.groups for p in g.points}
+        if max_workers is None:
+            max_workers = max(1, len(devices))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="poll")
+        self._running = False
+        self._wake = threading.Event()
+        self._expedite = False
+
+    def _read_device(self, points):
+        start = time.monotonic()
+        values = {p.name: p.read() for p in points}
+        rtt = time.monotonic() - start
+        DEVICE_POLL_DURATION.labels(points[0].device).observe(rtt)
+        return values, rtt
+
+    def poll(self, now=None):
+        """
+        Read every point of every due group; returns {point name: value}.
+        Points that could not be read are left out and tracked in self.stale.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        requested, self._requested = self._requested, set()
+        by_device = {}
+        for group in self.groups:
+            if group.is_due(now):
+                points = group.points
+                group.mark_polled(now)
+            else:
+                points = [p for p in group.points if p.name in requested or p.name in self.stale
+                          or self._outages_seen.get(p.name) != p.client.outages]
+            for point in points:
+                by_device.setdefault(point.device, []).append(point)
+            POINT_READS.labels(group.name).inc(len(points))
+            POINT_READS_SAVED.labels(group.name).inc(len(group.points) - len(points))
+            self.reads_saved += len(group.points) - len(points)
+
+        start = time.monotonic()
+        futures = [self._executor.submit(self._read_device, points) for points in by_device.values()]
+
+        # a failed device only makes its own points stale; the cycle goes on
+        results = {}
+        self.cycle_rtt = {}
+        for (device, points), future in zip(by_device.items(), futures):
+            try:
+                values, rtt = future.result()
+            except PollError as e:
+                for p in points:
+                    if p.name not in self.stale:
+                        log_event("stale", f"marking {p.name} stale: {e}", logging.WARNING, point=p.name,
+                                  device=device, error=str(e))
+                    self.stale.add(p.name)
+                continue
+            results.update(values)
+            self.device_rtt[device] = rtt
+            self.cycle_rtt[device] = rtt
+            for p in points:
+                self._outages_seen[p.name] = p.client.outages
+                if p.name in self.stale:
+                    log_event("fresh", f"{p.name} is fresh again", point=p.name, device=device)
+                    self.stale.discard(p.name)
+
+        POLL_DURATION.observe(time.monotonic() - start)
+        return results
+
+    def request_read(self, names):
+        """Read the named points on the next cycle even if their group is not due."""
+        self._requested.update(names)
+
+    def dispatch(self, fn, items):
+        """Run fn over items on the polling workers and wait for all of them."""
+        futures = [self._executor.submit(fn, item) for item in items]
+        return [f.result() for f in futures]
+
+    def wake(self):
+        self._wake.set()
+
+    def expedite(self):
+        self._expedite = True
+        self._wake.set()
+
+    def run(self, on_cycle, on_wake=None):
+        self._running = True
+        deadline = time.monotonic()
+        while self._running:
+            cycle_start = time.monotonic()
+            CYCLE_JITTER.observe(max(0.0, cycle_start - deadline))
+            on_cycle(self.poll(cycle_start))
+            self.cycles += 1
+
+            now = time.monotonic()
+            self.last_cycle_duration = now - cycle_start
+            CYCLE_DURATION.observe(self.last_cycle_duration)
+            deadline += self.period
+            if now > deadline:
+                late = now - deadline
+                skipped = int(late // self.period) + 1
+                self.overruns += 1
+                OVERRUNS.inc()
+                logging.warning(f"control cycle overran its deadline by {late * 1000:.1f} ms "
+                                f"(cycle took {self.last_cycle_duration * 1000:.1f} ms, "
+                                f"period {self.period * 1000:.0f} ms); skipping {skipped} tick(s), "
+                                f"{self.overruns} overrun(s) so far")
+                deadline += skipped * self.period
+
+            # sleep until the next tick, acting on any wake() in the meantime
+            while self._running and self._wake.wait(max(0.0, deadline - time.monotonic())):
+                self._wake.clear()
+                if self._expedite:
+                    self._expedite = False
+                    deadline = time.monotonic()
+                    break
+                if on_wake is not None and self._running:
+                    WAKEUPS.inc()
+                    on_wake()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def shutdown(self):
+        self.stop()
+        self._executor.shutdown(wait=False)
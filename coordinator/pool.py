@@ -0,0 +1,207 @@
+"""
+managed modbus/TCP connections that reconnect in the background instead of
+taking the coordinator down with them
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusException, ModbusIOException
+
+from logs import log_event
+from metrics import Counter, Histogram
+
+
+MODBUS_RTT = Histogram("psh_modbus_request_duration_seconds", "Round trip time of Modbus requests", ["device", "function"])
+MODBUS_ERRORS = Counter("psh_modbus_errors", "Failed Modbus requests", ["device", "reason"])
+COIL_WRITES = Counter("psh_coil_writes", "Coil writes sent to a device", ["device"])
+RECONNECTS = Counter("psh_device_reconnects", "Successful reconnects after a device was lost", ["device"])
+
+
+class DeviceUnavailable(ConnectionException):
+    pass
+
+
+class ManagedClient:
+    """
+    Wraps the ModbusTcpClient of one device. Requests fail fast with
+    DeviceUnavailable while the device is down, so a dead device never costs
+    the control loop a connect timeout; the pool reconnects it in the
+    background. The only wait is for the pool's first connection attempt, so
+    a request made right after startup does not fail just because the
+    connection was still being set up.
+    """
+
+    def __init__(self, pool, name, host, port, timeout, unit=0):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.client = ModbusTcpClient(host, port=port, timeout=timeout, retries=0)
+        self.connected = False
+        self.down_since = time.monotonic()
+        self.backoff = 0.0
+        self.next_attempt = 0.0
+        self.attempts = 0
+        self.pending = False
+        self.outages = 0
+        self.last_outage = None
+        self.first_attempt = threading.Event()
+        self._pool = pool
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args):
+        if not self.connected and not self.first_attempt.is_set():
+            self.first_attempt.wait(self._pool.timeout)
+        if not self.connected:
+            MODBUS_ERRORS.labels(self.name, "unavailable").inc()
+            raise DeviceUnavailable(f"{self.name} is not connected (reconnecting in the background)")
+        error = None
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                response = getattr(self.client, method)(*args, slave=self.unit)
+            except ModbusException as e:
+                error = e
+            MODBUS_RTT.labels(self.name, method).observe(time.perf_counter() - start)
+        if error is not None:
+            MODBUS_ERRORS.labels(self.name, "exception").inc()
+            self._pool.mark_down(self, error)
+            raise error
+        if isinstance(response, ModbusIOException):
+            MODBUS_ERRORS.labels(self.name, "io").inc()
+            self._pool.mark_down(self, response)
+        elif response.isError():
+            MODBUS_ERRORS.labels(self.name, "response").inc()
+        return response
+
+    def read_coils(self, address, count=1):
+        return self._call("read_coils", address, count)
+
+    def read_discrete_inputs(self, address, count=1):
+        return self._call("read_discrete_inputs", address, count)
+
+    def write_coil(self, address, value):
+        COIL_WRITES.labels(self.name).inc()
+        return self._call("write_coil", address, value)
+
+    def close(self):
+        with self._lock:
+            self.client.close()
+
+
+class ConnectionPool:
+    """
+    One ManagedClient per device plus a single reconnect thread that brings
+    failed devices back with bounded exponential backoff. on_connect, if
+    set, is called with every device that has just been (re)connected.
+    """
+
+    def __init__(self, timeout=0.5, min_backoff=0.05, max_backoff=5.0, reconnect_workers=8):
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.devices = {}
+        self.on_connect = None
+        self._reconnect_workers = reconnect_workers
+        self._wake = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._executor = None
+
+    def add(self, name, host, port, unit=0):
+        device = ManagedClient(self, name, host, port, self.timeout, unit)
+        self.devices[name] = device
+        return device
+
+    def start(self):
+        self._running = True
+        self._executor = ThreadPoolExecutor(max_workers=self._reconnect_workers, thread_name_prefix="reconnect")
+        self._thread = threading.Thread(target=self._reconnect_loop, name="reconnect", daemon=True)
+        self._thread.start()
+
+    def wait_connected(self, timeout):
+        """Wait up to timeout seconds for every device; returns the names still down."""
+        deadline = time.monotonic() + timeout
+        with self._wake:
+            while True:
+                down = [d.name for d in self.devices.values() if not d.connected]
+                remaining = deadline - time.monotonic()
+                if not down or remaining <= 0:
+                    return down
+                self._wake.wait(remaining)
+
+    def mark_down(self, device, error):
+        with self._wake:
+            if not device.connected:
+                return
+            device.connected = False
+            device.down_since = time.monotonic()
+            device.backoff = 0.0
+            device.next_attempt = 0.0
+            device.attempts = 0
+            device.outages += 1
+            # no reconnect attempt until the broken socket is closed, or closing it could close the new one
+            device.pending = True
+            self._wake.notify_all()
+        log_event("device_down", f"lost connection to {device.name} ({device.host}:{device.port}): {error}",
+                  logging.ERROR, device=device.name, error=str(error))
+        device.close()
+        with self._wake:
+            device.pending = False
+            self._wake.notify_all()
+
+    def _attempt(self, device):
+        device.attempts += 1
+        ok = device.client.connect()
+
+        with self._wake:
+            now = time.monotonic()
+            if ok:
+                device.connected = True
+                device.last_outage = now - device.down_since
+                if device.outages:
+                    RECONNECTS.labels(device.name).inc()
+                    log_event("device_up", f"reconnected to {device.name} after {device.last_outage * 1000:.0f} ms "
+                              f"({device.attempts} attempt(s))", logging.WARNING, device=device.name,
+                              outage=device.last_outage, attempts=device.attempts)
+                else:
+                    logging.info(f"connected to {device.name} ({device.host}:{device.port})")
+            else:
+                device.backoff = min(self.max_backoff, max(self.min_backoff, device.backoff * 2))
+                device.next_attempt = now + device.backoff
+                logging.debug(f"connection attempt {device.attempts} to {device.name} failed, "
+                              f"retrying in {device.backoff:.2f} s")
+            device.pending = False
+            device.first_attempt.set()
+            self._wake.notify_all()
+        if ok and self.on_connect is not None:
+            self.on_connect(device)
+
+    def _reconnect_loop(self):
+        with self._wake:
+            while self._running:
+                now = time.monotonic()
+                wait = None
+                for device in self.devices.values():
+                    if device.connected or device.pending:
+                        continue
+                    if device.next_attempt <= now:
+                        device.pending = True
+                        self._executor.submit(self._attempt, device)
+                    else:
+                        delay = device.next_attempt - now
+                        wait = delay if wait is None else min(wait, delay)
+                self._wake.wait(wait)
+
+    def close(self):
+        with self._wake:
+            self._running = False
+            self._wake.notify_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for device in self.devices.values():
+            device.close()
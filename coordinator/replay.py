@@ -0,0 +1,169 @@
+"""
+replays an event journal through the coordinator's control logic, as fast as
+it will go or at a chosen multiple of real time, and compares the coil writes
+the logic makes now with the ones that were recorded
+
+usage: python replay.py /var/lib/psh/journal --plant north --check
+"""
+
+import datetime as dt
+import json
+import logging
+import time
+
+import click
+
+import app
+import journal
+import policy
+from plants import Plant
+from state import ANY_STALE, DAY, LEVEL_HIGH, MANUAL, enter_manual
+
+
+class _Acknowledged:
+    def isError(self):
+        return False
+
+
+class ReplayClient:
+    """Stands in for a device's ManagedClient; every write is acknowledged and kept."""
+
+    def __init__(self, replay, coil):
+        self._replay = replay
+        self._coil = coil
+
+    def write_coil(self, address, value):
+        self._replay.writes.append((self._replay.now, self._coil, value))
+        return _Acknowledged()
+
+
+class PlantReplay:
+    def __init__(self, name):
+        self.plant = Plant(name, None, None, None)
+        self.plant.clients = {
+            "gate": ReplayClient(self, journal.COIL_GATE),
+            "pump": ReplayClient(self, journal.COIL_PUMP),
+        }
+        self.now = 0.0
+        self.records = 0
+        self.decisions = 0
+        self.writes = []
+        self.recorded = []
+
+    def cycle(self):
+        # the inputs only change between records, so one cycle per record is
+        # enough to reproduce every decision the live loop made
+        app.run_plant_logic(self.plant)
+        self.decisions += 1
+
+    def apply(self, timestamp, kind, a, b, c):
+        self.now = timestamp
+        self.records += 1
+        plant = self.plant
+        if kind == journal.INPUT:
+            # the journal only records whether anything was stale, which is all the logic looks at
+            plant.state.update(DAY | LEVEL_HIGH | ANY_STALE,
+                               (DAY if a else 0) | (LEVEL_HIGH if b else 0) | (ANY_STALE if c else 0))
+            self.cycle()
+        elif kind == journal.MANUAL:
+            if a == journal.MANUAL_MODE and b:
+                # what /manual does when switching to manual mode
+                if not plant.state.is_set(MANUAL):
+                    plant.commands.discard()
+                plant.state.apply(enter_manual)
+            elif a == journal.MANUAL_MODE:
+                if plant.state.is_set(MANUAL):
+                    plant.commands.discard()
+                plant.state.put(MANUAL, 0)
+            else:
+                plant.commands.submit("gate" if a == journal.MANUAL_GATE else "pump", b)
+            self.cycle()
+        elif kind == journal.COIL:
+            self.recorded.append((timestamp, a, b))
+
+    def divergence(self):
+        """The first replayed write that differs from the recording, if any."""
+        for i, (replayed, recorded) in enumerate(zip(self.writes, self.recorded)):
+            if replayed[1:] != recorded[1:]:
+                return i, recorded, replayed
+        if len(self.writes) != len(self.recorded):
+            i = min(len(self.writes), len(self.recorded))
+            return (i, self.recorded[i] if i < len(self.recorded) else None,
+                    self.writes[i] if i < len(self.writes) else None)
+        return None
+
+
+def _describe(write):
+    if write is None:
+        return "nothing"
+    timestamp, coil, value = write
+    name = "gate" if coil == journal.COIL_GATE else "pump"
+    return f"{name}={value} at {dt.datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')}"
+
+
+@click.command()
+@click.argument("journal_dir", type=click.Path(exists=True, file_okay=False))
+@click.option("--plant", "-p", "plant_names", multiple=True, help="Only replay this plant; may be repeated (default: every plant in the journal)")
+@click.option("--start", "-s", default=None, type=click.DateTime(), help="Skip records before this local time")
+@click.option("--end", "-e", default=None, type=click.DateTime(), help="Stop at this local time")
+@click.option("--speed", "-x", default=0.0, help="Multiple of real time to replay at, 0 for as fast as possible (default: 0)")
+@click.option("--policy", "-po", "control_policy", default=None, help="Replay with this candidate policy instead of the default, e.g. 2,3,1,1 (see policy.py)")
+@click.option("--check", is_flag=True, help="Exit with status 1 if the replayed coil writes differ from the recorded ones")
+@click.option("--log", "-l", default="warning", help="The log level of the replayed control logic (default: WARNING)")
+def main(journal_dir, plant_names, start, end, speed, control_policy, check, log):
+    logging.basicConfig(level=getattr(logging, log.upper()))
+    if control_policy is not None:
+        app.control_policy = policy.parse_policy(control_policy)
+    start = start.timestamp() if start is not None else None
+    end = end.timestamp() if end is not None else None
+
+    replays = {}
+    first = last = None
+    wall_start = time.perf_counter()
+    for timestamp, name, kind, a, b, c in journal.read_journal(journal_dir):
+        if (plant_names and name not in plant_names) or (start is not None and timestamp < start):
+            continue
+        if end is not None and timestamp > end:
+            break
+        if first is None:
+            first = timestamp
+        last = timestamp
+        if speed > 0:
+            delay = (timestamp - first) / speed - (time.perf_counter() - wall_start)
+            if delay > 0:
+                time.sleep(delay)
+        replay = replays.get(name)
+        if replay is None:
+            replay = replays[name] = PlantReplay(name)
+        replay.apply(timestamp, kind, a, b, c)
+    wall = time.perf_counter() - wall_start
+
+    span = (last - first) if first is not None else 0.0
+    summary = {
+        "journal_seconds": span,
+        "replay_seconds": wall,
+        "speedup": span / wall if wall > 0 else None,
+        "plants": {},
+    }
+    diverged = False
+    for name, replay in replays.items():
+        result = {
+            "records": replay.records,
+            "decisions": replay.decisions,
+            "recorded_writes": len(replay.recorded),
+            "replayed_writes": len(replay.writes),
+        }
+        divergence = replay.divergence()
+        if divergence is not None:
+            diverged = True
+            index, recorded, replayed = divergence
+            result["first_divergence"] = {"write": index, "recorded": _describe(recorded), "replayed": _describe(replayed)}
+        summary["plants"][name] = result
+    click.echo(json.dumps(summary, indent=2))
+
+    if check and diverged:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
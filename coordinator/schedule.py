@@ -0,0 +1,254 @@
+"""
+calendar of day/night and tariff windows, loaded from a JSON schedule file and
+precomputed into a sorted interval index for O(log n) lookups
+
+a schedule file looks like
+
+    {
+        "timezone": "Europe/Berlin",
+        "sun": [{"date": "01-01", "sunrise": "08:17", "sunset": "16:02"},
+                {"date": "06-21", "sunrise": "04:43", "sunset": "21:33"}],
+        "tariffs": [
+            {"name": "evening-peak", "days": ["mon", "tue", "wed", "thu", "fri"],
+             "start": "17:00", "end": "21:00", "price": 0.41, "day": true},
+            {"name": "off-peak", "start": "00:00", "end": "24:00", "price": 0.12}
+        ],
+        "holidays": ["2026-12-25", "2026-12-26"]
+    }
+
+sunrise and sunset are interpolated linearly between the dated entries (a
+single entry applies all year). the first tariff band that covers a moment
+wins; bands apply to the listed days, where "hol" stands for the holidays
+(which then count as no weekday), or to every day if "days" is left out. a
+band with "day" overrides the sun while it is active, e.g. to keep
+generating through an evening price peak
+"""
+
+import bisect
+import datetime as dt
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import click
+
+from metrics import Counter, Gauge
+
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+HORIZON_DAYS = 400
+
+SCHEDULE_RELOADS = Counter("psh_schedule_reloads", "Schedule file reloads", ["result"])
+TARIFF_PRICE = Gauge("psh_tariff_price", "Price of the tariff band currently in force")
+
+
+def _minutes(text):
+    hours, _, minutes = text.partition(":")
+    value = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= value <= 24 * 60:
+        raise ValueError(f"time of day {text!r} is out of range")
+    return value
+
+
+class Window:
+    """The state in force from `start` until the next window begins."""
+
+    __slots__ = ("start", "is_day", "tariff", "price", "holiday")
+
+    def __init__(self, start, is_day, tariff, price, holiday):
+        self.start = start
+        self.is_day = is_day
+        self.tariff = tariff
+        self.price = price
+        self.holiday = holiday
+
+    def same_state(self, other):
+        return (self.is_day, self.tariff, self.price, self.holiday) == (other.is_day, other.tariff, other.price, other.holiday)
+
+    def __repr__(self):
+        return (f"Window({dt.datetime.fromtimestamp(self.start).isoformat(timespec='minutes')}, "
+                f"{'day' if self.is_day else 'night'}, {self.tariff}, {self.price})")
+
+
+class ScheduleConfig:
+    def __init__(self, config):
+        tz = config.get("timezone")
+        if tz is not None:
+            from zoneinfo import ZoneInfo
+            self.tz = ZoneInfo(tz)
+        else:
+            self.tz = None
+
+        sun = config.get("sun") or [{"date": "01-01", "sunrise": "06:00", "sunset": "18:00"}]
+        self.sun = sorted((dt.date(2001, *map(int, entry["date"].split("-"))).timetuple().tm_yday,
+                           _minutes(entry["sunrise"]), _minutes(entry["sunset"])) for entry in sun)
+
+        self.tariffs = []
+        for band in config.get("tariffs", []):
+            days = tuple(band.get("days", WEEKDAYS + ("hol",)))
+            unknown = [d for d in days if d not in WEEKDAYS + ("hol",)]
+            if unknown:
+                raise ValueError(f"tariff {band.get('name')!r} has unknown day(s) {', '.join(unknown)}")
+            self.tariffs.append((band.get("name", "unnamed"), days, _minutes(band["start"]), _minutes(band["end"]),
+                                 float(band.get("price", 0.0)), band.get("day")))
+
+        self.holidays = {dt.date.fromisoformat(day) for day in config.get("holidays", [])}
+
+    def sun_times(self, date):
+        """
+        Sunrise and sunset of a date in whole minutes after midnight,
+        interpolated by day of year; rounded here so window boundaries and
+        state() agree on when the day starts.
+        """
+        if len(self.sun) == 1:
+            return self.sun[0][1:]
+        day = min(date.timetuple().tm_yday, 365)
+        days = [entry[0] for entry in self.sun]
+        i = bisect.bisect_right(days, day)
+        before = self.sun[i - 1] if i > 0 else (self.sun[-1][0] - 365,) + self.sun[-1][1:]
+        after = self.sun[i] if i < len(self.sun) else (self.sun[0][0] + 365,) + self.sun[0][1:]
+        share = (day - before[0]) / (after[0] - before[0])
+        return tuple(round(b + (a - b) * share) for b, a in zip(before[1:], after[1:]))
+
+    def epoch(self, date, minutes):
+        # minutes are wall clock time, so windows stay on the clock across DST changes
+        moment = dt.datetime(date.year, date.month, date.day) + dt.timedelta(minutes=minutes)
+        if self.tz is None:
+            return moment.timestamp()
+        return moment.replace(tzinfo=self.tz).timestamp()
+
+    def state(self, date, minutes):
+        holiday = date in self.holidays
+        day_type = "hol" if holiday else WEEKDAYS[date.weekday()]
+        sunrise, sunset = self.sun_times(date)
+        is_day = sunrise <= minutes < sunset
+        for name, days, start, end, price, day in self.tariffs:
+            if day_type in days and start <= minutes < end:
+                return (day if day is not None else is_day), name, price, holiday
+        return is_day, None, 0.0, holiday
+
+    def windows(self, first_day, days):
+        """Windows covering `days` whole days from first_day, merged where nothing changes."""
+        windows = []
+        for offset in range(days):
+            date = first_day + dt.timedelta(days=offset)
+            sunrise, sunset = self.sun_times(date)
+            boundaries = {0, sunrise, sunset}
+            for _, _, start, end, _, _ in self.tariffs:
+                boundaries.update((start, end))
+            for minutes in sorted(b for b in boundaries if b < 24 * 60):
+                window = Window(self.epoch(date, minutes), *self.state(date, minutes))
+                if not windows or not windows[-1].same_state(window):
+                    windows.append(window)
+        return windows
+
+
+class Schedule:
+    """
+    Day/night and tariff lookups against a precomputed index of windows
+    starting a day before the load and reaching HORIZON_DAYS ahead. The
+    index is rebuilt when a lookup falls outside it, and when the file
+    changes (checked at most every `reload_interval` seconds); a file that
+    fails to load leaves the previous index in place.
+    """
+
+    def __init__(self, path, reload_interval=5.0):
+        self.path = Path(path)
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._mtime = os.stat(self.path).st_mtime
+        self._config = self._load()
+        self._index = self._build(time.time())
+        self._current = None
+
+    def _load(self):
+        with open(self.path) as f:
+            return ScheduleConfig(json.load(f))
+
+    def _build(self, around):
+        first_day = dt.date.fromtimestamp(around) - dt.timedelta(days=1)
+        windows = self._config.windows(first_day, HORIZON_DAYS + 1)
+        end = self._config.epoch(first_day + dt.timedelta(days=HORIZON_DAYS + 1), 0)
+        logging.info(f"indexed {len(windows)} schedule window(s) from {first_day} over {HORIZON_DAYS} day(s)")
+        return [w.start for w in windows], windows, end
+
+    def maybe_reload(self, now=None):
+        now = time.monotonic() if now is None else now
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.reload_interval
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return False
+            config = self._load()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            SCHEDULE_RELOADS.labels("error").inc()
+            logging.error(f"could not reload schedule {self.path}, keeping the previous one: {e}")
+            return False
+        with self._lock:
+            self._mtime = mtime
+            self._config = config
+            self._index = self._build(time.time())
+        SCHEDULE_RELOADS.labels("ok").inc()
+        logging.warning(f"reloaded schedule {self.path}")
+        return True
+
+    def lookup(self, t):
+        starts, windows, end = self._index
+        if not starts[0] <= t < end:
+            with self._lock:
+                self._index = self._build(t)
+                starts, windows, end = self._index
+        return windows[bisect.bisect_right(starts, t) - 1]
+
+    def is_day(self, t=None):
+        window = self.lookup(time.time() if t is None else t)
+        if window is not self._current:
+            self._current = window
+            TARIFF_PRICE.set(window.price)
+        return window.is_day
+
+    def lookup_many(self, timestamps):
+        """
+        (is_day, price) for every timestamp, as numpy arrays when numpy is
+        installed; used to feed simulations and policy.evaluate().
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            windows = [self.lookup(t) for t in timestamps]
+            return [w.is_day for w in windows], [w.price for w in windows]
+
+        timestamps = np.asarray(timestamps, dtype=float)
+        if not timestamps.size:
+            return np.zeros(0, dtype=bool), np.zeros(0)
+        first_day = dt.date.fromtimestamp(timestamps.min()) - dt.timedelta(days=1)
+        days = (dt.date.fromtimestamp(timestamps.max()) - first_day).days + 2
+        windows = self._config.windows(first_day, days)
+        starts = np.array([w.start for w in windows])
+        index = np.searchsorted(starts, timestamps, side="right") - 1
+        return (np.array([w.is_day for w in windows], dtype=bool)[index],
+                np.array([w.price for w in windows])[index])
+
+
+@click.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--date", "-d", default=None, type=click.DateTime(["%Y-%m-%d"]), help="Day to list the windows of (default: today)")
+def main(path, date):
+    """Check a schedule file by listing the windows of one day."""
+    logging.basicConfig(level=logging.WARNING)
+    config = Schedule(path)._config
+    day = (date or dt.datetime.now()).date()
+    for window in config.windows(day, 1):
+        start = dt.datetime.fromtimestamp(window.start, config.tz).strftime("%H:%M")
+        click.echo(f"{start}  {'day  ' if window.is_day else 'night'}  {window.tariff or '-':<16} "
+                   f"{window.price:>8.4f}{'  holiday' if window.holiday else ''}")
+
+
+if __name__ == "__main__":
+    main()
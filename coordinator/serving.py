@@ -0,0 +1,175 @@
+"""
+in-memory, precompressed serving of the built HMI bundle
+"""
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from pathlib import Path
+
+from metrics import Counter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# create-react-app puts a content hash in every file name under static/
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/manifest+json")
+MIN_COMPRESS_SIZE = 256
+
+STATIC_REQUESTS = Counter("psh_hmi_static_requests", "HMI asset requests served from memory", ["encoding", "status"])
+
+ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header value matches etag: "*", or one of the
+    listed entity tags. As If-None-Match asks for, the comparison is weak:
+    W/"x" matches "x".
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(match.group(1) == etag for match in ENTITY_TAG.finditer(if_none_match))
+
+
+class StaticAsset:
+    def __init__(self, path, body):
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.content_type.startswith("text/") or self.content_type == "application/javascript":
+            self.content_type += "; charset=utf-8"
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        if HASHED_NAME.search(path.name):
+            self.cache_control = "public, max-age=31536000, immutable"
+        else:
+            self.cache_control = "no-cache"
+
+        # keep only the encodings that actually make the asset smaller
+        self.variants = {"identity": body}
+        if len(body) >= MIN_COMPRESS_SIZE and self.content_type.startswith(COMPRESSIBLE):
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    self.variants["br"] = compressed
+
+    def select(self, accept_encoding):
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accept_encoding:
+                return encoding, self.variants[encoding]
+        return "identity", self.variants["identity"]
+
+
+class StaticBundle:
+    """Every file of the HMI build, loaded and compressed once at startup."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.assets = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = Path(dirpath) / filename
+                url = "/" + path.relative_to(self.root).as_posix()
+                self.assets[url] = StaticAsset(path, path.read_bytes())
+        if "/index.html" in self.assets:
+            self.assets["/"] = self.assets["/index.html"]
+
+        size = sum(len(a.variants["identity"]) for a in self.assets.values())
+        logging.info(f"loaded {len(self.assets)} HMI asset(s) ({size / 1024:.0f} KiB) from {self.root}"
+                     f"{'' if brotli is not None else ' (brotli not installed, gzip only)'}")
+
+    def lookup(self, path):
+        return self.assets.get(path)
+
+
+class StaticBundleMiddleware:
+    """
+    Answers GET/HEAD requests for bundle files straight from memory, before
+    they reach Flask; everything else is passed to the wrapped application.
+    Until a bundle is set (see load()), every request is passed on.
+    """
+
+    def __init__(self, app, bundle=None):
+        self.app = app
+        self.bundle = bundle
+
+    def load(self, root):
+        """Load the bundle at root and start serving it; meant to run on a background thread."""
+        self.bundle = StaticBundle(root)
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        bundle = self.bundle
+        asset = bundle.lookup(environ.get("PATH_INFO", "/")) if bundle is not None and method in ("GET", "HEAD") else None
+        if asset is None:
+            return self.app(environ, start_response)
+
+        headers = [
+            ("ETag", asset.etag),
+            ("Cache-Control", asset.cache_control),
+            ("Vary", "Accept-Encoding"),
+        ]
+        if etag_matches(environ.get("HTTP_IF_NONE_MATCH"), asset.etag):
+            STATIC_REQUESTS.labels("identity", "304").inc()
+            headers.append(("Content-Length", "0"))
+            start_response("304 Not Modified", headers)
+            return []
+
+        encoding, body = asset.select(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        headers.append(("Content-Type", asset.content_type))
+        headers.append(("Content-Length", str(len(body))))
+        if encoding != "identity":
+            headers.append(("Content-Encoding", encoding))
+        STATIC_REQUESTS.labels(encoding, "200").inc()
+        start_response("200 OK", headers)
+        return [b"" if method == "HEAD" else body]
+
+
+def _keep_alive_channel():
+    """
+    A waitress channel that keeps HTTP/1.1 connections open after 1xx, 204
+    and 304 responses. waitress closes the connection after any response
+    without a Content-Length, but these cannot have a body and end at their
+    headers; closing would make every conditional poll of /update that comes
+    back 304 reconnect.
+    """
+    from waitress.channel import HTTPChannel
+    from waitress.task import WSGITask
+
+    class KeepAliveTask(WSGITask):
+        def set_close_on_finish(self):
+            if (self.version == "1.1" and not self.has_body and not self.wrote_header
+                    and self.request.headers.get("CONNECTION", "").lower() != "close"):
+                return
+            super().set_close_on_finish()
+
+    class KeepAliveChannel(HTTPChannel):
+        task_class = KeepAliveTask
+
+    return KeepAliveChannel
+
+
+def serve_hmi(app, host, port, server="waitress", threads=32):
+    """Run the HMI under waitress if it is installed, otherwise the development server."""
+    if server == "waitress":
+        try:
+            import waitress
+        except ImportError:
+            logging.warning("waitress is not installed, falling back to the Flask development server")
+        else:
+            logging.info(f"serving HMI with waitress at {host}:{port} ({threads} threads)")
+            server = waitress.create_server(app, host=host, port=port, threads=threads, ident="coordinator")
+            server.channel_class = _keep_alive_channel()
+            server.run()
+            return
+    app.run(host=host, port=port, threaded=True)
@@ -0,0 +1,44 @@
+"""
+client for the plant simulator (plant-simulator/app.py), used to take day and
+night from the simulated clock when the plant runs faster than real time
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+
+
+class SimulatedDaylight:
+    def __init__(self, address, timeout=0.2):
+        host, _, port = address.partition(":")
+        self._address = (host, int(port) if port else 5020)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._last = False
+
+    def _get(self):
+        # the reply echoes the request's sequence number; drop late replies to earlier requests
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        self._sock.sendto(f"{self._seq} get".encode(), self._address)
+        deadline = time.monotonic() + self._timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("timed out")
+            self._sock.settimeout(remaining)
+            reply = json.loads(self._sock.recv(512))
+            if reply.get("seq") == self._seq:
+                return reply
+
+    def is_day(self):
+        # keep the previous answer if the simulator does not reply in time
+        with self._lock:
+            try:
+                self._last = bool(self._get()["day"])
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"could not read the simulated clock: {e}")
+        return self._last
@@ -0,0 +1,296 @@
+"""
+hot standby for the coordinator: two instances on one host meet on an
+abstract unix socket; the one holding the listening socket is active and
+drives the plant, the other follows its state and takes over when the active
+goes away or stops renewing its lease
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+
+from logs import log_event
+from metrics import Counter, Gauge
+from state import GATE_OPEN, MANUAL, PUMP_ON, TARGETS
+
+
+ACTIVE = Gauge("psh_coordinator_active", "1 while this coordinator drives the plant, 0 while it is the standby")
+FAILOVERS = Counter("psh_failovers", "Times this coordinator took over from the active one")
+FAILOVER_DURATION = Gauge("psh_failover_seconds", "Seconds from noticing the active coordinator was gone to the end of the first cycle this one drove")
+
+# what the active is the authority on; the standby polls the inputs itself
+REPLICATED = MANUAL | TARGETS | GATE_OPEN | PUMP_ON
+
+
+class Replicator:
+    """
+    Active/standby pair of coordinators. Binding the abstract socket `name`
+    decides who is active: the kernel lets only one process hold it and
+    frees it the moment that process dies, so the standby, finding its
+    connection closed, can take over as soon as it manages to bind it.
+
+    The active sends the replicated state bits and last action of every plant
+    as a JSON line at least every lease / 4 and after every cycle, each with
+    a lease: the time (on the host's monotonic clock) until which the standby
+    promises not to act. A standby that hears nothing past the lease assumes
+    the active is hung, tells it so and takes over; an active whose lease ran
+    out while a standby was following steps down for good, so the two never
+    drive the plant at once.
+    """
+
+    def __init__(self, name, plants, lease=0.5):
+        self.address = "\0" + name
+        self.plants = {plant.name: plant for plant in plants}
+        self.lease = lease
+        self.grace = lease / 10
+        self.active = False
+        self.on_promote = None
+        self.failover_started = None
+        self._lease_until = 0.0
+        self._peer = None
+        self._listener = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._running = False
+
+    def start(self):
+        self._running = True
+        if self._bind():
+            logging.info(f"active coordinator on replication socket {self.address[1:]!r}")
+            self._become_active()
+        else:
+            logging.info(f"another coordinator is active on {self.address[1:]!r}, following it as the standby")
+            ACTIVE.set(0)
+            threading.Thread(target=self._follow, name="standby", daemon=True).start()
+
+    def _bind(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.address)
+        except OSError:
+            listener.close()
+            return False
+        listener.listen(1)
+        self._listener = listener
+        threading.Thread(target=self._accept, args=(listener,), name="replication", daemon=True).start()
+        return True
+
+    # active side
+
+    def _become_active(self):
+        self.active = True
+        ACTIVE.set(1)
+        threading.Thread(target=self._heartbeat, name="heartbeat", daemon=True).start()
+        if self._listener is None:
+            threading.Thread(target=self._rebind, name="rebind", daemon=True).start()
+
+    def _rebind(self):
+        # a hung active still holds the socket and lets go of it once it resumes and
+        # notices its lease is gone; one that sends its state when connected to is
+        # alive and driving the plant, and holding the socket it wins
+        while self._running and self.active and not self._bind():
+            if self._holder_alive():
+                self._step_down("another coordinator holds the replication socket")
+                return
+            time.sleep(self.grace)
+
+    def _holder_alive(self):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+                conn.settimeout(self.lease)
+                conn.connect(self.address)
+                return conn.recv(1) != b""
+        except OSError:
+            return False
+
+    def _accept(self, listener):
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with self._lock:
+                previous, self._peer = self._peer, conn
+                self._lease_until = time.monotonic() + self.lease
+            if previous is not None:
+                previous.close()
+            log_event("standby", "a standby coordinator is following this one")
+            self.publish()
+            threading.Thread(target=self._watch_peer, args=(conn,), name="replication-peer", daemon=True).start()
+
+    def _watch_peer(self, conn):
+        # the standby only ever says that it has taken over, then hangs up
+        with conn.makefile("rb") as stream:
+            try:
+                for line in stream:
+                    if json.loads(line).get("type") == "takeover":
+                        self._step_down("the standby has taken over")
+                        return
+            except (OSError, ValueError):
+                pass
+        with self._lock:
+            if self._peer is not conn:
+                return
+            self._peer = None
+        if self.active:
+            log_event("standby_lost", "the standby coordinator went away, running without one", logging.WARNING)
+
+    def _heartbeat(self):
+        while self._running and self.active:
+            self.publish()
+            time.sleep(self.lease / 4)
+
+    def publish(self):
+        """Send the current state to the standby, if one is following; renews the lease."""
+        with self._lock:
+            conn = self._peer
+            if conn is None or not self.active:
+                return
+            now = time.monotonic()
+            if now >= self._lease_until:
+                expired = True
+            else:
+                expired = False
+                self._lease_until = now + self.lease
+        if expired:
+            self._step_down("its lease ran out while a standby was following")
+            return
+        message = {"type": "state", "lease": now + self.lease,
+                   "plants": {name: [plant.state.snapshot.bits, plant.previous_action or 0]
+                              for name, plant in self.plants.items()}}
+        try:
+            with self._send_lock:
+                conn.sendall((json.dumps(message) + "\n").encode())
+        except OSError:
+            pass
+
+    def may_actuate(self):
+        """Whether this coordinator may write to the devices right now."""
+        if not self.active:
+            return False
+        with self._lock:
+            if self._peer is None or time.monotonic() < self._lease_until:
+                return True
+        self._step_down("its lease ran out while a standby was following")
+        return False
+
+    def _step_down(self, reason):
+        with self._lock:
+            if not self.active:
+                return
+            self.active = False
+            listener, self._listener = self._listener, None
+            peer, self._peer = self._peer, None
+        ACTIVE.set(0)
+        log_event("demoted", f"stepping down to standby: {reason}", logging.WARNING, reason=reason)
+        for sock in (listener, peer):
+            if sock is not None:
+                sock.close()
+        # the coordinator taking over may not hold the socket yet; give it time to bind it
+        if self._running:
+            threading.Thread(target=self._follow, args=(2 * self.lease,), name="standby", daemon=True).start()
+
+    def release(self):
+        """
+        On shutdown: hand over to a following standby if there is one.
+        Returns whether this coordinator should switch the plant off itself.
+        """
+        self._running = False
+        with self._lock:
+            active, peer = self.active, self._peer
+            self.active = False
+        if not active:
+            return False
+        if peer is None:
+            return True
+        try:
+            with self._send_lock:
+                peer.sendall(b'{"type": "handover"}\n')
+        except OSError:
+            pass
+        for sock in (self._listener, peer):
+            if sock is not None:
+                sock.close()
+        log_event("handover", "handing the plant over to the standby coordinator")
+        return False
+
+    # standby side
+
+    def _follow(self, hold_off=0.0):
+        patient_until = time.monotonic() + hold_off
+        while self._running and not self.active:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                conn.connect(self.address)
+            except OSError:
+                conn.close()
+                # nobody holds the socket: there is no active coordinator
+                if time.monotonic() >= patient_until and self._bind():
+                    self._promote("there is no active coordinator")
+                    return
+                time.sleep(self.lease / 4)
+                continue
+            if self._follow_connection(conn):
+                return
+
+    def _follow_connection(self, conn):
+        """Apply the active's state until it goes away; returns True once this coordinator took over."""
+        lease_until = time.monotonic() + self.lease
+        buffer = b""
+        with conn:
+            while self._running:
+                conn.settimeout(max(0.001, lease_until + self.grace - time.monotonic()))
+                try:
+                    data = conn.recv(65536)
+                except socket.timeout:
+                    try:
+                        conn.sendall(b'{"type": "takeover"}\n')
+                    except OSError:
+                        pass
+                    self._promote("the active coordinator stopped renewing its lease")
+                    return True
+                except OSError:
+                    data = b""
+                if not data:
+                    # closed: the active died, stepped down or handed over, unless it still holds the socket
+                    if self._bind():
+                        self._promote("the active coordinator went away")
+                        return True
+                    return False
+                *lines, buffer = (buffer + data).split(b"\n")
+                for line in lines:
+                    message = json.loads(line)
+                    if message.get("type") == "state":
+                        lease_until = message["lease"]
+                        self._apply(message["plants"])
+        return False
+
+    def _apply(self, plants):
+        for name, (bits, action) in plants.items():
+            plant = self.plants.get(name)
+            if plant is not None:
+                plant.state.update(REPLICATED, bits)
+                plant.previous_action = action
+                # what the active wrote is what the standby's own read-backs should find
+                for signal, flag in (("gateOpen", GATE_OPEN), ("pumpOn", PUMP_ON)):
+                    plant.coils.follow(signal, bits & flag != 0)
+
+    def _promote(self, reason):
+        self.failover_started = time.monotonic()
+        FAILOVERS.inc()
+        log_event("promoted", f"taking over as the active coordinator: {reason}", logging.WARNING, reason=reason)
+        self._become_active()
+        if self.on_promote is not None:
+            self.on_promote()
+
+    def cycle_completed(self):
+        """Called by the control loop after every cycle."""
+        if self.failover_started is not None and self.active:
+            took = time.monotonic() - self.failover_started
+            self.failover_started = None
+            FAILOVER_DURATION.set(took)
+            log_event("failover", f"first cycle as the active coordinator completed {took * 1000:.1f} ms after taking over",
+                      seconds=took)
+        self.publish()
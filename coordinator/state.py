@@ -0,0 +1,85 @@
+"""
+versioned state record of a plant: every flag the control loop and the HMI
+share, packed into one bitfield that is swapped as a whole, so a reader sees
+the state of one moment rather than a mix of two cycles
+"""
+
+import collections
+import threading
+import time
+
+
+# flags of the state bitfield
+MANUAL = 1 << 0
+DAY = 1 << 1
+LEVEL_HIGH = 1 << 2
+GATE_OPEN = 1 << 3
+PUMP_ON = 1 << 4
+TARGET_GATE_OPEN = 1 << 5
+TARGET_PUMP_ON = 1 << 6
+STALE_LEVEL = 1 << 7
+STALE_GATE = 1 << 8
+STALE_PUMP = 1 << 9
+
+# polled signals, and the flag holding each one's value and whether it is stale
+SIGNALS = {"waterLevelHigh": LEVEL_HIGH, "gateOpen": GATE_OPEN, "pumpOn": PUMP_ON}
+STALE = {"waterLevelHigh": STALE_LEVEL, "gateOpen": STALE_GATE, "pumpOn": STALE_PUMP}
+ANY_STALE = STALE_LEVEL | STALE_GATE | STALE_PUMP
+TARGETS = TARGET_GATE_OPEN | TARGET_PUMP_ON
+
+
+Snapshot = collections.namedtuple("Snapshot", ["bits", "version", "timestamp"])
+
+
+def stale_signals(bits):
+    if not bits & ANY_STALE:
+        return []
+    return [signal for signal, flag in STALE.items() if bits & flag]
+
+
+def enter_manual(bits):
+    # manual mode starts from the coils as they are, not from leftover targets
+    targets = (TARGET_GATE_OPEN if bits & GATE_OPEN else 0) | (TARGET_PUMP_ON if bits & PUMP_ON else 0)
+    return (bits & ~TARGETS) | targets | MANUAL
+
+
+class StateStore:
+    """
+    The current Snapshot of a plant (bits, version, unix timestamp of the
+    last change). Readers take `snapshot` without locking; it is replaced by
+    a single assignment. Writers go through update() or apply(), which are
+    serialized, bump the version only when a bit actually changes and wake
+    everyone blocked in wait().
+    """
+
+    def __init__(self, bits=0):
+        self.snapshot = Snapshot(bits, 0, time.time())
+        self._changed = threading.Condition()
+
+    def is_set(self, flag):
+        return self.snapshot.bits & flag != 0
+
+    def apply(self, fn):
+        """Replace the bits with fn(bits), atomically; returns the resulting snapshot."""
+        with self._changed:
+            current = self.snapshot
+            bits = fn(current.bits)
+            if bits == current.bits:
+                return current
+            self.snapshot = Snapshot(bits, current.version + 1, time.time())
+            self._changed.notify_all()
+            return self.snapshot
+
+    def update(self, mask, bits):
+        """Set the flags in `mask` to their values in `bits`, leaving the others alone."""
+        return self.apply(lambda current: (current & ~mask) | (bits & mask))
+
+    def put(self, flag, value):
+        return self.update(flag, flag if value else 0)
+
+    def wait(self, since, timeout=None):
+        """Block until the version moves past `since` (or the timeout passes); returns the latest snapshot."""
+        with self._changed:
+            if self.snapshot.version == since:
+                self._changed.wait(timeout)
+            return self.snapshot
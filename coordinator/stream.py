@@ -0,0 +1,84 @@
+"""
+versioned HMI state of a plant, published once per change and shared by every
+/update poller and /stream subscriber
+"""
+
+import collections
+import json
+import os
+import threading
+
+
+class StateBroadcaster:
+    """
+    Keeps the latest HMI state of one plant, its pre-serialized JSON body and
+    a short backlog of deltas. Each change is serialized once when it is
+    published, no matter how many pollers and subscribers there are; a
+    subscriber that falls further behind than the backlog is resynchronized
+    with a full snapshot.
+    """
+
+    # versions restart with the process, so ETags carry a per-boot prefix
+    boot_id = os.urandom(4).hex()
+
+    def __init__(self, backlog=64):
+        self.version = 0
+        self.state = {}
+        self._snapshot = (f'"{self.boot_id}-0"', b"{}")
+        self._deltas = collections.deque(maxlen=backlog)
+        self._changed = threading.Condition()
+
+    def publish(self, state):
+        with self._changed:
+            delta = {k: v for k, v in state.items() if self.state.get(k) != v}
+            if not delta:
+                return self.version
+            self.version += 1
+            self.state = dict(state)
+            self._snapshot = (f'"{self.boot_id}-{self.version}"', _encode(self.state))
+            self._deltas.append((self.version, _frame("delta", self.version, _encode(delta))))
+            self._changed.notify_all()
+            return self.version
+
+    def snapshot(self):
+        """Return (etag, JSON body) of the current state."""
+        # swapped as a single tuple by publish(), so no lock is needed to read it
+        return self._snapshot
+
+    def snapshot_event(self):
+        with self._changed:
+            return self.version, _frame("snapshot", self.version, self._snapshot[1])
+
+    def wait_events(self, since, timeout):
+        """
+        Block until there is something newer than version `since` (or the
+        timeout passes) and return (version, [encoded events]).
+        """
+        with self._changed:
+            if self.version == since:
+                self._changed.wait(timeout)
+            if self.version == since:
+                return since, []
+            if not self._deltas or self._deltas[0][0] > since + 1:
+                return self.version, [_frame("snapshot", self.version, self._snapshot[1])]
+            return self.version, [event for version, event in self._deltas if version > since]
+
+    def subscribe(self, heartbeat=15.0):
+        """Generator of encoded SSE messages for one client."""
+        version, event = self.snapshot_event()
+        yield event
+        while True:
+            version, events = self.wait_events(version, heartbeat)
+            if not events:
+                # comment line, keeps proxies from closing an idle stream
+                yield b": keepalive\n\n"
+            for event in events:
+                yield event
+
+
+def _encode(data):
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def _frame(kind, version, body):
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (version, kind.encode(), body)
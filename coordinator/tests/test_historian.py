@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+import historian
+from historian import SIGNALS, Historian
+
+
+@pytest.fixture(scope="module")
+def filled():
+    rng = random.Random(7)
+    buffer = Historian(5000)
+    # more records than fit, so the oldest are overwritten and queries span the wrap-around
+    for i in range(6000):
+        state = {signal: rng.random() < 0.3 for signal in SIGNALS}
+        rtt = {role: rng.random() / 100 for role in ("sensor", "gate", "pump") if rng.random() < 0.6}
+        buffer.record(state, rtt, timestamp=1_000_000 + i * 1.5)
+    yield buffer
+    buffer.close()
+
+
+@pytest.mark.parametrize("start, end, step", [
+    (1_000_000, 1_010_000, 97.3),
+    (1_001_400, 1_001_600, 1),
+    (1_008_990, 1_009_100, 7),
+    (999_000, 999_500, 10),
+])
+def test_numpy_sums_match_python(filled, start, end, step, monkeypatch):
+    vectorized = filled.query(start, end, step)
+    monkeypatch.setattr(historian, "_sum_numpy",
+                        lambda np, raw, *args: historian._sum_python(raw, *args))
+    assert vectorized == filled.query(start, end, step)
+
+
+def test_query_buckets_samples(filled):
+    series = filled.query(1_001_500, 1_001_530, 10)
+    assert series["t"] == [1_001_500, 1_001_510, 1_001_520]
+    assert series["samples"] == [7, 7, 6]
+    assert all(0 <= f <= 1 for f in series["pumpOn"])
+
+
+def test_clock_stepping_back_keeps_records_in_order(tmp_path):
+    path = tmp_path / "history.bin"
+    buffer = Historian(10, path)
+    buffer.record({"pumpOn": True}, timestamp=1_000_010)
+    buffer.record({"pumpOn": True}, timestamp=1_000_000)
+    buffer.close()
+
+    # the last time is picked up again from the file
+    buffer = Historian(10, path)
+    buffer.record({"pumpOn": False}, timestamp=1_000_005)
+    try:
+        series = buffer.query(1_000_010, 1_000_011, 1)
+        assert series["samples"] == [3]
+        assert series["pumpOn"] == [round(2 / 3, 4)]
+    finally:
+        buffer.close()
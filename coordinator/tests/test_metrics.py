@@ -0,0 +1,18 @@
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_families_are_named_after_their_samples():
+    registry = Registry()
+    requests = Counter("psh_requests", "Requests", ["code"], registry=registry)
+    requests.labels("200").inc()
+    Gauge("psh_level", "Level", registry=registry).set(3)
+    Histogram("psh_seconds", "Seconds", buckets=(1.0,), registry=registry).observe(0.5)
+
+    families, samples = set(), set()
+    for line in registry.render().decode().splitlines():
+        if line.startswith("# TYPE "):
+            families.add(line.split()[2])
+        elif not line.startswith("#"):
+            samples.add(line.split("{")[0].split()[0])
+    assert families == {"psh_requests_total", "psh_level", "psh_seconds"}
+    assert samples == {"psh_requests_total", "psh_level", "psh_seconds_bucket", "psh_seconds_sum", "psh_seconds_count"}
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from pool import ConnectionPool
+
+
+class FakeClient:
+    """Stands in for ModbusTcpClient: connects at once, and knows whether its socket is open."""
+
+    def __init__(self):
+        self.open = False
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        self.open = True
+        return True
+
+    def close(self):
+        self.open = False
+
+
+def test_mark_down_never_closes_the_reconnected_socket():
+    pool = ConnectionPool(min_backoff=0.001, max_backoff=0.001)
+    device = pool.add("pump", "127.0.0.1", 1)
+    device.client = FakeClient()
+    pool.start()
+    try:
+        assert pool.wait_connected(1.0) == []
+        close = device.close
+        closing = threading.Event()
+
+        def slow_close():
+            # the thread that lost the device is preempted right before closing its socket
+            closing.set()
+            time.sleep(0.1)
+            close()
+
+        device.close = slow_close
+        threading.Thread(target=pool.mark_down, args=(device, OSError("reset"))).start()
+        assert closing.wait(1.0)
+        assert pool.wait_connected(1.0) == []
+        time.sleep(0.15)
+        assert device.connected and device.client.open
+        assert device.client.connects == 2
+    finally:
+        pool.close()
@@ -0,0 +1,44 @@
+import datetime as dt
+from pathlib import Path
+
+import pytest
+
+from schedule import Schedule
+
+EXAMPLE = Path(__file__).resolve().parent.parent / "schedule.example.json"
+
+
+@pytest.fixture(scope="module")
+def schedule():
+    return Schedule(EXAMPLE)
+
+
+@pytest.mark.parametrize("date", ["2027-02-10", "2026-11-26", "2027-06-21", "2026-12-25", "2027-09-22"])
+def test_is_day_matches_listed_windows(schedule, date):
+    config = schedule._config
+    day = dt.date.fromisoformat(date)
+    windows = config.windows(day, 1)
+    for window, following in zip(windows, windows[1:] + [None]):
+        end = following.start if following is not None else config.epoch(day + dt.timedelta(days=1), 0)
+        for t in range(int(window.start), int(end), 60):
+            moment = dt.datetime.fromtimestamp(t, config.tz)
+            assert schedule.is_day(t) == window.is_day, moment
+            assert config.state(day, moment.hour * 60 + moment.minute)[0] == window.is_day, moment
+
+
+def test_sunrise_starts_the_day_on_a_weekday_morning(schedule):
+    config = schedule._config
+    day = dt.date(2027, 2, 10)
+    sunrise, sunset = config.sun_times(day)
+    assert not schedule.is_day(config.epoch(day, sunrise - 1))
+    assert schedule.is_day(config.epoch(day, sunrise))
+    assert schedule.is_day(config.epoch(day, 8 * 60))
+
+
+def test_sunrise_starts_the_day_on_a_holiday(schedule):
+    config = schedule._config
+    day = dt.date(2026, 11, 26)
+    sunrise, sunset = config.sun_times(day)
+    assert sunrise < 8 * 60
+    assert schedule.is_day(config.epoch(day, sunrise))
+    assert not schedule.is_day(config.epoch(day, sunset))
@@ -0,0 +1,347 @@
+"""
+generic modbus field device: serves every point of a JSON point map (coils,
+discrete inputs, holding and input registers, on any number of unit IDs) from
+a single process, each point bound to a GPIO pin, the plant simulator or
+plain memory
+"""
+
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+import click
+from pymodbus.server import StartTcpServer
+from pymodbus.datastore import (
+    ModbusSequentialDataBlock,
+    ModbusServerContext,
+    ModbusSlaveContext,
+)
+
+# devicekit.py sits next to app.py in the image, and in common/ in a checkout
+sys.path.append(str(Path(__file__).resolve().parent.parent / "common"))
+from devicekit import (RequestMetrics, SimulatedPlant, check_gpio, check_modbus, check_plant_sim, gauge, log_event,
+                       render, setup_logging, start_metrics_server)
+
+
+# coils, discrete inputs, holding registers, input registers
+TABLES = ("co", "di", "hr", "ir")
+WRITABLE = ("co", "hr")
+
+
+# request metrics, exposed in prometheus text format on the optional
+# --metrics-port scrape endpoint
+_requests = RequestMetrics(("unit", "table"))
+_metrics = {"points": {}}
+_started = time.time()
+
+
+def _render_metrics():
+    return render(
+        _requests.render("Time spent in the datastore callback (backend access included)"),
+        gauge("psh_device_point_state", "Last value read or written for each point",
+              [({"point": name}, value) for name, value in sorted(_metrics["points"].items())]),
+        gauge("psh_device_start_time_seconds", "Unix time the device server started", [({}, _started)]),
+    )
+
+
+# readiness, answered at /ready on the metrics port: the device is ready when
+# its own modbus server answers a read of one point of every unit, every GPIO
+# pin is set up the way its point needs, and the plant simulator (if any
+# point uses it) answers; set by run_server
+_readiness = {}
+FUNCTIONS = {"co": 1, "di": 2, "hr": 3, "ir": 4}
+
+
+def readiness_problems():
+    if "modbus" not in _readiness:
+        return ["modbus: server not started"]
+    problems = []
+    host, port = _readiness["modbus"]
+    probed = set()
+    plants = set()
+    for point in _readiness["points"]:
+        if point.unit not in probed:
+            probed.add(point.unit)
+            problem = check_modbus(host, port, point.unit, FUNCTIONS[point.table], point.address)
+            if problem is not None:
+                problems.append(f"modbus unit {point.unit}: {problem}")
+        backend = point.backend
+        if isinstance(backend, GPIOBackend):
+            problem = check_gpio(backend._gpio, backend.pin, backend.output)
+            if problem is not None:
+                problems.append(f"gpio: {point.name}: {problem}")
+        elif isinstance(backend, SimulatedBackend):
+            plants.add(backend._plant)
+    for plant in plants:
+        problem = check_plant_sim(plant)
+        if problem is not None:
+            problems.append(f"plant simulator: {problem}")
+    return problems
+
+
+class MemoryBackend:
+    """A point that only lives in the datastore; inputs read as their initial value."""
+
+    def __init__(self, value=0):
+        self.value = value
+
+    def read(self):
+        return self.value
+
+    def write(self, value):
+        self.value = value
+
+    def cleanup(self):
+        pass
+
+
+class GPIOBackend:
+    """A Raspberry Pi pin: an output for coils and holding registers, an input otherwise."""
+
+    def __init__(self, pin, output, active_low=False):
+        import RPi.GPIO as gpio
+        self._gpio = gpio
+        self.pin = pin
+        self.output = output
+        self._active = gpio.LOW if active_low else gpio.HIGH
+        self._inactive = gpio.HIGH if active_low else gpio.LOW
+        if output:
+            gpio.setup(pin, gpio.OUT, initial=self._inactive)
+        else:
+            gpio.setup(pin, gpio.IN)
+
+    def read(self):
+        return 1 if self._gpio.input(self.pin) == self._active else 0
+
+    def write(self, value):
+        self._gpio.output(self.pin, self._active if value else self._inactive)
+
+    def cleanup(self):
+        if self.output:
+            self._gpio.output(self.pin, self._inactive)
+
+
+class SimulatedBackend:
+    """
+    A value of the plant simulator's snapshot (e.g. levelHigh, or level scaled
+    to an integer register); writes are reported to the simulator as
+    "set <key> <value>", which it accepts for the pump and gate.
+    """
+
+    def __init__(self, plant, key, scale=1):
+        self._plant = plant
+        self.key = key
+        self.scale = scale
+
+    def read(self):
+        # polled in the background: no network round trip on the server's event loop
+        return int(self._plant.snapshot()[self.key] * self.scale)
+
+    def write(self, value):
+        # queued for the simulator's writer thread, like read(): never waits on the network
+        self._plant.send(f"set {self.key} {1 if value else 0}")
+
+    def cleanup(self):
+        pass
+
+
+class Point:
+    def __init__(self, name, unit, table, address, backend):
+        self.name = name
+        self.unit = unit
+        self.table = table
+        self.address = address
+        self.backend = backend
+
+
+class PointDataBlock(ModbusSequentialDataBlock):
+    """
+    One table of one unit. Reads of discrete inputs and input registers fetch
+    the mapped points from their backends, so a multi-point read is still a
+    single request; writes to coils and holding registers are passed on to the
+    backends before they are stored.
+    """
+
+    def __init__(self, unit, table, points):
+        size = max(p.address for p in points) + 1 if points else 1
+        # addresses in the point map are protocol addresses; the slave context
+        # adds one before it reaches the block (zero_mode=False)
+        super().__init__(0x01, [0] * size)
+        self._unit = unit
+        self._table = table
+        self._points = {p.address + 1: p for p in points}
+
+    def validate(self, address, count=1):
+        # a table without points answers every request with an illegal address
+        return bool(self._points) and super().validate(address, count)
+
+    def getValues(self, address, count=1):
+        start = time.perf_counter()
+        values = super().getValues(address, count)
+        if self._table not in WRITABLE:
+            for i in range(count):
+                point = self._points.get(address + i)
+                if point is not None:
+                    values[i] = point.backend.read()
+                    _metrics["points"][point.name] = values[i]
+        _requests.observe("read", time.perf_counter() - start, self._unit, self._table)
+        return values
+
+    def setValues(self, address, values):
+        start = time.perf_counter()
+        logging.debug("unit %s %s write at %s: %s", self._unit, self._table, address, values)
+        for i, value in enumerate(values):
+            point = self._points.get(address + i)
+            if point is not None:
+                value = int(value)
+                # events bypass the log rate limit, so only a write that changes the point is logged
+                if int(super().getValues(address + i, 1)[0]) != value:
+                    log_event("write", f"setting {point.name} to {value} in response to request", point=point.name,
+                              unit=self._unit, table=self._table, value=value)
+                point.backend.write(value)
+                _metrics["points"][point.name] = value
+        super().setValues(address, values)
+        _requests.observe("write", time.perf_counter() - start, self._unit, self._table)
+
+
+def load_point_map(path, use_gpio=False, plant_sim=None):
+    """
+    Load points from a JSON point map, grouped by unit ID, e.g.
+
+        {"units": {"1": [{"name": "gate", "table": "co", "address": 0,
+                          "gpio": 22, "active_low": true, "sim": "gate"}],
+                   "3": [{"name": "levelHigh", "table": "di", "address": 0,
+                          "gpio": 17, "active_low": true, "sim": "levelHigh"},
+                         {"name": "level", "table": "ir", "address": 0,
+                          "sim": "level", "scale": 1000}]}}
+
+    A point is bound to its GPIO pin when use_gpio is set, otherwise to the
+    plant simulator key when a simulator is given, otherwise to memory.
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    points = []
+    seen = set()
+    for unit, entries in config["units"].items():
+        unit = int(unit)
+        if not 0 <= unit <= 247:
+            raise ValueError(f"unit ID {unit} is out of range (0-247)")
+        for entry in entries:
+            table = entry["table"]
+            if table not in TABLES:
+                raise ValueError(f"point {entry.get('name')!r} has unknown table {table!r} (options: {', '.join(TABLES)})")
+            key = (unit, table, entry["address"])
+            if key in seen:
+                raise ValueError(f"point {entry.get('name')!r} reuses unit {unit} {table} address {entry['address']}")
+            seen.add(key)
+
+            if use_gpio and "gpio" in entry:
+                backend = GPIOBackend(entry["gpio"], table in WRITABLE, entry.get("active_low", False))
+            elif plant_sim is not None and "sim" in entry:
+                backend = SimulatedBackend(plant_sim, entry["sim"], entry.get("scale", 1))
+            else:
+                backend = MemoryBackend(entry.get("initial", 0))
+            points.append(Point(entry.get("name", f"{unit}.{table}.{entry['address']}"), unit, table, entry["address"], backend))
+
+    names = [p.name for p in points]
+    if len(set(names)) != len(names):
+        raise ValueError("point names in the point map must be unique")
+    if not points:
+        raise ValueError("point map does not define any points")
+    return points
+
+
+def build_context(points):
+    slaves = {}
+    for unit in sorted({p.unit for p in points}):
+        blocks = {table: PointDataBlock(unit, table, [p for p in points if p.unit == unit and p.table == table])
+                  for table in TABLES}
+        slaves[unit] = ModbusSlaveContext(**blocks)
+        counts = ", ".join(f"{len(b._points)} {t}" for t, b in blocks.items() if b._points)
+        logging.info(f"unit {unit}: {counts}")
+    return ModbusServerContext(slaves=slaves, single=False)
+
+
+def setup_gpio(**args):
+    logging.debug("setting up GPIO")
+    import RPi.GPIO as gpio
+
+    # use BCM mode (as opposed to BOARD mode)
+    gpio.setmode(gpio.BCM)
+
+
+def run_server(points, host, port, metrics_port=None, **args):
+    logging.debug("setting up Modbus/TCP server")
+    if metrics_port is not None:
+        start_metrics_server(host, metrics_port, _render_metrics, readiness_problems)
+
+    context = build_context(points)
+
+    # start the modbus/TCP server with the provided information from cmdline
+    _readiness.update(modbus=(host, port), points=points)
+    logging.info(f"running Modbus/TCP server at {host}:{port} with {len(points)} point(s)")
+    return StartTcpServer(
+        context=context,
+        address=(host, port),
+    )
+
+
+def cleanup(points, **args):
+    logging.debug("cleaning up GPIO")
+    for point in points:
+        point.backend.cleanup()
+    import RPi.GPIO as gpio
+    gpio.cleanup()
+
+
+@click.group()
+@click.option("--log", "-l", default="info", help="The log level to use when sending logs to stdout (default: INFO; options: DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+@click.option("--log-format", "-lf", default="text", type=click.Choice(["text", "json"], case_sensitive=False), help="Write log records as plain text or as one JSON object per line (default: text)")
+@click.option("--log-rate", "-lr", default=5.0, help="Log records per second allowed from any one line of code after a burst of 20, 0 to disable (default: 5.0)")
+def cli(log, log_format, log_rate):
+    log_level = getattr(logging, log.upper())
+    setup_logging(log_level, log_format, log_rate)
+    logging.info(f"logging level set to {log.upper()}")
+
+@click.command()
+@click.option("--point-map", "-pm", default="/opt/csci498/points.json", type=click.Path(exists=True, dir_okay=False), help="The JSON point map to serve (default: /opt/csci498/points.json)")
+@click.option("--host", "-h", default="0.0.0.0", help="The address to use when creating a socket for the Modbus server (default: 0.0.0.0)")
+@click.option("--port", "-p", default=502, help="The port to use when creating a socket for the Modbus server (default: 502)")
+@click.option("--metrics-port", "-mp", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics, and readiness at /ready (default: disabled)")
+def run(**args):
+    setup_gpio(**args)
+    args['points'] = []
+    try:
+        args['points'] = load_point_map(args['point_map'], use_gpio=True)
+        run_server(**args)
+    finally:
+        cleanup(**args)
+
+@click.group()
+def debug():
+    pass
+
+@click.command("modbus")
+@click.option("--point-map", "-pm", default="points.json", type=click.Path(exists=True, dir_okay=False), help="The JSON point map to serve, without touching any GPIO (default: points.json)")
+@click.option("--host", "-h", default="0.0.0.0", help="The address to use when creating a socket for the Modbus server (default: 0.0.0.0)")
+@click.option("--port", "-p", default=502, help="The port to use when creating a socket for the Modbus server (default: 502)")
+@click.option("--metrics-port", "-mp", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics, and readiness at /ready (default: disabled)")
+@click.option("--plant-sim", "-ps", default=None, help="HOST:PORT of a plant simulator to bind points with a \"sim\" key to instead of memory (default: disabled)")
+def modbus_debug(**args):
+    logging.info(f"starting Modbus debugging mode (host={args['host']}, port={args['port']})")
+    plant_sim = None
+    if args['plant_sim'] is not None:
+        logging.info(f"using plant simulator at {args['plant_sim']}")
+        plant_sim = SimulatedPlant(args['plant_sim'])
+        plant_sim.start_polling()
+    args['points'] = load_point_map(args['point_map'], plant_sim=plant_sim)
+    run_server(**args)
+
+if __name__ == "__main__":
+    cli.add_command(run)
+    cli.add_command(debug)
+    debug.add_command(modbus_debug)
+    cli()
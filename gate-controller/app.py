@@ -3,6 +3,9 @@ modbus server designed to provide a read-write interface for a water flow gate
 """
 
 import logging
+import sys
+import time
+from pathlib import Path
 
 import click
 from pymodbus.server import StartTcpServer
@@ -12,30 +15,85 @@ from pymodbus.datastore import (
     ModbusSlaveContext,
 )
 
+# devicekit.py sits next to app.py in the image, and in common/ in a checkout
+sys.path.append(str(Path(__file__).resolve().parent.parent / "common"))
+from devicekit import (RequestMetrics, SimulatedPlant, check_gpio, check_modbus, check_plant_sim, gauge, log_event,
+                       render, setup_logging, start_metrics_server)
+
+
+# request metrics, exposed in prometheus text format on the optional
+# --metrics-port scrape endpoint
+_requests = RequestMetrics()
+_metrics = {"coil": 0}
+_started = time.time()
+
+
+def _render_metrics():
+    return render(
+        _requests.render("Time spent in the datastore callback (GPIO access included)"),
+        gauge("psh_device_coil_state", "Last value written to the gate coil", [({}, _metrics["coil"])]),
+        gauge("psh_device_start_time_seconds", "Unix time the device server started", [({}, _started)]),
+    )
+
+
+# readiness, answered at /ready on the metrics port: the device is ready when
+# its own modbus server answers a read of its coil and the GPIO pin (or
+# plant simulator) behind it can be reached; set by run_server
+_readiness = {}
+
+
+def readiness_problems():
+    if "modbus" not in _readiness:
+        return ["modbus: server not started"]
+    checks = [("modbus", check_modbus(*_readiness["modbus"], function=1))]
+    if _readiness.get("gpio") is not None:
+        import RPi.GPIO as gpio
+        checks.append(("gpio", check_gpio(gpio, _readiness["gpio"], output=True)))
+    if _readiness.get("plant_sim") is not None:
+        checks.append(("plant simulator", check_plant_sim(_readiness["plant_sim"])))
+    return [f"{name}: {problem}" for name, problem in checks if problem is not None]
+
 
 class CallbackDataBlock(ModbusSequentialDataBlock):
-    def __init__(self, gate_gpio, address, values):
+    def __init__(self, gate_gpio, address, values, plant_sim=None):
         super().__init__(address, values)
         self._gate_gpio = gate_gpio
+        self._plant_sim = plant_sim
 
     def _included_in_range(addr, rng, target_addr):
         if addr + rng > target_addr:
             return target_addr - addr
         return None
 
+    def getValues(self, address, count=1):
+        start = time.perf_counter()
+        values = super().getValues(address, count)
+        _requests.observe("read", time.perf_counter() - start)
+        return values
+
     def setValues(self, address, values):
-        logging.debug(f"write request received for address {address}, values {values}")
+        start = time.perf_counter()
+        logging.debug("write request received for address %s, values %s", address, values)
         idx = CallbackDataBlock._included_in_range(address, len(values), 0x01)
         if idx is not None and self._gate_gpio is not None:
             import RPi.GPIO as gpio
             target_value = values[idx]
+            # events bypass the log rate limit, so only a write that changes the coil is logged
+            changed = bool(super().getValues(address + idx, 1)[0]) != bool(target_value)
             if target_value is True:
-                logging.info("toggling gate OPEN in response to request")
+                if changed:
+                    log_event("coil", "toggling gate OPEN in response to request", point="gate", value=1)
                 gpio.output(self._gate_gpio, gpio.LOW)
             else:
-                logging.info("toggling gate CLOSED in response to request")
+                if changed:
+                    log_event("coil", "toggling gate CLOSED in response to request", point="gate", value=0)
                 gpio.output(self._gate_gpio, gpio.HIGH)
         super().setValues(address, values)
+        if idx is not None and self._plant_sim is not None:
+            self._plant_sim.send(f"set gate {1 if values[idx] else 0}")
+        if idx is not None:
+            _metrics["coil"] = 1 if values[idx] else 0
+        _requests.observe("write", time.perf_counter() - start)
 
 
 def setup_gpio(gate_gpio, **args):
@@ -49,11 +107,16 @@ def setup_gpio(gate_gpio, **args):
     gpio.setup(gate_gpio, gpio.OUT, initial=gpio.HIGH)
 
 
-def run_server(gate_gpio, host, port, **args):
+def run_server(gate_gpio, host, port, metrics_port=None, plant_sim=None, **args):
     logging.debug("setting up Modbus/TCP server")
+    if metrics_port is not None:
+        start_metrics_server(host, metrics_port, _render_metrics, readiness_problems)
 
     # initialize data block with exactly 1 coil, value 0, at address 0x01
-    block = CallbackDataBlock(gate_gpio, 0x01, [0] * 1)
+    if plant_sim is not None:
+        logging.info(f"using plant simulator at {plant_sim}")
+        plant_sim = SimulatedPlant(plant_sim)
+    block = CallbackDataBlock(gate_gpio, 0x01, [0] * 1, plant_sim)
 
     # pass the data block in as a coil initializer (read-write 1-bit cells);
     # ignore discrete inputs, holding registers, and input registers
@@ -64,6 +127,7 @@ def run_server(gate_gpio, host, port, **args):
     context = ModbusServerContext(slaves=store, single=True)
 
     # start the modbus/TCP server with the provided information from cmdline
+    _readiness.update(modbus=(host, port), gpio=gate_gpio, plant_sim=plant_sim)
     logging.info(f"running Modbus/TCP server at {host}:{port}")
     return StartTcpServer(
         context=context,
@@ -80,15 +144,18 @@ def cleanup(gate_gpio, **args):
 
 @click.group()
 @click.option("--log", "-l", default="info", help="The log level to use when sending logs to stdout (default: INFO; options: DEBUG, INFO, WARNING, ERROR, CRITICAL)")
-def cli(log):
+@click.option("--log-format", "-lf", default="text", type=click.Choice(["text", "json"], case_sensitive=False), help="Write log records as plain text or as one JSON object per line (default: text)")
+@click.option("--log-rate", "-lr", default=5.0, help="Log records per second allowed from any one line of code after a burst of 20, 0 to disable (default: 5.0)")
+def cli(log, log_format, log_rate):
     log_level = getattr(logging, log.upper())
-    logging.basicConfig(level=log_level)
+    setup_logging(log_level, log_format, log_rate)
     logging.info(f"logging level set to {log.upper()}")
 
 @click.command()
 @click.option("--gate-gpio", "-gg", default=22, help="The GPIO to use for controlling the gate (default: 22)")
 @click.option("--host", "-h", default="0.0.0.0", help="The address to use when creating a socket for the Modbus server (default: 0.0.0.0)")
 @click.option("--port", "-p", default=502, help="The address to use when creating a socket for the Modbus server (default: 502)")
+@click.option("--metrics-port", "-mp", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics, and readiness at /ready (default: disabled)")
 def run(**args):
     try:
         setup_gpio(**args)
@@ -103,6 +170,8 @@ def debug():
 @click.command("modbus")
 @click.option("--host", "-h", default="0.0.0.0", help="The address to use when creating a socket for the Modbus server (default: 0.0.0.0)")
 @click.option("--port", "-p", default=502, help="The address to use when creating a socket for the Modbus server (default: 502)")
+@click.option("--metrics-port", "-mp", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics, and readiness at /ready (default: disabled)")
+@click.option("--plant-sim", "-ps", default=None, help="HOST:PORT of a plant simulator to report gate coil writes to instead of only storing the coil (default: disabled)")
 def modbus_debug(**args):
     logging.info(f"starting Modbus debugging mode (host={args['host']}, port={args['port']})")
     args['gate_gpio'] = None
@@ -4,6 +4,10 @@ discrete input cell
 """
 
 import logging
+import sys
+import threading
+import time
+from pathlib import Path
 
 import click
 from pymodbus.server import StartTcpServer
@@ -13,10 +17,200 @@ from pymodbus.datastore import (
     ModbusSlaveContext,
 )
 
+# devicekit.py sits next to app.py in the image, and in common/ in a checkout
+sys.path.append(str(Path(__file__).resolve().parent.parent / "common"))
+from devicekit import (RequestMetrics, SimulatedPlant, check_gpio, check_modbus, check_plant_sim, counter, gauge,
+                       log_event, render, setup_logging, start_metrics_server)
+
+
+# request metrics, exposed in prometheus text format on the optional
+# --metrics-port scrape endpoint
+_requests = RequestMetrics()
+_metrics_lock = threading.Lock()
+_metrics = {
+    "input": 0,
+    "input_changed": 0.0,
+    "edges": 0,
+    "bounces": 0,
+}
+_started = time.time()
+
+
+def _record_sensor(state, edges, bounced):
+    """DebouncedSensor report callback that feeds the module metrics."""
+    with _metrics_lock:
+        _metrics["input"], _metrics["input_changed"] = state
+        _metrics["edges"] += edges
+        _metrics["bounces"] += bounced
+
+
+def _render_metrics():
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    return render(
+        _requests.render("Time spent in the datastore callback (GPIO access included)"),
+        gauge("psh_device_input_state", "Last water level sensor value returned", [({}, metrics["input"])]),
+        gauge("psh_device_input_changed_time_seconds", "Unix time the debounced sensor value last changed",
+              [({}, metrics["input_changed"])]),
+        counter("psh_device_input_edges", "Raw GPIO edges seen by the sensor worker", [({}, metrics["edges"])]),
+        counter("psh_device_input_bounces", "Edge bursts that settled back on the previous value",
+                [({}, metrics["bounces"])]),
+        gauge("psh_device_start_time_seconds", "Unix time the device server started", [({}, _started)]),
+    )
+
+
+# readiness, answered at /ready on the metrics port: the device is ready when
+# its own modbus server answers a read of its discrete input and the GPIO pin (or
+# plant simulator) behind it can be reached; set by run_server
+_readiness = {}
+
+
+def readiness_problems():
+    if "modbus" not in _readiness:
+        return ["modbus: server not started"]
+    checks = [("modbus", check_modbus(*_readiness["modbus"], function=2))]
+    if _readiness.get("gpio") is not None:
+        import RPi.GPIO as gpio
+        checks.append(("gpio", check_gpio(gpio, _readiness["gpio"], output=False)))
+    if _readiness.get("plant_sim") is not None:
+        checks.append(("plant simulator", check_plant_sim(_readiness["plant_sim"])))
+    sensor = _readiness.get("sensor")
+    if sensor is not None and not sensor._running:
+        checks.append(("sensor", "the debounce thread is not running"))
+    return [f"{name}: {problem}" for name, problem in checks if problem is not None]
+
+
+class RPiGPIOBackend:
+    """The float switch on a Raspberry Pi pin; it pulls the pin LOW when the reservoir is full."""
+
+    def __init__(self, pin):
+        import RPi.GPIO as gpio
+        self._gpio = gpio
+        self.pin = pin
+
+    def read(self):
+        return 1 if self._gpio.input(self.pin) == self._gpio.LOW else 0
+
+    def on_edge(self, callback):
+        self._gpio.add_event_detect(self.pin, self._gpio.BOTH, callback=lambda channel: callback())
+
+    def cleanup(self):
+        self._gpio.remove_event_detect(self.pin)
+
+
+class FakeGPIOBackend:
+    """In-memory stand-in for RPiGPIOBackend, so the cached mode runs on any machine."""
+
+    def __init__(self, level=0):
+        self.level = level
+        self._callbacks = []
+
+    def read(self):
+        return self.level
+
+    def on_edge(self, callback):
+        self._callbacks.append(callback)
+
+    def set(self, level):
+        if level != self.level:
+            self.level = level
+            for callback in self._callbacks:
+                callback()
+
+    def bounce(self, level, transitions=6, interval=0.002):
+        """Chatter like a mechanical switch before settling on level."""
+        for i in range(transitions):
+            self.set(level if i % 2 == 0 else 1 - level)
+            time.sleep(interval)
+        self.set(level)
+
+    def cleanup(self):
+        self._callbacks.clear()
+
+
+class DebouncedSensor:
+    """
+    Keeps the debounced sensor value and the time it last changed. Edges only
+    wake the worker thread; it waits until the input has been quiet for
+    `debounce` seconds before reading it, so contact bounce never reaches a
+    Modbus client. The input is also re-read every `resync` seconds in case an
+    edge was missed. Reads are a plain attribute lookup.
+
+    After every read of the input the worker calls report(state, edges,
+    bounced) with the debounced (value, changed time), the edges counted since
+    the last read, and whether they settled back on the old value.
+    """
+
+    def __init__(self, backend, debounce=0.05, resync=1.0, report=None):
+        self.backend = backend
+        self.debounce = debounce
+        self.resync = resync
+        self.report = report or (lambda state, edges, bounced: None)
+        self.state = (backend.read(), time.time())
+        self._edge = threading.Event()
+        # edges arrive on the GPIO library's callback thread
+        self._edges_lock = threading.Lock()
+        self._edges = 0
+        self._running = False
+        self.report(self.state, 0, False)
+
+    @property
+    def value(self):
+        return self.state[0]
+
+    def _on_edge(self):
+        with self._edges_lock:
+            self._edges += 1
+        self._edge.set()
+
+    def start(self):
+        self._running = True
+        self.backend.on_edge(self._on_edge)
+        threading.Thread(target=self._run, name="sensor", daemon=True).start()
+
+    def _run(self):
+        try:
+            self._watch()
+        finally:
+            # /ready reports a worker that died as not running
+            self._running = False
+
+    def _watch(self):
+        while self._running:
+            self._edge.wait(self.resync)
+            while self._edge.is_set():
+                self._edge.clear()
+                time.sleep(self.debounce)
+
+            level = self.backend.read()
+            with self._edges_lock:
+                edges, self._edges = self._edges, 0
+            bounced = level == self.state[0] and edges > 0
+            if level != self.state[0]:
+                self.state = (level, time.time())
+                log_event("input", f"level sensor changed to {'FULL' if level else 'EMPTY'} ({edges} edge(s))",
+                          point="waterLevelHigh", value=level, edges=edges)
+            self.report(self.state, edges, bounced)
+
+    def stop(self):
+        self._running = False
+        self._edge.set()
+        self.backend.cleanup()
+
+
+def flip_fake_sensor(backend, period):
+    # alternate the fake float switch between EMPTY and FULL, with contact bounce
+    while True:
+        time.sleep(period)
+        backend.bounce(1 - backend.level)
+
+
 class CallbackDataBlock(ModbusSequentialDataBlock):
-    def __init__(self, sensor_gpio, address, values):
+    def __init__(self, sensor_gpio, address, values, plant_sim=None, sensor=None):
         super().__init__(address, values)
         self._sensor_gpio = sensor_gpio
+        self._plant_sim = plant_sim
+        self._sensor = sensor
 
     def _included_in_range(addr, rng, target_addr):
         if addr + rng > target_addr:
@@ -39,16 +233,25 @@ class CallbackDataBlock(ModbusSequentialDataBlock):
 
     def getValues(self, address, count=1):
         """Return the requested values from the datastore."""
-        logging.debug(f"read request received for address {address}, count {count}")
+        start = time.perf_counter()
+        logging.debug("read request received for address %s, count %s", address, count)
         idx = CallbackDataBlock._included_in_range(address, count, 0x01)
         if idx is not None:
             results = [0] * count
-            if self._sensor_gpio is not None:
+            if self._sensor is not None:
+                results[idx] = self._sensor.value
+            elif self._sensor_gpio is not None:
                 results[idx] = self._read_sensor_gpio()
+            elif self._plant_sim is not None:
+                # polled in the background: no network round trip on the server's event loop
+                results[idx] = self._plant_sim.snapshot()["levelHigh"]
             else:
                 results[idx] = self._fake_sensor_gpio()
-            return results
-        return [self._fake_sensor_gpio()] * count
+            _metrics["input"] = results[idx]
+        else:
+            results = [self._fake_sensor_gpio()] * count
+        _requests.observe("read", time.perf_counter() - start)
+        return results
 
 def setup_gpio(sensor_gpio, **args):
     logging.debug("setting up GPIO")
@@ -61,11 +264,20 @@ def setup_gpio(sensor_gpio, **args):
     gpio.setup(sensor_gpio, gpio.IN)
 
 
-def run_server(sensor_gpio, host, port, **args):
+def run_server(sensor_gpio, host, port, metrics_port=None, plant_sim=None, sensor=None, **args):
     logging.debug("setting up Modbus/TCP server")
+    if metrics_port is not None:
+        start_metrics_server(host, metrics_port, _render_metrics, readiness_problems)
+    if sensor is not None:
+        logging.info(f"serving the debounced sensor value ({sensor.debounce * 1000:.0f} ms debounce)")
+        sensor.start()
 
     # initialize data block with exactly 1 coil, value 0, at address 0x01
-    block = CallbackDataBlock(sensor_gpio, 0x01, [0] * 1)
+    if plant_sim is not None:
+        logging.info(f"using plant simulator at {plant_sim}")
+        plant_sim = SimulatedPlant(plant_sim)
+        plant_sim.start_polling()
+    block = CallbackDataBlock(sensor_gpio, 0x01, [0] * 1, plant_sim, sensor)
 
     # pass the data block in as a discrete input initializer (read-only 1-bit
     # cells); ignore coils, holding registers, and input registers
@@ -76,6 +288,7 @@ def run_server(sensor_gpio, host, port, **args):
     context = ModbusServerContext(slaves=store, single=True)
 
     # start the modbus/TCP server with the provided information from cmdline
+    _readiness.update(modbus=(host, port), gpio=sensor_gpio, plant_sim=plant_sim, sensor=sensor)
     logging.info(f"running Modbus/TCP server at {host}:{port}")
     return StartTcpServer(
         context=context,
@@ -91,18 +304,25 @@ def cleanup(sensor_gpio, **args):
 
 @click.group()
 @click.option("--log", "-l", default="info", help="The log level to use when sending logs to stdout (default: INFO; options: DEBUG, INFO, WARNING, ERROR, CRITICAL)")
-def cli(log):
+@click.option("--log-format", "-lf", default="text", type=click.Choice(["text", "json"], case_sensitive=False), help="Write log records as plain text or as one JSON object per line (default: text)")
+@click.option("--log-rate", "-lr", default=5.0, help="Log records per second allowed from any one line of code after a burst of 20, 0 to disable (default: 5.0)")
+def cli(log, log_format, log_rate):
     log_level = getattr(logging, log.upper())
-    logging.basicConfig(level=log_level)
+    setup_logging(log_level, log_format, log_rate)
     logging.info(f"logging level set to {log.upper()}")
 
 @click.command()
 @click.option("--sensor-gpio", "-sg", default=11, help="The GPIO to use for reading water level sensor signal (default: 11)")
 @click.option("--host", "-h", default="0.0.0.0", help="The address to use when creating a socket for the Modbus server (default: 0.0.0.0)")
 @click.option("--port", "-p", default=502, help="The address to use when creating a socket for the Modbus server (default: 502)")
+@click.option("--metrics-port", "-mp", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics, and readiness at /ready (default: disabled)")
+@click.option("--sensor-mode", "-sm", default="cached", type=click.Choice(["cached", "direct"], case_sensitive=False), help="cached answers reads from a debounced value kept up to date by GPIO edge detection; direct reads the GPIO on every request (default: cached)")
+@click.option("--debounce", "-db", default=0.05, help="Seconds the sensor input must be stable before a change is served in cached mode (default: 0.05)")
 def run(**args):
     try:
         setup_gpio(**args)
+        if args['sensor_mode'] == "cached":
+            args['sensor'] = DebouncedSensor(RPiGPIOBackend(args['sensor_gpio']), args['debounce'], report=_record_sensor)
         run_server(**args)
     finally:
         cleanup(**args)
@@ -114,9 +334,17 @@ def debug():
 @click.command("modbus")
 @click.option("--host", "-h", default="0.0.0.0", help="The address to use when creating a socket for the Modbus server (default: 0.0.0.0)")
 @click.option("--port", "-p", default=502, help="The address to use when creating a socket for the Modbus server (default: 502)")
+@click.option("--metrics-port", "-mp", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics, and readiness at /ready (default: disabled)")
+@click.option("--plant-sim", "-ps", default=None, help="HOST:PORT of a plant simulator to read the water level from instead of a random level (default: disabled)")
+@click.option("--fake-flip-period", "-ff", default=None, type=float, help="Serve a fake, bouncing float switch through the debounced cache that flips every this many seconds, instead of a random level (default: disabled)")
+@click.option("--debounce", "-db", default=0.05, help="Seconds the fake sensor input must be stable before a change is served (default: 0.05)")
 def modbus_debug(**args):
     logging.info(f"starting Modbus debugging mode (host={args['host']}, port={args['port']})")
     args['sensor_gpio'] = None
+    if args['fake_flip_period'] is not None:
+        backend = FakeGPIOBackend()
+        args['sensor'] = DebouncedSensor(backend, args['debounce'], report=_record_sensor)
+        threading.Thread(target=flip_fake_sensor, args=(backend, args['fake_flip_period']), daemon=True).start()
     run_server(**args)
 
 @click.command("gpio")
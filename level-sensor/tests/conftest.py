@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# app.py is run as a script, so the tests import it as a top-level module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+import app
+from app import DebouncedSensor, FakeGPIOBackend
+
+
+class Reports:
+    """A report callback for DebouncedSensor that adds up what it is told."""
+
+    def __init__(self):
+        self.state = None
+        self.edges = 0
+        self.bounces = 0
+
+    def __call__(self, state, edges, bounced):
+        self.state = state
+        self.edges += edges
+        self.bounces += bounced
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return condition()
+
+
+@pytest.fixture
+def backend():
+    return FakeGPIOBackend(level=0)
+
+
+@pytest.fixture
+def reports():
+    return Reports()
+
+
+@pytest.fixture
+def sensor(backend, reports):
+    sensor = DebouncedSensor(backend, debounce=0.05, resync=10.0, report=reports)
+    sensor.start()
+    yield sensor
+    sensor.stop()
+
+
+def test_bounce_reaches_clients_as_one_change(backend, sensor, reports):
+    seen = []
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.is_set():
+            seen.append(sensor.value)
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    backend.bounce(1, transitions=6, interval=0.002)
+    assert wait_for(lambda: sensor.value == 1)
+    time.sleep(0.1)
+    sampling.set()
+    sampler.join()
+
+    # the value went from EMPTY to FULL once, never back and forth
+    assert seen[0] == 0 and seen[-1] == 1
+    assert sum(a != b for a, b in zip(seen, seen[1:])) == 1
+    assert reports.edges == 7
+    assert reports.state == sensor.state and reports.state[0] == 1
+
+
+def test_bounce_settling_on_the_old_value_is_not_a_change(backend, sensor, reports):
+    changed = sensor.state[1]
+    backend.bounce(0, transitions=6, interval=0.002)
+    assert wait_for(lambda: reports.bounces == 1)
+    assert sensor.state == (0, changed)
+
+
+def test_edges_from_other_threads_are_all_counted(sensor, reports):
+    def callbacks():
+        for _ in range(5000):
+            sensor._on_edge()
+
+    threads = [threading.Thread(target=callbacks) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert wait_for(lambda: reports.edges == 20000)
+
+
+def test_value_waits_for_the_input_to_be_quiet(backend, sensor):
+    backend.set(1)
+    time.sleep(0.02)
+    backend.set(0)
+    time.sleep(0.02)
+    backend.set(1)
+    # still inside the debounce interval of the last edge
+    assert sensor.value == 0
+    assert wait_for(lambda: sensor.value == 1)
+
+
+def test_resync_picks_up_a_missed_edge(backend):
+    sensor = DebouncedSensor(backend, debounce=0.01, resync=0.05)
+    sensor.start()
+    try:
+        backend.level = 1   # no edge callback
+        assert wait_for(lambda: sensor.value == 1)
+    finally:
+        sensor.stop()
+
+
+def test_stopped_sensor_is_not_ready(backend, monkeypatch):
+    sensor = DebouncedSensor(backend)
+    monkeypatch.setattr(app, "_readiness", {"modbus": ("127.0.0.1", 1), "sensor": sensor})
+    sensor.start()
+    assert not any(p.startswith("sensor:") for p in app.readiness_problems())
+    sensor.stop()
+    assert "sensor: the debounce thread is not running" in app.readiness_problems()
+
+
+def test_crashed_worker_is_not_running(backend, monkeypatch):
+    sensor = DebouncedSensor(backend, debounce=0.01)
+    sensor.start()
+    assert sensor._running
+
+    def broken():
+        raise OSError("pin went away")
+
+    monkeypatch.setattr(threading, "excepthook", lambda args: None)
+    monkeypatch.setattr(backend, "read", broken)
+    backend.set(1)
+    assert wait_for(lambda: not sensor._running)
+    monkeypatch.setattr(app, "_readiness", {"modbus": ("127.0.0.1", 1), "sensor": sensor})
+    assert "sensor: the debounce thread is not running" in app.readiness_problems()
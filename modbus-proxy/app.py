@@ -0,0 +1,479 @@
+"""
+modbus/TCP policy proxy: sits in front of the field device servers and only
+forwards requests that the policy file allows, per device and per point, by
+source address and function code, with writes rate-limited per source
+
+requests are checked on the raw MBAP frames without decoding them any further,
+so the proxy adds as little latency as possible; denied requests are answered
+with a modbus exception and never reach the device
+
+a policy file looks like
+
+    {
+        "devices": {
+            "pump-controller": {
+                "listen": 505, "upstream": "192.168.1.5:502",
+                "points": [
+                    {"name": "pumpOn", "table": "co", "address": 0,
+                     "read": ["192.168.1.0/24"], "write": ["192.168.1.2"],
+                     "write_rate": 1.0, "write_burst": 5}
+                ]
+            }
+        }
+    }
+
+addresses are the zero-based ones on the wire. a point may also set "count"
+to cover a range, "unit" to apply to one unit ID only, and "functions" to
+narrow the function codes allowed on it
+"""
+
+import asyncio
+import ipaddress
+import json
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+
+import click
+
+# devicekit.py sits next to app.py in the image, and in common/ in a checkout
+sys.path.append(str(Path(__file__).resolve().parent.parent / "common"))
+from devicekit import counter, gauge, log_event, render, setup_logging, start_metrics_server
+
+
+# function code: (table, access, how to find the addresses it touches)
+READ, WRITE = "read", "write"
+TABLES = ("co", "di", "hr", "ir")
+FUNCTION_NAMES = {
+    1: "read_coils",
+    2: "read_discrete_inputs",
+    3: "read_holding_registers",
+    4: "read_input_registers",
+    5: "write_single_coil",
+    6: "write_single_register",
+    15: "write_multiple_coils",
+    16: "write_multiple_registers",
+    22: "mask_write_register",
+    23: "read_write_multiple_registers",
+}
+TABLE_FUNCTIONS = {
+    "co": {1, 5, 15},
+    "di": {2},
+    "hr": {3, 6, 16, 22, 23},
+    "ir": {4},
+}
+
+# decisions, and the exception code a denied request is answered with
+ALLOWED = "allowed"
+DENIED_SOURCE = "denied_source"
+DENIED_FUNCTION = "denied_function"
+DENIED_ADDRESS = "denied_address"
+RATE_LIMITED = "rate_limited"
+MALFORMED = "malformed"
+EXCEPTION_CODES = {
+    DENIED_SOURCE: 0x01,    # illegal function
+    DENIED_FUNCTION: 0x01,  # illegal function
+    DENIED_ADDRESS: 0x02,   # illegal data address
+    MALFORMED: 0x03,        # illegal data value
+    RATE_LIMITED: 0x06,     # server device busy
+}
+MAX_PDU = 253
+
+
+def _spans(function, adu):
+    """(table, access, start, count) for every range of points a request touches."""
+    if function in (1, 2, 3, 4):
+        start, count = adu[8] << 8 | adu[9], adu[10] << 8 | adu[11]
+        return ((("co", "di", "hr", "ir")[function - 1], READ, start, count),)
+    if function in (5, 6, 22):
+        return (("co" if function == 5 else "hr", WRITE, adu[8] << 8 | adu[9], 1),)
+    if function in (15, 16):
+        return (("co" if function == 15 else "hr", WRITE, adu[8] << 8 | adu[9], adu[10] << 8 | adu[11]),)
+    if function == 23:
+        return (("hr", READ, adu[8] << 8 | adu[9], adu[10] << 8 | adu[11]),
+                ("hr", WRITE, adu[12] << 8 | adu[13], adu[14] << 8 | adu[15]))
+    return None
+
+
+# request metrics, exposed in prometheus text format on the optional
+# --metrics-port scrape endpoint
+_metrics_lock = threading.Lock()
+_metrics = {
+    "decisions": {},
+    "connections": {},
+    "upstream_failures": {},
+}
+_started = time.time()
+
+
+def _count(name, key):
+    with _metrics_lock:
+        counts = _metrics[name]
+        counts[key] = counts.get(key, 0) + 1
+
+
+def _render_metrics():
+    with _metrics_lock:
+        decisions = sorted(_metrics["decisions"].items())
+        connections = sorted(_metrics["connections"].items())
+        upstream_failures = sorted(_metrics["upstream_failures"].items())
+    return render(
+        counter("psh_proxy_requests", "Modbus requests seen by the proxy, by policy decision",
+                [({"device": device, "decision": decision, "function": function}, count)
+                 for (device, decision, function), count in decisions]),
+        counter("psh_proxy_connections", "Client connections accepted by the proxy",
+                [({"device": device}, count) for device, count in connections]),
+        counter("psh_proxy_upstream_failures", "Client connections closed because the device could not be reached",
+                [({"device": device}, count) for device, count in upstream_failures]),
+        gauge("psh_proxy_start_time_seconds", "Unix time the proxy started", [({}, _started)]),
+    )
+
+
+# readiness, answered at /ready on the metrics port: the proxy is ready once
+# every listener is bound and its event loop runs a callback in time; set by
+# serve. a modbus read of its own would be a request the policy denies
+_readiness = {}
+
+
+def readiness_problems(timeout=0.5):
+    loop = _readiness.get("loop")
+    if loop is None:
+        return ["listeners: not started"]
+    answered = threading.Event()
+    try:
+        loop.call_soon_threadsafe(answered.set)
+    except RuntimeError as e:
+        return [f"event loop: {e}"]
+    if not answered.wait(timeout):
+        return [f"event loop: no response within {timeout} s"]
+    return []
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class Point:
+    def __init__(self, name, table, address, count=1, unit=None, read=(), write=(), functions=None,
+                 write_rate=0.0, write_burst=1):
+        if table not in TABLES:
+            raise ValueError(f"point {name}: unknown table {table!r}")
+        self.name = name
+        self.table = table
+        self.address = address
+        self.count = count
+        self.unit = unit
+        self.read = [ipaddress.ip_network(n, strict=False) for n in read]
+        self.write = [ipaddress.ip_network(n, strict=False) for n in write]
+        self.functions = frozenset(functions) if functions is not None else TABLE_FUNCTIONS[table]
+        if not self.functions <= TABLE_FUNCTIONS[table]:
+            raise ValueError(f"point {name}: function(s) {sorted(self.functions - TABLE_FUNCTIONS[table])} "
+                             f"do not apply to table {table}")
+        self.write_rate = write_rate
+        self.write_burst = write_burst
+        self._buckets = {}
+
+    def bucket(self, source):
+        """The write rate limit of one source, shared by all of its connections."""
+        if not self.write_rate:
+            return None
+        bucket = self._buckets.get(source)
+        if bucket is None:
+            bucket = self._buckets[source] = TokenBucket(self.write_rate, self.write_burst)
+        return bucket
+
+
+class SourceRules:
+    """
+    The points of a device as they apply to one source address, resolved
+    once per (unit, table) so checking a request is a short walk over
+    (start, end, can read, can write, functions, write bucket) tuples.
+    """
+
+    def __init__(self, device, source):
+        self.device = device
+        self.source = source
+        self._tables = {}
+
+    def points(self, unit, table):
+        rules = self._tables.get((unit, table))
+        if rules is None:
+            source = self.source
+            rules = self._tables[(unit, table)] = sorted(
+                (p.address, p.address + p.count, any(source in n for n in p.read), any(source in n for n in p.write),
+                 p.functions, p.bucket(source))
+                for p in self.device.points if p.table == table and p.unit in (None, unit))
+        return rules
+
+
+class Device:
+    def __init__(self, name, listen, upstream, points):
+        self.name = name
+        self.listen = listen
+        host, _, port = upstream.rpartition(":")
+        self.upstream = (host, int(port))
+        self.points = points
+        self._rules = {}
+        self._denials = set()
+
+    def rules_for(self, source):
+        rules = self._rules.get(source)
+        if rules is None:
+            address = ipaddress.ip_address(source)
+            if address.version == 6 and address.ipv4_mapped is not None:
+                address = address.ipv4_mapped
+            rules = self._rules[source] = SourceRules(self, address)
+        return rules
+
+    def check(self, rules, adu):
+        function = adu[7]
+        try:
+            spans = _spans(function, adu)
+        except IndexError:
+            return MALFORMED
+        if spans is None:
+            return DENIED_FUNCTION
+
+        buckets = None
+        for table, access, start, count in spans:
+            if count == 0:
+                return MALFORMED
+            # walk the points in address order until the whole range is covered
+            cursor, end = start, start + count
+            for p_start, p_end, can_read, can_write, functions, bucket in rules.points(adu[6], table):
+                if p_end <= cursor:
+                    continue
+                if p_start > cursor:
+                    break
+                if function not in functions:
+                    return DENIED_FUNCTION
+                if not (can_write if access is WRITE else can_read):
+                    return DENIED_SOURCE
+                if access is WRITE and bucket is not None:
+                    buckets = buckets or []
+                    buckets.append(bucket)
+                cursor = p_end
+                if cursor >= end:
+                    break
+            if cursor < end:
+                return DENIED_ADDRESS
+
+        if buckets:
+            now = time.monotonic()
+            if any(bucket.refill(now) < 1 for bucket in buckets):
+                return RATE_LIMITED
+            for bucket in buckets:
+                bucket.tokens -= 1
+        return ALLOWED
+
+    def denied(self, source, adu, decision):
+        function = FUNCTION_NAMES.get(adu[7], adu[7])
+        key = (source, adu[7], decision)
+        if key in self._denials:
+            logging.debug(f"{self.name}: {decision} {function} from {source}")
+            return
+        # the first denial of a kind is an event, the counters carry the rest
+        self._denials.add(key)
+        log_event("denied", f"{self.name}: {decision} {function} from {source}", logging.WARNING,
+                  device=self.name, source=source, function=function, decision=decision, unit=adu[6])
+
+
+def _exception(adu, decision):
+    return adu[:4] + b"\x00\x03" + adu[6:7] + bytes((adu[7] | 0x80, EXCEPTION_CODES[decision]))
+
+
+class UpstreamConnection(asyncio.Protocol):
+    """The proxy's connection to the device; responses go straight back to the client."""
+
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.client.transport.write(data)
+
+    def connection_lost(self, exc):
+        self.client.upstream_lost(exc)
+
+    def pause_writing(self):
+        self.client.transport.pause_reading()
+
+    def resume_writing(self):
+        self.client.transport.resume_reading()
+
+
+class ClientConnection(asyncio.Protocol):
+    """
+    One client connection, proxied over a connection of its own to the
+    device so transaction IDs pass through untouched. Reading from the
+    client is paused until the device connection is up; whatever arrives
+    anyway is held until then.
+    """
+
+    def __init__(self, device, connect_timeout):
+        self.device = device
+        self.connect_timeout = connect_timeout
+        self.transport = None
+        self.upstream = None
+        self.buffer = b""
+        self.pending = []
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.source = transport.get_extra_info("peername")[0]
+        self.rules = self.device.rules_for(self.source)
+        _count("connections", self.device.name)
+        logging.debug(f"{self.device.name}: connection from {self.source}")
+        transport.pause_reading()
+        self._connecting = asyncio.get_running_loop().create_task(self._connect())
+
+    async def _connect(self):
+        host, port = self.device.upstream
+        try:
+            transport, _ = await asyncio.wait_for(asyncio.get_running_loop().create_connection(
+                lambda: UpstreamConnection(self), host, port), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            _count("upstream_failures", self.device.name)
+            logging.warning(f"{self.device.name}: could not reach {host}:{port}, closing the connection from {self.source}: {e}")
+            self.transport.close()
+            return
+        if self.closed:
+            transport.close()
+            return
+        self.upstream = transport
+        if self.pending:
+            transport.write(b"".join(self.pending))
+            self.pending = None
+        self.transport.resume_reading()
+
+    def data_received(self, data):
+        buffer = self.buffer + data if self.buffer else data
+        device, size, pos = self.device, len(buffer), 0
+        forward = []
+        while size - pos >= 8:
+            length = buffer[pos + 4] << 8 | buffer[pos + 5]
+            if buffer[pos + 2] or buffer[pos + 3] or not 2 <= length <= MAX_PDU + 1:
+                # not modbus, or out of step; there is no way to find the next frame
+                _count("decisions", (device.name, MALFORMED, "-"))
+                logging.warning(f"{device.name}: malformed frame from {self.source}, closing the connection")
+                self.transport.close()
+                return
+            end = pos + 6 + length
+            if end > size:
+                break
+            adu = buffer if pos == 0 and end == size else buffer[pos:end]
+            decision = device.check(self.rules, adu)
+            _count("decisions", (device.name, decision, FUNCTION_NAMES.get(adu[7], str(adu[7]))))
+            if decision is ALLOWED:
+                forward.append(adu)
+            else:
+                self.transport.write(_exception(adu, decision))
+                device.denied(self.source, adu, decision)
+            pos = end
+        self.buffer = buffer[pos:] if pos < size else b""
+        if forward:
+            data = forward[0] if len(forward) == 1 else b"".join(forward)
+            if self.upstream is not None:
+                self.upstream.write(data)
+            else:
+                self.pending.append(data)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.upstream is not None:
+            self.upstream.close()
+        else:
+            self._connecting.cancel()
+
+    def upstream_lost(self, exc):
+        if not self.closed:
+            logging.debug(f"{self.device.name}: device closed the connection of {self.source}")
+            self.transport.close()
+
+    def pause_writing(self):
+        if self.upstream is not None:
+            self.upstream.pause_reading()
+
+    def resume_writing(self):
+        if self.upstream is not None:
+            self.upstream.resume_reading()
+
+
+def load_policy(path):
+    with open(path) as f:
+        config = json.load(f)
+    devices = []
+    for name, device in config["devices"].items():
+        points = [Point(p["name"], p["table"], p["address"], p.get("count", 1), p.get("unit"),
+                        p.get("read", ()), p.get("write", ()), p.get("functions"),
+                        p.get("write_rate", 0.0), p.get("write_burst", 1))
+                  for p in device.get("points", [])]
+        devices.append(Device(name, device["listen"], device["upstream"], points))
+    listens = [d.listen for d in devices]
+    if len(set(listens)) != len(listens):
+        raise ValueError(f"{path}: devices must listen on different ports")
+    return devices
+
+
+async def serve(devices, host, connect_timeout):
+    loop = asyncio.get_running_loop()
+    servers = []
+    for device in devices:
+        server = await loop.create_server(lambda device=device: ClientConnection(device, connect_timeout),
+                                          host, device.listen, reuse_address=True)
+        servers.append(server)
+        logging.info(f"proxying {host}:{device.listen} to {device.upstream[0]}:{device.upstream[1]} "
+                     f"({device.name}, {len(device.points)} point(s))")
+    _readiness["loop"] = loop
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def run_proxy(policy, host, connect_timeout, metrics_port=None, **args):
+    devices = load_policy(policy)
+    if metrics_port is not None:
+        start_metrics_server(host, metrics_port, _render_metrics, readiness_problems)
+    try:
+        import uvloop
+        logging.info("using uvloop")
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(serve(devices, host, connect_timeout))
+
+
+@click.group()
+@click.option("--log", "-l", default="info", help="The log level to use when sending logs to stdout (default: INFO; options: DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+@click.option("--log-format", "-lf", default="text", type=click.Choice(["text", "json"], case_sensitive=False), help="Write log records as plain text or as one JSON object per line (default: text)")
+@click.option("--log-rate", "-lr", default=5.0, help="Log records per second allowed from any one line of code after a burst of 20, 0 to disable (default: 5.0)")
+def cli(log, log_format, log_rate):
+    log_level = getattr(logging, log.upper())
+    setup_logging(log_level, log_format, log_rate)
+    logging.info(f"logging level set to {log.upper()}")
+
+@click.command()
+@click.option("--policy", "-pf", default="/opt/csci498/policy.json", type=click.Path(exists=True, dir_okay=False), help="The JSON policy naming every device to proxy and what may be done to its points (default: /opt/csci498/policy.json)")
+@click.option("--host", "-h", default="0.0.0.0", help="The address to listen on; each device gets the port set in the policy (default: 0.0.0.0)")
+@click.option("--connect-timeout", "-ct", default=1.0, help="Seconds to wait for a device when a client connects before giving up on the client (default: 1.0)")
+@click.option("--metrics-port", "-mp", default=None, type=int, help="Serve Prometheus metrics on this port at /metrics, and readiness at /ready (default: disabled)")
+def run(**args):
+    logging.info(f"starting Modbus policy proxy (policy={args['policy']})")
+    run_proxy(**args)
+
+if __name__ == "__main__":
+    cli.add_command(run)
+    cli()
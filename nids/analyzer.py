@@ -0,0 +1,544 @@
+"""
+streaming modbus/TCP analyzer for pcap and pcapng captures: per-source,
+per-function-code and per-unit statistics, plus alerts for write floods (like
+attacker/modbusattacks/pumpforce.py) and writes from unexpected hosts
+
+capture files are memory-mapped and walked in place, so multi-GB captures
+never have to fit in memory; `live` reads the same formats from a pipe:
+
+    python analyzer.py analyze capture.pcapng --writer 192.168.1.2
+    tcpdump -i any -U -w - 'tcp port 502' | python analyzer.py live - --writer 192.168.1.2
+
+modbus ADUs are decoded per TCP segment without stream reassembly; an ADU
+split across segments is counted as truncated
+"""
+
+import collections
+import json
+import mmap
+import socket
+import struct
+import sys
+import time
+
+import click
+
+
+FUNCTIONS = {
+    1: "read_coils",
+    2: "read_discrete_inputs",
+    3: "read_holding_registers",
+    4: "read_input_registers",
+    5: "write_single_coil",
+    6: "write_single_register",
+    8: "diagnostics",
+    15: "write_multiple_coils",
+    16: "write_multiple_registers",
+    22: "mask_write_register",
+    23: "read_write_multiple_registers",
+    43: "encapsulated_interface",
+}
+WRITE_FUNCTIONS = frozenset((5, 6, 15, 16, 22, 23))
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER = 0x1A2B3C4D
+
+# link types: null/loopback, ethernet, raw IP, linux cooked v1 and v2, raw IPv4/IPv6
+LINK_NULL, LINK_ETHERNET, LINK_RAW, LINK_SLL, LINK_SLL2, LINK_IPV4, LINK_IPV6 = 0, 1, 101, 113, 276, 228, 229
+
+_u16 = struct.Struct(">H")
+_ports = struct.Struct(">HH")
+_mbap = struct.Struct(">HHHBB")
+# ethertype through TCP ports of an ethernet frame carrying IPv4 without options,
+# which is nearly every frame on the plant network
+_ethernet_ipv4 = struct.Struct(">HBxH5xB2x4s4sHH")
+_structs = {endian: {name: struct.Struct(endian + fmt) for name, fmt in
+                     (("I", "I"), ("H", "H"), ("HH", "HH"), ("II", "II"), ("IIII", "IIII"))}
+            for endian in "<>"}
+
+
+class CaptureError(Exception):
+    pass
+
+
+def _ip_offset(linktype, buf, off, length):
+    """Offset of the IP header in a frame, or None if it carries no IP."""
+    if linktype == LINK_ETHERNET:
+        if length < 14:
+            return None
+        ethertype = _u16.unpack_from(buf, off + 12)[0]
+        off += 14
+        while ethertype in (0x8100, 0x88A8) and length >= 18:
+            ethertype = _u16.unpack_from(buf, off + 2)[0]
+            off += 4
+        return off if ethertype in (0x0800, 0x86DD) else None
+    if linktype == LINK_SLL:
+        return off + 16 if length >= 16 and _u16.unpack_from(buf, off + 14)[0] in (0x0800, 0x86DD) else None
+    if linktype == LINK_SLL2:
+        return off + 20 if length >= 20 and _u16.unpack_from(buf, off)[0] in (0x0800, 0x86DD) else None
+    if linktype == LINK_NULL:
+        return off + 4
+    if linktype in (LINK_RAW, LINK_IPV4, LINK_IPV6):
+        return off
+    return None
+
+
+def _tcp_segment(linktype, buf, off, length):
+    """(source, destination, source port, destination port, TCP offset, end of segment) of a TCP frame, or None."""
+    ip = _ip_offset(linktype, buf, off, length)
+    frame_end = off + length
+    if ip is None or ip + 20 > frame_end:
+        return None
+    version = buf[ip] >> 4
+    if version == 4:
+        if buf[ip + 9] != 6:
+            return None
+        tcp = ip + (buf[ip] & 0x0F) * 4
+        end = ip + _u16.unpack_from(buf, ip + 2)[0]
+        src, dst = bytes(buf[ip + 12:ip + 16]), bytes(buf[ip + 16:ip + 20])
+    elif version == 6:
+        if ip + 40 > frame_end or buf[ip + 6] != 6:
+            return None
+        tcp = ip + 40
+        end = tcp + _u16.unpack_from(buf, ip + 4)[0]
+        src, dst = bytes(buf[ip + 8:ip + 24]), bytes(buf[ip + 24:ip + 40])
+    else:
+        return None
+    end = end if end < frame_end else frame_end
+    if tcp + 20 > end:
+        return None
+    return (src, dst) + _ports.unpack_from(buf, tcp) + (tcp, end)
+
+
+class Analyzer:
+    """
+    Feed it frames with feed(); report() returns the statistics. Write
+    requests are counted per (source, server, unit, function, address) in a
+    sliding window of `flood_window` seconds, and `flood_writes` of them
+    raise a write_flood alert. With `writers`, any write request from
+    another host raises an unexpected_writer alert.
+    """
+
+    def __init__(self, port=502, flood_writes=10, flood_window=60.0, writers=(), on_alert=None):
+        self.port = port
+        self.flood_writes = flood_writes
+        self.flood_window = flood_window
+        self.writers = frozenset(socket.inet_pton(socket.AF_INET6 if ":" in w else socket.AF_INET, w) for w in writers)
+        self.on_alert = on_alert
+
+        self.frames = 0
+        self.bytes = 0
+        self.modbus_segments = 0
+        self.requests = 0
+        self.responses = 0
+        self.exceptions = 0
+        self.malformed = 0
+        self.truncated = 0
+        self.first = None
+        self.last = None
+
+        self.sources = collections.defaultdict(lambda: {"requests": 0, "writes": 0, "servers": set()})
+        self.servers = collections.Counter()
+        self.functions = collections.defaultdict(lambda: [0, 0])
+        self.units = collections.Counter()
+        self.alerts = []
+        self._windows = collections.defaultdict(collections.deque)
+        self._flooding = set()
+        self._unexpected = set()
+        # addresses are kept as raw bytes and only formatted for alerts and reports
+        self._addresses = {}
+
+    def _alert(self, alert):
+        self.alerts.append(alert)
+        if self.on_alert is not None:
+            self.on_alert(alert)
+
+    def feed(self, ts, linktype, buf, off, length):
+        self.frames += 1
+        self.bytes += length
+        if self.first is None:
+            self.first = ts
+        self.last = ts
+        port = self.port
+
+        if linktype == LINK_ETHERNET and length >= 54:
+            ethertype, version, total, protocol, src, dst, sport, dport = _ethernet_ipv4.unpack_from(buf, off + 12)
+            if ethertype == 0x0800 and version == 0x45:
+                if protocol != 6 or (sport != port and dport != port):
+                    return
+                tcp = off + 34
+                end = tcp - 20 + total
+                if end > off + length:
+                    end = off + length
+            else:
+                segment = _tcp_segment(linktype, buf, off, length)
+                if segment is None:
+                    return
+                src, dst, sport, dport, tcp, end = segment
+        else:
+            segment = _tcp_segment(linktype, buf, off, length)
+            if segment is None:
+                return
+            src, dst, sport, dport, tcp, end = segment
+        if sport != port and dport != port:
+            return
+
+        p = tcp + (buf[tcp + 12] >> 4) * 4
+        if p >= end:
+            return
+        self.modbus_segments += 1
+        request = dport == port
+
+        while p + 8 <= end:
+            _, protocol, mbap_length, unit, function = _mbap.unpack_from(buf, p)
+            if protocol != 0 or mbap_length < 2:
+                self.malformed += 1
+                return
+            if p + 6 + mbap_length > end:
+                self.truncated += 1
+                return
+            if request:
+                self._request(ts, src, dst, unit, function, buf, p + 8, mbap_length - 2)
+            else:
+                self.responses += 1
+                if function & 0x80:
+                    self.exceptions += 1
+                    self.functions[function & 0x7F][1] += 1
+            p += 6 + mbap_length
+
+    def _address(self, raw):
+        address = self._addresses.get(raw)
+        if address is None:
+            address = self._addresses[raw] = socket.inet_ntop(socket.AF_INET if len(raw) == 4 else socket.AF_INET6, raw)
+        return address
+
+    def _request(self, ts, src, dst, unit, function, buf, data, data_length):
+        self.requests += 1
+        source = self.sources[src]
+        source["requests"] += 1
+        source["servers"].add(dst)
+        self.servers[dst] += 1
+        self.functions[function][0] += 1
+        self.units[unit] += 1
+        if function not in WRITE_FUNCTIONS:
+            return
+
+        source["writes"] += 1
+        address = _u16.unpack_from(buf, data)[0] if data_length >= 2 else None
+        if self.writers and src not in self.writers and (src, dst) not in self._unexpected:
+            self._unexpected.add((src, dst))
+            self._alert({"alert": "unexpected_writer", "ts": ts, "source": self._address(src),
+                         "server": self._address(dst), "unit": unit,
+                         "function": FUNCTIONS.get(function, function), "address": address})
+
+        key = (src, dst, unit, function, address)
+        window = self._windows[key]
+        window.append(ts)
+        while ts - window[0] > self.flood_window:
+            window.popleft()
+        if len(window) >= self.flood_writes:
+            if key not in self._flooding:
+                self._flooding.add(key)
+                value = None
+                if function == 5 and data_length >= 4:
+                    value = 1 if _u16.unpack_from(buf, data + 2)[0] == 0xFF00 else 0
+                self._alert({"alert": "write_flood", "ts": ts, "since": window[0], "source": self._address(src),
+                             "server": self._address(dst), "unit": unit, "function": FUNCTIONS.get(function, function), "address": address,
+                             "value": value, "writes": len(window), "window": self.flood_window})
+        elif len(window) < self.flood_writes // 2:
+            self._flooding.discard(key)
+
+    def report(self):
+        duration = (self.last - self.first) if self.first is not None else 0.0
+        return {
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "first": self.first,
+            "last": self.last,
+            "seconds": duration,
+            "modbus_segments": self.modbus_segments,
+            "requests": self.requests,
+            "responses": self.responses,
+            "exceptions": self.exceptions,
+            "malformed": self.malformed,
+            "truncated": self.truncated,
+            "sources": dict(sorted((self._address(ip), {
+                "requests": s["requests"], "writes": s["writes"],
+                "servers": sorted(map(self._address, s["servers"])),
+                "requests_per_second": s["requests"] / duration if duration else None,
+            }) for ip, s in self.sources.items())),
+            "servers": dict(sorted((self._address(ip), n) for ip, n in self.servers.items())),
+            "functions": {FUNCTIONS.get(fc, str(fc)): {"code": fc, "requests": n, "exceptions": e}
+                          for fc, (n, e) in sorted(self.functions.items())},
+            "units": {str(unit): n for unit, n in sorted(self.units.items())},
+            "alerts": self.alerts,
+        }
+
+
+def _pcap_mapped(buf):
+    endian, scale = PCAP_MAGIC[bytes(buf[:4])]
+    linktype = _structs[endian]["I"].unpack_from(buf, 20)[0] & 0x0FFFFFFF
+    record = struct.Struct(endian + "IIII")
+    pos, size = 24, len(buf)
+    while pos + 16 <= size:
+        seconds, fraction, caplen, _ = record.unpack_from(buf, pos)
+        pos += 16
+        if pos + caplen > size:
+            break
+        yield seconds + fraction * scale, linktype, buf, pos, caplen
+        pos += caplen
+
+
+def _read_exact(stream, n):
+    data = stream.read(n)
+    while data is not None and len(data) < n:
+        more = stream.read(n - len(data))
+        if not more:
+            return None
+        data += more
+    return data
+
+
+def _pcap_stream(stream, magic):
+    endian, scale = PCAP_MAGIC[magic]
+    header = _read_exact(stream, 20)
+    if header is None:
+        return
+    linktype = _structs[endian]["I"].unpack_from(header, 16)[0] & 0x0FFFFFFF
+    record = struct.Struct(endian + "IIII")
+    while True:
+        header = _read_exact(stream, 16)
+        if header is None:
+            return
+        seconds, fraction, caplen, _ = record.unpack(header)
+        data = _read_exact(stream, caplen)
+        if data is None:
+            return
+        yield seconds + fraction * scale, linktype, data, 0, caplen
+
+
+def _pcapng_blocks_stream(stream, first):
+    head, endian = first, "<"
+    while True:
+        rest = _read_exact(stream, 8 - len(head))
+        if rest is None:
+            return
+        head += rest
+        if struct.unpack_from("<I", head)[0] == PCAPNG_SHB:
+            order = _read_exact(stream, 4)
+            if order is None:
+                return
+            endian = "<" if struct.unpack("<I", order)[0] == PCAPNG_BYTE_ORDER else ">"
+            block_type, length = _structs[endian]["II"].unpack(head)
+            body = _read_exact(stream, length - 12)
+            if body is None:
+                return
+            body = order + body
+        else:
+            block_type, length = _structs[endian]["II"].unpack(head)
+            body = _read_exact(stream, length - 8)
+            if body is None:
+                return
+        yield block_type, endian, body, 0, length - 12
+        head = b""
+
+
+def _pcapng_interface(endian, buf, body, body_length):
+    """(link type, seconds per timestamp unit) of an interface description block."""
+    linktype = _structs[endian]["H"].unpack_from(buf, body)[0]
+    scale = 1e-6
+    # walk the options for if_tsresol (code 9)
+    pos, end = body + 8, body + body_length
+    while pos + 4 <= end:
+        code, length = _structs[endian]["HH"].unpack_from(buf, pos)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            resolution = buf[pos + 4]
+            scale = 2.0 ** -(resolution & 0x7F) if resolution & 0x80 else 10.0 ** -resolution
+        pos += 4 + (length + 3) // 4 * 4
+    return linktype, scale
+
+
+def _pcapng_packets(blocks):
+    interfaces = []
+    for block_type, endian, buf, body, body_length in blocks:
+        if block_type == PCAPNG_EPB:
+            interface, high, low, caplen = _structs[endian]["IIII"].unpack_from(buf, body)
+            if interface >= len(interfaces):
+                raise CaptureError(f"packet refers to undeclared interface {interface}")
+            linktype, scale = interfaces[interface]
+            yield ((high << 32) | low) * scale, linktype, buf, body + 20, caplen
+        elif block_type == PCAPNG_SHB:
+            interfaces = []
+        elif block_type == PCAPNG_IDB:
+            interfaces.append(_pcapng_interface(endian, buf, body, body_length))
+        elif block_type == PCAPNG_SPB:
+            if not interfaces:
+                raise CaptureError("simple packet block before any interface description")
+            # simple packet blocks carry no timestamp or captured length
+            yield None, interfaces[0][0], buf, body + 4, body_length - 4
+
+
+def _pcapng_mapped(buf):
+    # the block walk of _pcapng_packets inlined, since this loop runs once per frame
+    pos, size, endian = 0, len(buf), "<"
+    interfaces = []
+    block = _structs[endian]["II"]
+    packet = _structs[endian]["IIII"]
+    while pos + 12 <= size:
+        block_type, length = block.unpack_from(buf, pos)
+        if block_type == PCAPNG_SHB:
+            # a section header's type reads the same either way round; its byte
+            # order, and so its length, only follows from the magic after the length
+            endian = "<" if struct.unpack_from("<I", buf, pos + 8)[0] == PCAPNG_BYTE_ORDER else ">"
+            block = _structs[endian]["II"]
+            packet = _structs[endian]["IIII"]
+            length = block.unpack_from(buf, pos)[1]
+            interfaces = []
+        if length < 12 or pos + length > size:
+            break
+        if block_type == PCAPNG_EPB:
+            interface, high, low, caplen = packet.unpack_from(buf, pos + 8)
+            if interface >= len(interfaces):
+                raise CaptureError(f"packet refers to undeclared interface {interface}")
+            linktype, scale = interfaces[interface]
+            yield ((high << 32) | low) * scale, linktype, buf, pos + 28, caplen
+        elif block_type == PCAPNG_IDB:
+            interfaces.append(_pcapng_interface(endian, buf, pos + 8, length - 12))
+        elif block_type == PCAPNG_SPB:
+            if not interfaces:
+                raise CaptureError("simple packet block before any interface description")
+            yield None, interfaces[0][0], buf, pos + 12, length - 16
+        pos += length
+
+
+def frames_mapped(buf):
+    """Frames of a pcap or pcapng capture held in a buffer (e.g. an mmap)."""
+    magic = bytes(buf[:4])
+    if magic in PCAP_MAGIC:
+        return _pcap_mapped(buf)
+    if struct.unpack("<I", magic)[0] == PCAPNG_SHB:
+        return _pcapng_mapped(buf)
+    raise CaptureError("not a pcap or pcapng capture")
+
+
+def frames_stream(stream):
+    """Frames of a pcap or pcapng capture read incrementally from a binary stream."""
+    magic = _read_exact(stream, 4)
+    if magic is None:
+        return iter(())
+    if magic in PCAP_MAGIC:
+        return _pcap_stream(stream, magic)
+    if struct.unpack("<I", magic)[0] == PCAPNG_SHB:
+        return _pcapng_packets(_pcapng_blocks_stream(stream, magic))
+    raise CaptureError("not a pcap or pcapng capture")
+
+
+def analyze_file(path, analyzer):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            last = 0.0
+            for ts, linktype, data, off, length in frames_mapped(buf):
+                # simple packet blocks have no timestamp; keep the previous one
+                last = ts if ts is not None else last
+                analyzer.feed(last, linktype, data, off, length)
+    return analyzer
+
+
+def _print_report(report):
+    click.echo(f"{report['frames']} frame(s), {report['bytes'] / 1e6:.1f} MB over {report['seconds']:.1f} s; "
+               f"{report['requests']} modbus request(s), {report['responses']} response(s), "
+               f"{report['exceptions']} exception(s), {report['malformed']} malformed, {report['truncated']} truncated")
+    click.echo("\nsources:")
+    for ip, source in report["sources"].items():
+        click.echo(f"  {ip:<39} {source['requests']:>10} requests {source['writes']:>10} writes  -> {', '.join(source['servers'])}")
+    click.echo("\nfunction codes:")
+    for name, function in report["functions"].items():
+        click.echo(f"  {function['code']:>3} {name:<28} {function['requests']:>10} requests {function['exceptions']:>8} exceptions")
+    click.echo("\nunits:")
+    for unit, count in report["units"].items():
+        click.echo(f"  {unit:>3} {count:>10} requests")
+    click.echo(f"\n{len(report['alerts'])} alert(s)")
+    for alert in report["alerts"]:
+        click.echo("  " + json.dumps(alert))
+
+
+def _analyzer(args, on_alert=None):
+    return Analyzer(args['port'], args['flood_writes'], args['flood_window'], args['writer'], on_alert)
+
+
+_analysis_options = [
+    click.option("--port", "-p", default=502, help="TCP port of the Modbus servers (default: 502)"),
+    click.option("--flood-writes", "-fw", default=10, help="Write requests to the same point from one source within the window that count as a flood (default: 10)"),
+    click.option("--flood-window", "-fs", default=60.0, help="Sliding window in seconds for flood detection (default: 60)"),
+    click.option("--writer", "-w", multiple=True, help="Host allowed to write (the coordinator); writes from anyone else are flagged; may be repeated (default: no check)"),
+]
+
+
+def analysis_options(command):
+    for option in reversed(_analysis_options):
+        command = option(command)
+    return command
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.argument("capture", type=click.Path(exists=True, dir_okay=False))
+@analysis_options
+@click.option("--json", "as_json", is_flag=True, help="Print the report as JSON")
+def analyze(capture, as_json, **args):
+    """Analyze a pcap or pcapng capture file."""
+    start = time.perf_counter()
+    analyzer = analyze_file(capture, _analyzer(args))
+    elapsed = time.perf_counter() - start
+    report = analyzer.report()
+    report["analysis_seconds"] = elapsed
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+        click.echo(f"\nanalyzed in {elapsed:.2f} s ({analyzer.bytes / 1e6 / elapsed if elapsed else 0:.0f} MB/s)", err=True)
+
+
+@cli.command()
+@click.argument("source", default="-", type=click.Path(allow_dash=True, dir_okay=False))
+@analysis_options
+@click.option("--report-interval", "-ri", default=60.0, help="Seconds between statistics reports on stderr, 0 for only at the end (default: 60)")
+def live(source, report_interval, **args):
+    """Analyze a capture as it is written to a pipe (- for stdin); alerts are printed as JSON lines."""
+    def on_alert(alert):
+        click.echo(json.dumps(alert))
+        sys.stdout.flush()
+
+    analyzer = _analyzer(args, on_alert)
+    stream = sys.stdin.buffer if source == "-" else open(source, "rb")
+    next_report = time.monotonic() + report_interval
+    last = 0.0
+    try:
+        for ts, linktype, data, off, length in frames_stream(stream):
+            last = ts if ts is not None else time.time()
+            analyzer.feed(last, linktype, data, off, length)
+            if report_interval and time.monotonic() >= next_report:
+                next_report += report_interval
+                click.echo(json.dumps({k: v for k, v in analyzer.report().items() if k != "alerts"}), err=True)
+    except KeyboardInterrupt:
+        pass
+    click.echo(json.dumps({k: v for k, v in analyzer.report().items() if k != "alerts"}), err=True)
+
+
+if __name__ == "__main__":
+    cli()
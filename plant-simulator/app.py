@@ -0,0 +1,187 @@
+"""
+simulated pumped storage plant shared by the debug modbus servers: the pump
+and gate servers report their coils to it and the level sensor server reads
+the upper reservoir level from it, with a clock that can run many times
+faster than real time
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+
+import click
+
+
+class PlantModel:
+    def __init__(self, upper_capacity, lower_capacity, upper_volume, pump_rate, gate_rate,
+                 sensor_threshold, acceleration, sunrise, sunset, start_hour):
+        self.upper_capacity = upper_capacity
+        self.lower_capacity = lower_capacity
+        self.upper_volume = upper_volume
+        self.lower_volume = lower_capacity - upper_volume
+        self.pump_rate = pump_rate
+        self.gate_rate = gate_rate
+        self.sensor_threshold = sensor_threshold
+        self.acceleration = acceleration
+        self.sunrise = sunrise
+        self.sunset = sunset
+
+        self.pump_on = 0
+        self.gate_open = 0
+        self.sim_time = start_hour * 3600.0
+
+        # totals in simulated seconds, reported once per simulated day
+        self.pump_seconds = 0.0
+        self.gate_seconds = 0.0
+        self.spill_seconds = 0.0
+        self.dry_run_seconds = 0.0
+        self.pumped_volume = 0.0
+        self.drained_volume = 0.0
+        self.min_level = 1.0
+        self.max_level = 0.0
+
+        self._lock = threading.Lock()
+
+    def level(self):
+        return self.upper_volume / self.upper_capacity
+
+    def level_high(self):
+        return 1 if self.level() >= self.sensor_threshold else 0
+
+    def is_day(self):
+        hour = (self.sim_time % 86400) / 3600
+        return 1 if self.sunrise <= hour < self.sunset else 0
+
+    def step(self, real_seconds):
+        with self._lock:
+            dt = real_seconds * self.acceleration
+            day_before = int(self.sim_time // 86400)
+
+            if self.pump_on:
+                self.pump_seconds += dt
+                lifted = min(self.pump_rate * dt, self.lower_volume)
+                if lifted < self.pump_rate * dt:
+                    self.dry_run_seconds += dt
+                room = self.upper_capacity - self.upper_volume
+                if lifted > room:
+                    # the upper reservoir is full, the excess spills back down
+                    self.spill_seconds += dt
+                    lifted = room
+                self.lower_volume -= lifted
+                self.upper_volume += lifted
+                self.pumped_volume += lifted
+
+            if self.gate_open:
+                self.gate_seconds += dt
+                drained = min(self.gate_rate * dt, self.upper_volume, self.lower_capacity - self.lower_volume)
+                self.upper_volume -= drained
+                self.lower_volume += drained
+                self.drained_volume += drained
+
+            self.min_level = min(self.min_level, self.level())
+            self.max_level = max(self.max_level, self.level())
+            self.sim_time += dt
+
+            if int(self.sim_time // 86400) != day_before:
+                self._report_day(day_before)
+
+    def _report_day(self, day):
+        logging.info(f"day {day}: level {self.min_level:.0%}..{self.max_level:.0%}, "
+                     f"pumped {self.pumped_volume:.0f} m3 in {self.pump_seconds / 3600:.1f} h, "
+                     f"drained {self.drained_volume:.0f} m3 in {self.gate_seconds / 3600:.1f} h, "
+                     f"spilling {self.spill_seconds / 3600:.1f} h, running dry {self.dry_run_seconds / 3600:.1f} h")
+        if self.spill_seconds or self.dry_run_seconds:
+            logging.warning(f"day {day}: pump ran against a full upper or empty lower reservoir")
+        self.pump_seconds = self.gate_seconds = self.spill_seconds = self.dry_run_seconds = 0.0
+        self.pumped_volume = self.drained_volume = 0.0
+        self.min_level = self.max_level = self.level()
+
+    def set_coil(self, name, value):
+        with self._lock:
+            if name == "pump":
+                self.pump_on = 1 if value else 0
+            elif name == "gate":
+                self.gate_open = 1 if value else 0
+            else:
+                raise ValueError(f"unknown coil {name!r}")
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "t": self.sim_time,
+                "day": self.is_day(),
+                "level": round(self.level(), 6),
+                "levelHigh": self.level_high(),
+                "upper": self.upper_volume,
+                "lower": self.lower_volume,
+                "pump": self.pump_on,
+                "gate": self.gate_open,
+            }
+
+
+def run_clock(model, tick):
+    last = time.monotonic()
+    while True:
+        time.sleep(tick)
+        now = time.monotonic()
+        model.step(now - last)
+        last = now
+
+
+def serve(model, host, port):
+    # one datagram per request: "get" or "set <pump|gate> <0|1>", optionally
+    # preceded by a sequence number; the reply is always the plant snapshot as
+    # JSON, carrying the request's sequence number as "seq" so a client can
+    # tell it from a late reply to an earlier request
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    logging.info(f"running plant simulator at {host}:{port} (x{model.acceleration:g} real time)")
+    while True:
+        data, peer = sock.recvfrom(512)
+        parts = data.decode(errors="replace").split()
+        seq = int(parts.pop(0)) if parts and parts[0].isdigit() else None
+        try:
+            if parts[:1] == ["set"] and len(parts) == 3:
+                model.set_coil(parts[1], int(parts[2]))
+                logging.debug(f"{peer[0]}:{peer[1]} set {parts[1]} to {parts[2]}")
+            elif parts != ["get"]:
+                raise ValueError(f"bad request {data!r}")
+            reply = model.snapshot()
+        except ValueError as e:
+            reply = {"error": str(e)}
+        if seq is not None:
+            reply["seq"] = seq
+        sock.sendto(json.dumps(reply).encode(), peer)
+
+
+@click.command()
+@click.option("--log", "-l", default="info", help="The log level to use when sending logs to stdout (default: INFO; options: DEBUG, INFO, WARNING, ERROR, CRITICAL)")
+@click.option("--host", "-h", default="0.0.0.0", help="The address to use when creating the simulator's UDP socket (default: 0.0.0.0)")
+@click.option("--port", "-p", default=5020, help="The UDP port to serve the simulated plant on (default: 5020)")
+@click.option("--acceleration", "-a", default=1.0, help="Simulated seconds per real second, e.g. 1440 runs a day per minute (default: 1.0)")
+@click.option("--tick", "-t", default=0.01, help="Real seconds between integration steps (default: 0.01)")
+@click.option("--upper-capacity", default=100000.0, help="Upper reservoir capacity in m3 (default: 100000)")
+@click.option("--lower-capacity", default=120000.0, help="Lower reservoir capacity in m3 (default: 120000)")
+@click.option("--upper-volume", default=50000.0, help="Initial upper reservoir volume in m3 (default: 50000)")
+@click.option("--pump-rate", default=4.0, help="Volume the pump lifts in m3/s (default: 4.0)")
+@click.option("--gate-rate", default=5.0, help="Volume the open gate drains in m3/s (default: 5.0)")
+@click.option("--sensor-threshold", default=0.9, help="Upper reservoir fill fraction at which the level sensor reads high (default: 0.9)")
+@click.option("--sunrise", default=6.0, help="Simulated hour of sunrise (default: 6)")
+@click.option("--sunset", default=18.0, help="Simulated hour of sunset (default: 18)")
+@click.option("--start-hour", default=0.0, help="Simulated hour of day to start at (default: 0)")
+def main(**args):
+    log_level = getattr(logging, args['log'].upper())
+    logging.basicConfig(level=log_level)
+    logging.info(f"logging level set to {args['log'].upper()}")
+
+    model = PlantModel(args['upper_capacity'], args['lower_capacity'], args['upper_volume'],
+                       args['pump_rate'], args['gate_rate'], args['sensor_threshold'],
+                       args['acceleration'], args['sunrise'], args['sunset'], args['start_hour'])
+    threading.Thread(target=run_clock, args=(model, args['tick']), daemon=True).start()
+    serve(model, args['host'], args['port'])
+
+
+if __name__ == "__main__":
+    main()